@@ -25,6 +25,22 @@ CONFIG_GPG_KEYS = 'gpg_keys'
 CONFIG_ALLOWED_KEYS = 'allowed_keys'
 CONFIG_KEYSERVER = 'keyserver'
 CONFIG_KEYSERVER_DEFAULT = 'hkp://wwwkeys.pgp.net'
+CONFIG_DRY_RUN = 'dry_run'
+CONFIG_DRY_RUN_DEFAULT = False
+CONFIG_IMPORT_METHOD = 'import_method'
+IMPORT_METHOD_LINK = 'link'
+IMPORT_METHOD_REFLINK = 'reflink'
+IMPORT_METHOD_COPY = 'copy'
+IMPORT_METHODS = (IMPORT_METHOD_LINK, IMPORT_METHOD_REFLINK, IMPORT_METHOD_COPY)
+CONFIG_IMPORT_METHOD_DEFAULT = IMPORT_METHOD_LINK
+CONFIG_STORAGE_LAYOUT = 'storage_layout'
+STORAGE_LAYOUT_DEFAULT = 'default'
+STORAGE_LAYOUT_SHA256 = 'sha256'
+STORAGE_LAYOUTS = (STORAGE_LAYOUT_DEFAULT, STORAGE_LAYOUT_SHA256)
+CONFIG_STORAGE_LAYOUT_DEFAULT = STORAGE_LAYOUT_DEFAULT
+CONFIG_STORAGE_FANOUT = 'storage_fanout'
+CONFIG_STORAGE_FANOUT_DEFAULT = 2
+CONFIG_PROCESSES = 'processes'
 
 # Distributor configuration key names
 CONFIG_SERVE_HTTP = 'serve_http'
@@ -43,6 +59,7 @@ PUBLISH_DEB_STEP = "publish_deb"
 PUBLISH_DEB_RELEASE_STEP = "publish_deb_releases"
 PUBLISH_DEB_COMP_STEP = "publish_deb_components"
 PUBLISH_REPODATA = "publish_repodata"
+PUBLISH_PRUNE_POOL_STEP = "prune_pool"
 
 PUBLISH_STEPS = (PUBLISH_REPO_STEP, PUBLISH_MODULES_STEP,
                  PUBLISH_DEB_STEP, PUBLISH_REPODATA)
@@ -58,12 +75,18 @@ PUBLISH_GENERATE_LISTING_FILE_STEP = 'generate_listing_files'
 HTTP_PUBLISH_DIR_KEYWORD = 'http_publish_dir'
 HTTPS_PUBLISH_DIR_KEYWORD = 'https_publish_dir'
 PUBLISH_DEFAULT_RELEASE_KEYWORD = 'publish_default_release'
+PUBLISH_PROCESSES_KEYWORD = 'publish_processes'
+PUBLISH_SEPARATE_ARCH_ALL_KEYWORD = 'publish_separate_arch_all'
+PUBLISH_COMPRESSION_KEYWORD = 'publish_compression'
+PUBLISH_COMPRESSION_LEVELS_KEYWORD = 'publish_compression_levels'
+PUBLISH_COMPRESSION_THREADS_KEYWORD = 'publish_compression_threads'
+PUBLISH_BY_HASH_KEYWORD = 'publish_by_hash'
+PUBLISH_BY_HASH_GENERATIONS_KEYWORD = 'publish_by_hash_generations'
+PUBLISH_BY_HASH_GENERATIONS_DEFAULT = 3
 
 SYNC_STEP = 'sync_step'
-SYNC_STEP_RELEASE_DOWNLOAD = 'sync_step_release_download'
-SYNC_STEP_RELEASE_PARSE = 'sync_step_release_parse'
-SYNC_STEP_PACKAGES_DOWNLOAD = 'sync_step_packages_download'
-SYNC_STEP_PACKAGES_PARSE = 'sync_step_packages_parse'
+SYNC_STEP_RELEASES = 'sync_step_releases'
+SYNC_STEP_PLAN = 'sync_step_plan'
 SYNC_STEP_UNITS_DOWNLOAD_REQUESTS = 'sync_step_unit_download_requests'
 SYNC_STEP_UNITS_DOWNLOAD = 'sync_step_unit_download'
 SYNC_STEP_SAVE = 'sync_step_save'
@@ -14,8 +14,7 @@ EXTRA_FIELDS_DEB = set([
 TYPE_ID_DEB_COMP = 'deb_component'
 UNIT_KEY_DEB_COMP = (
     'name', 'release', 'repoid')
-EXTRA_FIELDS_DEB_COMP = set([
-    'packages'])
+EXTRA_FIELDS_DEB_COMP = set()
 
 TYPE_ID_DEB_RELEASE = 'deb_release'
 UNIT_KEY_DEB_RELEASE = (
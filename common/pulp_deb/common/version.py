@@ -0,0 +1,147 @@
+"""
+Debian package version comparison, following dpkg.
+
+A version is [epoch:]upstream[-revision]. Upstream and revision are compared
+as alternating runs of non-digits, compared character by character (with
+"~" sorting before everything, even the end of the run, and letters before
+other characters), and runs of digits, compared numerically.
+
+sort_key() encodes a version into a string whose plain (byte) ordering is the
+dpkg ordering, so units can be sorted by version in the database.
+"""
+import binascii
+import re
+import string
+
+_RUN_RE = re.compile(r'(\D*)(\d*)')
+_LETTERS = frozenset(string.ascii_letters)
+
+# Bytes of the sort key for non-digit characters. The end of a non-digit run
+# sorts after "~" and before any other character.
+_TILDE = 0x01
+_END = 0x02
+_OTHER = 0x80
+
+# Digit runs longer than this are truncated in sort keys
+_MAX_DIGITS = 0xff
+
+
+def parse(version):
+    """
+    Split a version into epoch, upstream version and revision. Versions dpkg
+    would reject because of a non-numeric epoch are taken as having no
+    epoch.
+
+    :param version: version to parse
+    :type version: str
+
+    :returns tuple: epoch (int), upstream version and revision (str)
+    """
+    epoch = 0
+    head, sep, tail = version.partition(':')
+    if sep and head.isdigit():
+        epoch = int(head)
+        version = tail
+    upstream, sep, revision = version.rpartition('-')
+    if not sep:
+        upstream, revision = revision, ''
+    return epoch, upstream, revision
+
+
+def _runs(part):
+    """
+    Return the (non-digits, number) runs of a version part. Trailing empty
+    runs compare equal to the end of the part and are dropped.
+    """
+    runs = [(chars, int(digits or 0))
+            for chars, digits in _RUN_RE.findall(part) if chars or digits]
+    if runs == [('', 0)]:
+        return []
+    return runs
+
+
+def _char_order(char):
+    if char == '~':
+        return -1
+    if char in _LETTERS:
+        return ord(char)
+    return ord(char) + 256
+
+
+def _compare_chars(a, b):
+    for i in range(max(len(a), len(b))):
+        x = _char_order(a[i]) if i < len(a) else 0
+        y = _char_order(b[i]) if i < len(b) else 0
+        if x != y:
+            return -1 if x < y else 1
+    return 0
+
+
+def _compare_part(a, b):
+    a, b = _runs(a), _runs(b)
+    for i in range(max(len(a), len(b))):
+        chars_a, num_a = a[i] if i < len(a) else ('', 0)
+        chars_b, num_b = b[i] if i < len(b) else ('', 0)
+        ret = _compare_chars(chars_a, chars_b)
+        if ret:
+            return ret
+        if num_a != num_b:
+            return -1 if num_a < num_b else 1
+    return 0
+
+
+def compare(a, b):
+    """
+    Compare two versions like dpkg --compare-versions.
+
+    :returns int: negative, zero or positive if a is older than, the same
+                  as, or newer than b
+    """
+    epoch_a, upstream_a, revision_a = parse(a)
+    epoch_b, upstream_b, revision_b = parse(b)
+    if epoch_a != epoch_b:
+        return -1 if epoch_a < epoch_b else 1
+    ret = _compare_part(upstream_a, upstream_b)
+    return ret or _compare_part(revision_a, revision_b)
+
+
+def _encode_number(key, number):
+    digits = str(number) if number else ''
+    digits = digits[:_MAX_DIGITS]
+    key.append(len(digits))
+    key.extend(ord(d) for d in digits)
+
+
+def _encode_part(key, part):
+    # The end of the part compares like an empty run, then like the end of
+    # a non-digit run. This keeps the key of a part from being a prefix of
+    # the key of a different part.
+    for chars, number in _runs(part) + [('', 0)]:
+        for char in chars:
+            if char == '~':
+                key.append(_TILDE)
+            elif char in _LETTERS:
+                key.append(ord(char))
+            else:
+                key.append(min(_OTHER + ord(char), 0xff))
+        key.append(_END)
+        _encode_number(key, number)
+    key.append(_END)
+
+
+def sort_key(version):
+    """
+    Return a string that sorts, as a plain string, like version does under
+    compare(). Versions that compare equal have the same key.
+
+    :param version: version to encode
+    :type version: str
+
+    :returns str: hexadecimal sort key
+    """
+    epoch, upstream, revision = parse(version)
+    key = bytearray()
+    _encode_number(key, epoch)
+    _encode_part(key, upstream)
+    _encode_part(key, revision)
+    return binascii.hexlify(bytes(key)).decode('ascii')
@@ -0,0 +1,59 @@
+import unittest
+
+from pulp_deb.common import version
+
+# Versions in increasing order, as sorted by dpkg
+ORDERED = [
+    '0~~',
+    '0~~a',
+    '0~',
+    '0',
+    '0a',
+    '0+',
+    '0.1~rc1',
+    '0.1',
+    '0.1-0.1',
+    '0.1-1',
+    '0.1-1ubuntu1',
+    '0.1-1+b1',
+    '0.1.0',
+    '0.2',
+    '0.10',
+    '1.0~beta1',
+    '1.0',
+    '1.0-1~bpo1',
+    '1.0-1',
+    '1.0a',
+    '1.0+dfsg',
+    '1.0.1',
+    '2',
+    '1:0.1',
+    '1:1.0-1',
+    '10:0',
+]
+
+
+class TestVersion(unittest.TestCase):
+    def test_parse(self):
+        self.assertEquals((0, '1.0', ''), version.parse('1.0'))
+        self.assertEquals((2, '1.0-rc', '3'), version.parse('2:1.0-rc-3'))
+        # Not a valid epoch
+        self.assertEquals((0, 'a:1.0', '1'), version.parse('a:1.0-1'))
+
+    def test_compare(self):
+        for i, a in enumerate(ORDERED):
+            for j, b in enumerate(ORDERED):
+                ret = version.compare(a, b)
+                expected = (i > j) - (i < j)
+                self.assertEquals(expected, (ret > 0) - (ret < 0), (a, b))
+
+    def test_compare_equal(self):
+        for a, b in [('1.0', '1.00'), ('1.0', '0:1.0'), ('1.0', '1.0-0'), ('01', '1'),
+                     ('1.', '1.0')]:
+            self.assertEquals(0, version.compare(a, b), (a, b))
+            self.assertEquals(version.sort_key(a), version.sort_key(b), (a, b))
+
+    def test_sort_key(self):
+        keys = [version.sort_key(v) for v in ORDERED]
+        self.assertEquals(sorted(keys), keys)
+        self.assertEquals(len(set(keys)), len(keys))
@@ -0,0 +1,119 @@
+"""
+Bulk operations on units and repository associations, for when saving and
+associating units one at a time costs a round trip each.
+"""
+import logging
+
+import pymongo
+from pymongo.errors import BulkWriteError
+from pymongo.collection import ReturnDocument
+from pulp.common import dateutils
+from pulp.server.db.model import RepositoryContentUnit
+
+_logger = logging.getLogger(__name__)
+
+CHUNK_SIZE = 1000
+
+# Duplicate key
+E_DUPLICATE = 11000
+
+
+def chunks(iterable, size=CHUNK_SIZE):
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def insert_units(model, units):
+    """
+    Insert new units of model. Units that already exist (e.g. uploaded
+    concurrently) are replaced in the returned list by the stored ones.
+
+    :param model: unit model class
+    :type model: subclass of pulp.server.db.model.ContentUnit
+    :param units: units that do not exist yet
+    :type units: list
+
+    :returns list: the stored units
+    """
+    collection = model._get_collection()
+    ret = []
+    for chunk in chunks(units):
+        for unit in chunk:
+            # What save() would do
+            model.pre_save_signal(model, unit)
+            unit.validate()
+        try:
+            collection.insert_many([unit.to_mongo() for unit in chunk], ordered=False)
+        except BulkWriteError as e:
+            errors = e.details.get('writeErrors', [])
+            if any(err['code'] != E_DUPLICATE for err in errors):
+                raise
+            for err in errors:
+                unit = chunk[err['index']]
+                chunk[err['index']] = model.objects.filter(**unit.unit_key).first()
+        ret.extend(chunk)
+    return ret
+
+
+def upsert_unit(model, query, update=None):
+    """
+    Update the unit of model matching query, or create it, in one round
+    trip instead of a lookup and a save.
+
+    :param model: unit model class
+    :type model: subclass of pulp.server.db.model.ContentUnit
+    :param query: values of the unit key fields
+    :type query: dict
+    :param update: values of other fields to set
+    :type update: dict
+
+    :returns: the stored unit
+    """
+    update = update or {}
+    unit = model(**dict(query, **update))
+    # What save() would do
+    model.pre_save_signal(model, unit)
+    unit.validate()
+    doc = unit.to_mongo()
+    to_set = dict((k, v) for k, v in doc.items() if k in update or k == '_last_updated')
+    on_insert = dict((k, v) for k, v in doc.items() if k not in to_set and k not in query)
+    changes = {'$setOnInsert': on_insert}
+    if to_set:
+        changes['$set'] = to_set
+    stored = model._get_collection().find_one_and_update(
+        query, changes, upsert=True, return_document=ReturnDocument.AFTER)
+    return model._from_son(stored)
+
+
+def associate_units(repo, units):
+    """
+    Associate units with repo, like repo_controller.associate_single_unit
+    does for one unit, with one bulk write per chunk of units.
+
+    :param repo: repository to associate the units with
+    :type repo: pulp.server.db.model.Repository
+    :param units: units to associate
+    :type units: iterable
+
+    :returns int: number of units associated
+    """
+    collection = RepositoryContentUnit._get_collection()
+    count = 0
+    for chunk in chunks(units):
+        now = dateutils.format_iso8601_utc_timestamp(dateutils.now_utc_timestamp())
+        requests = [
+            pymongo.UpdateOne(
+                dict(repo_id=repo.repo_id, unit_id=unit.id,
+                     unit_type_id=unit._content_type_id),
+                {'$setOnInsert': dict(created=now), '$set': dict(updated=now)},
+                upsert=True)
+            for unit in chunk]
+        collection.bulk_write(requests, ordered=False)
+        count += len(chunk)
+    return count
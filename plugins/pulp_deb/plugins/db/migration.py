@@ -0,0 +1,128 @@
+"""
+Runner for data migrations of unit collections.
+
+A UnitMigration applies a transform function to every document of a
+collection matching a query, in _id order and in batches: each batch is
+read with one query, transformed by a pool of worker processes and written
+back with one bulk write. The _id of the last document of each written batch
+is saved in the deb_migration_state collection, so a migration interrupted
+by a crash or a restart resumes after the last batch it wrote.
+"""
+import logging
+import multiprocessing
+import time
+from gettext import gettext as _
+
+import pymongo
+from pulp.server.db import connection
+
+from pulp_deb.plugins.db import bulk, models
+
+_logger = logging.getLogger(__name__)
+
+DEFAULT_PROGRESS_INTERVAL = 30
+
+
+class UnitMigration(object):
+    def __init__(self, name, collection_name, transform, query=None, projection=None,
+                 processes=None, batch_size=bulk.CHUNK_SIZE,
+                 progress_interval=DEFAULT_PROGRESS_INTERVAL, clock=time.time):
+        """
+        :param name: name the progress of the migration is saved under
+        :type name: str
+        :param collection_name: name of the collection to migrate
+        :type collection_name: str
+        :param transform: module-level function taking a document and
+                          returning the fields to set on it, or None to
+                          leave it alone. It runs in worker processes and
+                          must not use the database.
+        :type transform: callable
+        :param query: filter of the documents to migrate
+        :type query: dict
+        :param projection: fields transform needs
+        :type projection: list
+        :param processes: number of worker processes, defaults to the number
+                          of CPUs. With 1, documents are transformed in this
+                          process.
+        :type processes: int
+        :param batch_size: number of documents read and written at once
+        :type batch_size: int
+        :param progress_interval: seconds between progress reports
+        :type progress_interval: float
+        """
+        self.name = name
+        self.collection_name = collection_name
+        self.transform = transform
+        self.query = query or {}
+        self.projection = projection
+        self.processes = processes or multiprocessing.cpu_count()
+        self.batch_size = batch_size
+        self.progress_interval = progress_interval
+        self.clock = clock
+
+    def get_state(self):
+        state = models.DebMigrationState.objects.filter(name=self.name).first()
+        if state is None:
+            state = models.DebMigrationState(name=self.name)
+        return state
+
+    def run(self):
+        """
+        Migrate all the matching documents, resuming an interrupted run
+
+        :returns models.DebMigrationState: the final state
+        """
+        collection = connection.get_collection(self.collection_name)
+        state = self.get_state()
+        if state.cursor is not None:
+            _logger.info(_("Resuming migration %(name)s after %(processed)d units"),
+                         dict(name=self.name, processed=state.processed))
+        pool = None
+        if self.processes > 1:
+            pool = multiprocessing.Pool(self.processes)
+        started = last_report = self.clock()
+        processed = 0
+        try:
+            while True:
+                docs = self._next_batch(collection, state.cursor)
+                if not docs:
+                    break
+                if pool is not None:
+                    changes = pool.map(self.transform, docs,
+                                       chunksize=max(1, len(docs) // (self.processes * 4)))
+                else:
+                    changes = [self.transform(doc) for doc in docs]
+                requests = [pymongo.UpdateOne(dict(_id=doc['_id']), {'$set': change})
+                            for doc, change in zip(docs, changes) if change]
+                if requests:
+                    collection.bulk_write(requests, ordered=False)
+                state.cursor = docs[-1]['_id']
+                state.processed += len(docs)
+                state.updated += len(requests)
+                state.save()
+                processed += len(docs)
+                now = self.clock()
+                if now - last_report >= self.progress_interval:
+                    self._report(state, processed, now - started)
+                    last_report = now
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+        self._report(state, processed, self.clock() - started)
+        # Completed migrations are not run again
+        state.delete()
+        return state
+
+    def _next_batch(self, collection, cursor):
+        query = self.query
+        if cursor is not None:
+            query = {'$and': [query, {'_id': {'$gt': cursor}}]}
+        return list(collection.find(query, projection=self.projection)
+                    .sort('_id', pymongo.ASCENDING).limit(self.batch_size))
+
+    def _report(self, state, processed, elapsed):
+        _logger.info(_("Migration %(name)s: %(processed)d units processed, %(updated)d "
+                       "updated, %(rate).1f units/s"),
+                     dict(name=self.name, processed=state.processed, updated=state.updated,
+                          rate=processed / elapsed if elapsed > 0 else 0.0))
@@ -1,19 +1,32 @@
+import os
+import threading
+from collections import OrderedDict
 
 import mongoengine
-from debian import debfile
-from debpkgr import debpkg
+import pymongo
+from debian import deb822
 from pulp.server import util
 from pulp.server.controllers import repository as repo_controller
 from pulp.server.db.model import ContentUnit, FileContentUnit
-from pulp_deb.common import ids
+from pulp_deb.common import ids, version
+from pulp_deb.plugins import debstream, storage
+from pulp_deb.plugins.db import bulk
 
 NotUniqueError = mongoengine.NotUniqueError
 
+STRING_TYPES = (str, type(u''))
+
 
 class DebPackage(FileContentUnit):
     TYPE_ID = ids.TYPE_ID_DEB
+    # The platform creates the compound unique index on the unit key
     meta = dict(collection="units_deb",
-                indexes=list(ids.UNIT_KEY_DEB))
+                indexes=[
+                    'checksum',
+                    dict(fields=['name', 'architecture', 'version_sort_key']),
+                    'provides.name',
+                ],
+                index_background=True)
     unit_key_fields = ids.UNIT_KEY_DEB
 
     UNIT_KEY_TO_FIELD_MAP = dict(name="Package",
@@ -22,16 +35,35 @@ class DebPackage(FileContentUnit):
                                  installed_size="Installed-Size",
                                  multi_arch="Multi-Arch",
                                  original_maintainer="Original-Maintainer",
+                                 size="Size",
                                  )
+    # Fields from_file computes from the package file
+    FILE_FIELDS = frozenset(['checksumtype', 'checksum', 'checksums', 'size'])
+    # Digests of the package file stored in checksums, by hashlib name.
+    # These are all the digests Packages indexes list.
+    DIGESTS = ('md5', 'sha1', 'sha256', 'sha512')
+    # Fields computed from other fields when the unit is saved
+    COMPUTED_FIELDS = frozenset(['version_sort_key'])
+    # Fields of a Packages stanza that depend on the package file and on
+    # where it is published, rather than on its control file
+    STANZA_FILE_FIELDS = frozenset(['filename', 'size', 'md5sum', 'sha1', 'sha256',
+                                    'sha512', 'checksumtype', 'checksum'])
+
     name = mongoengine.StringField(required=True)
     version = mongoengine.StringField(required=True)
     architecture = mongoengine.StringField(required=True)
     checksumtype = mongoengine.StringField(required=True)
     checksum = mongoengine.StringField(required=True)
     size = mongoengine.IntField()
+    # Digests of the package file by hashlib name, see DIGESTS
+    checksums = mongoengine.DictField()
 
     filename = mongoengine.StringField(required=True)
     relativepath = mongoengine.StringField()
+    # version.sort_key(version), for sorting units by version in queries
+    version_sort_key = mongoengine.StringField()
+    # Control file paragraph, for publishing without reading the package
+    control = mongoengine.StringField()
 
     REL_FIELDS = ['breaks', 'conflicts', 'depends', 'enhances', 'pre_depends',
                   'provides', 'recommends', 'replaces', 'suggests']
@@ -64,46 +96,120 @@ class DebPackage(FileContentUnit):
 
     @classmethod
     def from_file(cls, filename, user_metadata=None):
+        unit_md = cls.read_file(filename)
+        if user_metadata:
+            # What we computed from the file itself is authoritative
+            user_metadata = dict((k, v) for k, v in user_metadata.items()
+                                 if k not in cls.FILE_FIELDS)
+
+        return cls.from_metadata(unit_md, user_metadata)
+
+    @classmethod
+    def read_file(cls, filename):
+        """
+        Return the control fields of a package file (or file object), with
+        its checksums and size
+        """
         if hasattr(filename, "read"):
             fobj = filename
         else:
             try:
-                fobj = open(filename, "r")
+                fobj = open(filename, "rb")
             except IOError as e:
                 raise Error(str(e))
-        unit_md = cls._read_metadata(filename)
+        try:
+            unit_md, checksums, size = cls._read_metadata(fobj)
+        finally:
+            if fobj is not filename:
+                fobj.close()
         unit_md.update(checksumtype=util.TYPE_SHA256,
-                       checksum=cls._compute_checksum(fobj),
-                       size=fobj.tell())
-
-        return cls.from_metadata(unit_md, user_metadata)
+                       checksum=checksums[util.TYPE_SHA256],
+                       checksums=checksums,
+                       Size=size)
+        return unit_md
 
     @classmethod
     def from_metadata(cls, unit_md, user_metadata=None):
-        ignored = set(['filename'])
-
+        """
+        Create a unit from a control dict (e.g. a Packages stanza). Values in
+        user_metadata, keyed by field name, take precedence.
+        """
+        user_metadata = user_metadata or {}
         metadata = dict()
-        for attr, fdef in cls._fields.items():
-            if attr == 'id' or attr.startswith('_'):
-                continue
-            if user_metadata and attr in user_metadata:
-                # We won't be mapping fields from
-                # user_metadata, if the user wanted to overwrite something
-                # they'd have done it with the properties pulp expects.
+        get = unit_md.get
+        for attr, prop_name, required, convert in cls._metadata_plan():
+            if attr in user_metadata:
                 metadata[attr] = user_metadata[attr]
-            prop_name = cls.UNIT_KEY_TO_FIELD_MAP.get(attr, attr)
-            val = unit_md.get(prop_name)
-            if val is None and fdef.required and attr not in ignored:
-                raise Error('Required field is missing: {}'.format(attr))
+                continue
+            val = get(prop_name)
+            if val is None:
+                if required:
+                    raise Error('Required field is missing: {}'.format(attr))
+            elif convert is not None and isinstance(val, STRING_TYPES):
+                # Packages files carry Size and relations as strings
+                val = convert(val)
             metadata[attr] = val
         metadata['filename'] = cls.filename_from_unit_key(metadata)
+        if metadata.get('control') is None and isinstance(unit_md, deb822.Deb822):
+            # A Packages stanza
+            metadata['control'] = cls.control_from_stanza(unit_md)
         return cls(**metadata)
 
+    @classmethod
+    def control_from_stanza(cls, stanza):
+        """
+        Return the control paragraph of the package described by a Packages
+        stanza
+        """
+        control = deb822.Deb822()
+        for field, value in stanza.items():
+            if field.lower() not in cls.STANZA_FILE_FIELDS:
+                control[field] = value
+        return control.dump()
+
+    @classmethod
+    def _metadata_plan(cls):
+        """
+        Return (field name, control field name, required, conversion) for
+        every field from_metadata fills, computed once per class
+        """
+        plan = cls.__dict__.get('_METADATA_PLAN')
+        if plan is None:
+            ignored = set(['filename'])
+            plan = []
+            for attr, fdef in sorted(cls._fields.items()):
+                if attr == 'id' or attr.startswith('_') or attr in cls.COMPUTED_FIELDS:
+                    continue
+                convert = None
+                if isinstance(fdef, mongoengine.IntField):
+                    convert = int
+                elif attr in cls.REL_FIELDS:
+                    convert = DependencyParser.parse_field
+                plan.append((attr, cls.UNIT_KEY_TO_FIELD_MAP.get(attr, attr),
+                             fdef.required and attr not in ignored, convert))
+            plan = cls._METADATA_PLAN = tuple(plan)
+        return plan
+
+    @classmethod
+    def pre_save_signal(cls, sender, document, **kwargs):
+        super(DebPackage, cls).pre_save_signal(sender, document, **kwargs)
+        if document.version is not None:
+            document.version_sort_key = version.sort_key(document.version)
+
     @classmethod
     def _compute_checksum(cls, fobj):
         cstype = util.TYPE_SHA256
         return util.calculate_checksums(fobj, [cstype])[cstype]
 
+    @classmethod
+    def _compute_checksums(cls, fobj):
+        """
+        Return all the DIGESTS of a package file, computed in one pass
+        """
+        reader = debstream.HashingReader(fobj, cls.DIGESTS)
+        reader.drain()
+        return reader.checksums()
+
     @classmethod
     def filename_from_unit_key(cls, unit_key):
         return "{0}_{1}_{2}.{3}".format(
@@ -134,33 +240,64 @@ class DebPackage(FileContentUnit):
             repository=repo, unit=self)
         return self
 
-    def save_and_associate(self, file_path, repo):
-        filename = self.filename_from_unit_key(self.unit_key)
-        self.set_storage_path(filename)
+    def save_and_associate(self, file_path, repo, import_methods=None,
+                           storage_layout=None):
+        """
+        Save the unit, import file_path into the content storage and
+        associate the unit with repo.
+
+        import_methods is a list of storage.IMPORT_* methods to try before
+        falling back to copying the file. storage_layout, if set, is a
+        storage.ContentAddressedLayout to use instead of Pulp's layout.
+        """
+        if storage_layout is not None:
+            self._storage_path = storage_layout.path(self.checksum)
+            import_methods = import_methods or [storage.IMPORT_COPY]
+        else:
+            filename = self.filename_from_unit_key(self.unit_key)
+            self.set_storage_path(filename)
         unit = self
         try:
             self.save()
-            self.safe_import_content(file_path)
+            if storage_layout is not None and os.path.exists(self._storage_path):
+                # Content-addressed: identical bytes are already in place
+                pass
+            elif import_methods:
+                storage.import_file(file_path, self._storage_path, import_methods)
+            else:
+                self.safe_import_content(file_path)
         except NotUniqueError:
             unit = self.__class__.objects.filter(**unit.unit_key).first()
+            if not unit.downloaded:
+                # The stored file was found corrupt or missing, replace it
+                storage.import_file(file_path, unit._storage_path,
+                                    import_methods or [storage.IMPORT_COPY])
+                unit.downloaded = True
+                if self.checksums:
+                    unit.checksums = self.checksums
+                unit.save()
         unit.associate(repo)
         return unit
 
     @classmethod
-    def _read_metadata(cls, filename):
+    def _read_metadata(cls, fobj):
+        """
+        Read the control data of a package and checksum it, in one pass.
+
+        :returns tuple: control fields, checksums by type and package size
+        """
         try:
-            deb = debfile.DebFile(filename)
-        except debfile.ArError as e:
+            control, checksums, size = debstream.read_package(fobj, cls.DIGESTS)
+        except debstream.Error as e:
             raise InvalidPackageError(str(e))
-        ret = dict(deb.debcontrol())
-        deps = debpkg.DebPkgRequires(**ret)
+        paragraph = deb822.Deb822(control)
+        ret = dict(paragraph)
+        ret['control'] = paragraph.dump()
         # Munge relation fields
-
         for fname in cls.REL_FIELDS:
-            vals = deps.relations.get(fname, [])
-            vals = DependencyParser.parse(vals)
-            ret[fname] = vals
-        return ret
+            control_field = '-'.join(x.capitalize() for x in fname.split('_'))
+            ret[fname] = DependencyParser.parse_field(ret.get(control_field))
+        return ret, checksums, size
 
 
 class DebComponent(ContentUnit):
@@ -168,14 +305,14 @@ class DebComponent(ContentUnit):
     This unittype represents a deb release component
     """
     TYPE_ID = ids.TYPE_ID_DEB_COMP
+    # Units are only looked up by their unit key, which the platform indexes
     meta = dict(collection="units_deb_component",
-                indexes=list(ids.UNIT_KEY_DEB_COMP))
+                indexes=[])
     unit_key_fields = ids.UNIT_KEY_DEB_COMP
 
     name = mongoengine.StringField(required=True)
     release = mongoengine.StringField(required=True)
     repoid = mongoengine.StringField(required=True)
-    packages = mongoengine.ListField()
 
     # For backward compatibility
     _ns = mongoengine.StringField(required=True, default=meta['collection'])
@@ -196,36 +333,133 @@ class DebComponent(ContentUnit):
         return unit
 
     def associate(self, repo):
-        # actually update the corresponding unit in the repository
-        # or create a new copy
-        unit = self
-        if unit.repoid != repo.repo_id:
-            # find the corresponding unit
-            unit = self.__class__.objects.filter(repoid=repo.repo_id,
-                                                 name=self.name,
-                                                 release=self.release).first()
-            if unit is None:
-                # create a new one
-                unit = self.__class__()
-                unit.repoid = repo.repo_id
-                unit.name = self.name
-                unit.release = self.release
-
-            # update data
-            unit.packages = self.packages
-            unit.save()
+        unit = self.copy_to(repo)
         repo_controller.associate_single_unit(
             repository=repo, unit=unit)
         return unit
 
+    def copy_to(self, repo):
+        """
+        Return the corresponding unit of repo, updated from this one or
+        newly created, without associating it
+        """
+        if self.repoid == repo.repo_id:
+            return self
+        unit = bulk.upsert_unit(self.__class__, dict(repoid=repo.repo_id,
+                                                     name=self.name,
+                                                     release=self.release))
+        # update data
+        unit.set_packages(self.get_packages())
+        return unit
+
+    def get_packages(self):
+        """
+        Return the set of ids of the DebPackage units in this component
+        """
+        return DebComponentPackage.unit_ids_by_component([self.id])[self.id]
+
+    def add_packages(self, unit_ids):
+        DebComponentPackage.add(self.id, unit_ids)
+
+    def remove_packages(self, unit_ids):
+        DebComponentPackage.remove(self.id, unit_ids)
+
+    def set_packages(self, unit_ids):
+        """
+        Make unit_ids the packages of this component, only writing the
+        memberships that changed
+        """
+        unit_ids = set(unit_ids)
+        current = self.get_packages()
+        self.remove_packages(current - unit_ids)
+        self.add_packages(unit_ids - current)
+
+
+class DebComponentPackage(mongoengine.Document):
+    """
+    Membership of a DebPackage unit in a DebComponent unit
+    """
+    component_id = mongoengine.StringField(required=True)
+    unit_id = mongoengine.StringField(required=True)
+
+    meta = dict(collection="deb_component_packages",
+                allow_inheritance=False,
+                indexes=[
+                    dict(fields=['component_id', 'unit_id'], unique=True),
+                    'unit_id',
+                ])
+
+    @classmethod
+    def unit_ids_by_component(cls, component_ids):
+        ret = dict((component_id, set()) for component_id in component_ids)
+        query = cls.objects.filter(component_id__in=list(component_ids))
+        for component_id, unit_id in query.scalar('component_id', 'unit_id'):
+            ret[component_id].add(unit_id)
+        return ret
+
+    @classmethod
+    def add(cls, component_id, unit_ids):
+        requests = [
+            pymongo.UpdateOne(dict(component_id=component_id, unit_id=unit_id),
+                              {'$set': dict(component_id=component_id, unit_id=unit_id)},
+                              upsert=True)
+            for unit_id in unit_ids]
+        if requests:
+            cls._get_collection().bulk_write(requests, ordered=False)
+
+    @classmethod
+    def remove(cls, component_id, unit_ids):
+        unit_ids = list(unit_ids)
+        if unit_ids:
+            cls.objects.filter(component_id=component_id, unit_id__in=unit_ids).delete()
+
+    @classmethod
+    def remove_components(cls, component_ids):
+        component_ids = list(component_ids)
+        if component_ids:
+            cls.objects.filter(component_id__in=component_ids).delete()
+
+    @classmethod
+    def remove_dangling(cls, batch_size=1000):
+        """
+        Remove the memberships of components and packages that no longer
+        exist. Purging orphaned units deletes them without going through the
+        models, so their memberships stay behind until this runs.
+
+        :returns int: number of memberships removed
+        """
+        removed = 0
+        component_ids = cls.objects.distinct('component_id')
+        existing = set(DebComponent.objects.filter(id__in=component_ids).scalar('id'))
+        gone = [x for x in component_ids if x not in existing]
+        if gone:
+            removed += cls.objects.filter(component_id__in=gone).delete()
+        # Walk the unit ids in order, so only one batch is held at a time
+        cursor = None
+        while True:
+            query = cls.objects
+            if cursor is not None:
+                query = query.filter(unit_id__gt=cursor)
+            query = query.order_by('unit_id').limit(batch_size)
+            unit_ids = sorted(set(query.scalar('unit_id')))
+            if not unit_ids:
+                break
+            existing = set(DebPackage.objects.filter(id__in=unit_ids).scalar('id'))
+            gone = [x for x in unit_ids if x not in existing]
+            if gone:
+                removed += cls.objects.filter(unit_id__in=gone).delete()
+            cursor = unit_ids[-1]
+        return removed
+
 
 class DebRelease(ContentUnit):
     """
     This unittype represents a deb release
     """
     TYPE_ID = ids.TYPE_ID_DEB_RELEASE
+    # Units are only looked up by their unit key, which the platform indexes
     meta = dict(collection="units_deb_release",
-                indexes=list(ids.UNIT_KEY_DEB_RELEASE))
+                indexes=[])
     unit_key_fields = ids.UNIT_KEY_DEB_RELEASE
 
     repoid = mongoengine.StringField(required=True)
@@ -253,26 +487,102 @@ class DebRelease(ContentUnit):
         return unit
 
     def associate(self, repo):
-        # actually update the corresponding unit in the repository
-        # or create a new copy
-        unit = self
-        if unit.repoid != repo.repo_id:
-            # find the corresponding unit
-            unit = self.__class__.objects.filter(repoid=repo.repo_id,
-                                                 codename=self.codename).first()
-            if unit is None:
-                # create a new one
-                unit = self.__class__()
-                unit.repoid = repo.repo_id
-                unit.codename = self.codename
-
-            # update data
-            unit.suite = self.suite
-            unit.save()
+        unit = self.copy_to(repo)
         repo_controller.associate_single_unit(
             repository=repo, unit=unit)
         return unit
 
+    def copy_to(self, repo):
+        """
+        Return the corresponding unit of repo, updated from this one or
+        newly created, without associating it
+        """
+        if self.repoid == repo.repo_id:
+            return self
+        return bulk.upsert_unit(self.__class__,
+                                dict(repoid=repo.repo_id, codename=self.codename),
+                                dict(suite=self.suite))
+
+
+class DebScrubState(mongoengine.Document):
+    """
+    Progress of the storage scrubber, so it can resume where it stopped
+    """
+    name = mongoengine.StringField(primary_key=True)
+    # Last unit checked in the current pass
+    cursor = mongoengine.StringField()
+    pass_started = mongoengine.DateTimeField()
+    passes = mongoengine.IntField(default=0)
+    checked = mongoengine.IntField(default=0)
+    # Number of corrupt or missing files found in the current and the last
+    # pass, which are listed in deb_scrub_problems
+    problem_count = mongoengine.IntField(default=0)
+    last_pass_problem_count = mongoengine.IntField(default=0)
+
+    meta = dict(collection="deb_scrub_state", allow_inheritance=False)
+
+
+class DebScrubProblem(mongoengine.Document):
+    """
+    Corrupt or missing file found by a pass of the storage scrubber
+    """
+    state = mongoengine.StringField(required=True)
+    # Number of passes completed before the one that found it
+    pass_number = mongoengine.IntField(required=True)
+    unit_id = mongoengine.StringField(required=True)
+    unit_key = mongoengine.DictField()
+    path = mongoengine.StringField()
+    problem = mongoengine.StringField(required=True)
+    found = mongoengine.DateTimeField()
+
+    meta = dict(collection="deb_scrub_problems",
+                allow_inheritance=False,
+                indexes=[
+                    dict(fields=['state', 'pass_number', 'unit_id'], unique=True),
+                ])
+
+
+class DebMigrationState(mongoengine.Document):
+    """
+    Progress of an interrupted unit migration, so it can resume where it
+    stopped
+    """
+    name = mongoengine.StringField(primary_key=True)
+    # _id of the last document migrated
+    cursor = mongoengine.DynamicField()
+    processed = mongoengine.IntField(default=0)
+    updated = mongoengine.IntField(default=0)
+
+    meta = dict(collection="deb_migration_state", allow_inheritance=False)
+
+
+class FrozenDict(dict):
+    """
+    A dict that cannot be changed, so that one parsed relation can be shared
+    by every package declaring it
+    """
+    __slots__ = ()
+
+    def _immutable(self, *args, **kwargs):
+        raise TypeError("%s cannot be changed" % self.__class__.__name__)
+
+    __setitem__ = __delitem__ = _immutable
+    clear = pop = popitem = setdefault = update = _immutable
+
+    def __reduce__(self):
+        return (self.__class__, (dict(self),))
+
+
+def _freeze(value):
+    """
+    Return a parsed relation as FrozenDicts and tuples
+    """
+    if isinstance(value, dict):
+        return FrozenDict((k, _freeze(v)) for k, v in value.items())
+    if isinstance(value, (list, tuple)):
+        return tuple(_freeze(v) for v in value)
+    return value
+
 
 class DependencyParser(object):
     DEP_OPERATOR_MAP = {
@@ -283,6 +593,43 @@ class DependencyParser(object):
         '<=': 'LE',
     }
 
+    # Parsed relations, most recently used last. Relations like
+    # "libc6 (>= 2.34)" are shared by thousands of packages, which all get
+    # the same cached value: a FrozenDict, or a tuple of them for
+    # alternatives. Callers wanting to change a relation copy it first.
+    CACHE_SIZE = 16384
+    _cache = OrderedDict()
+    _cache_lock = threading.Lock()
+
+    @classmethod
+    def parse_field(cls, raw):
+        """
+        Parse the value of a relationship field (Depends, Provides, ...)
+
+        :returns list: the shared, immutable value of each relation
+        """
+        if not raw:
+            return []
+        return [cls.parse_relation(rel) for rel in raw.split(',') if rel.strip()]
+
+    @classmethod
+    def parse_relation(cls, relation):
+        """
+        Parse a single relation, with its alternatives ("a (>= 1) | b")
+        """
+        key = ' '.join(relation.split())
+        with cls._cache_lock:
+            ret = cls._cache.pop(key, None)
+            if ret is not None:
+                cls._cache[key] = ret
+                return ret
+        ret = _freeze(cls._parse_one(deb822.PkgRelation.parse_relations(key)[0]))
+        with cls._cache_lock:
+            cls._cache[key] = ret
+            while len(cls._cache) > cls.CACHE_SIZE:
+                cls._cache.popitem(last=False)
+        return ret
+
     @classmethod
     def parse(cls, deps):
         assert isinstance(deps, list)
@@ -0,0 +1,154 @@
+"""
+Single-pass reader for .deb packages.
+
+A .deb is an ar archive of debian-binary, control.tar.* and data.tar.*.
+read_package walks the archive once, feeding every byte to the requested
+hashes, and only extracts the control file. data.tar.* is hashed but never
+decompressed.
+"""
+import hashlib
+import io
+import os
+import subprocess
+import tarfile
+
+AR_MAGIC = b'!<arch>\n'
+AR_HEADER_SIZE = 60
+AR_HEADER_END = b'`\n'
+
+CHUNK_SIZE = 1024 * 1024
+
+# Decompressors for control.tar members that tarfile does not handle under
+# Python 2, tried in order
+_EXTERNAL_DECOMPRESSORS = {
+    '.xz': (('lzma', 'decompress'), ['xz', '-dc']),
+    '.zst': (('zstandard', None), ['zstd', '-dc']),
+}
+
+
+class Error(ValueError):
+    pass
+
+
+class HashingReader(object):
+    """
+    Reads from fobj, feeding everything read to hashers and counting bytes
+    """
+    def __init__(self, fobj, checksum_types):
+        self.fobj = fobj
+        self.hashers = dict((t, hashlib.new(t)) for t in checksum_types)
+        self.size = 0
+
+    def read(self, size):
+        data = self.fobj.read(size)
+        for hasher in self.hashers.values():
+            hasher.update(data)
+        self.size += len(data)
+        return data
+
+    def read_exactly(self, size):
+        chunks = []
+        while size > 0:
+            data = self.read(min(size, CHUNK_SIZE))
+            if not data:
+                raise Error("Truncated package")
+            chunks.append(data)
+            size -= len(data)
+        return b''.join(chunks)
+
+    def skip(self, size):
+        while size > 0:
+            data = self.read(min(size, CHUNK_SIZE))
+            if not data:
+                raise Error("Truncated package")
+            size -= len(data)
+
+    def drain(self):
+        while self.read(CHUNK_SIZE):
+            pass
+
+    def checksums(self):
+        return dict((t, h.hexdigest()) for t, h in self.hashers.items())
+
+
+def read_package(fobj, checksum_types=('sha256', )):
+    """
+    Read a .deb package from fobj.
+
+    :param fobj: file object positioned at the start of the package
+    :param checksum_types: hashlib names of the checksums to compute
+    :type checksum_types: iterable
+
+    :returns tuple: contents of the control file (bytes), dict of checksums
+                    by type, and the size of the package
+    """
+    reader = HashingReader(fobj, checksum_types)
+    if reader.read(len(AR_MAGIC)) != AR_MAGIC:
+        raise Error("Not an ar archive")
+    control = None
+    while True:
+        header = reader.read(AR_HEADER_SIZE)
+        if not header.strip():
+            break
+        name, size = _parse_header(header)
+        if control is None and name.startswith('control.tar'):
+            control = _extract_control(name, reader.read_exactly(size))
+        else:
+            reader.skip(size)
+        if size % 2:
+            # Members are aligned on even offsets
+            reader.read(1)
+    # Anything trailing still is part of the file
+    reader.drain()
+    if control is None:
+        raise Error("No control.tar member found")
+    return control, reader.checksums(), reader.size
+
+
+def _parse_header(header):
+    if len(header) != AR_HEADER_SIZE or header[58:60] != AR_HEADER_END:
+        raise Error("Invalid ar member header")
+    name = header[0:16].decode('ascii', 'replace').strip()
+    if name.endswith('/'):
+        # GNU ar terminates names with a slash
+        name = name[:-1]
+    try:
+        size = int(header[48:58])
+    except ValueError:
+        raise Error("Invalid ar member size")
+    return name, size
+
+
+def _extract_control(name, data):
+    ext = os.path.splitext(name)[1]
+    if ext in _EXTERNAL_DECOMPRESSORS:
+        data = _decompress(ext, data)
+    try:
+        tar = tarfile.open(fileobj=io.BytesIO(data), mode='r:*')
+        for member in tar:
+            if member.isfile() and os.path.normpath(member.name) == 'control':
+                return tar.extractfile(member).read()
+    except tarfile.TarError as e:
+        raise Error("Invalid %s: %s" % (name, e))
+    raise Error("No control file in %s" % name)
+
+
+def _decompress(ext, data):
+    (module_name, function_name), command = _EXTERNAL_DECOMPRESSORS[ext]
+    try:
+        module = __import__(module_name)
+    except ImportError:
+        module = None
+    if module is not None:
+        if function_name is not None:
+            return getattr(module, function_name)(data)
+        return module.ZstdDecompressor().decompressobj().decompress(data)
+    try:
+        proc = subprocess.Popen(command, stdin=subprocess.PIPE,
+                                stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    except OSError as e:
+        raise Error("Unable to decompress %s control member: %s" % (ext, e))
+    out, err = proc.communicate(data)
+    if proc.returncode != 0:
+        raise Error("Unable to decompress %s control member: %s" % (ext, err.strip()))
+    return out
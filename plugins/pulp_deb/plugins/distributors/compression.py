@@ -0,0 +1,387 @@
+"""
+Single-pass writing of Packages indexes in several compression formats.
+
+write_index() writes the uncompressed index and feeds the same data, as it
+goes, to one compressor per configured format. Every file is hashed while it
+is written, so the data is walked once and the checksums of the Release file
+come from the same streams. Every compressor runs in a thread of its own:
+gzip and bzip2 compress in this process, as do xz and zstd with the lzma and
+zstandard modules when they are importable, all of which release the GIL
+while compressing. Otherwise xz and zstd use the xz and zstd commands, which
+can use several threads.
+"""
+import bz2
+import errno
+import gzip
+import hashlib
+import os
+import subprocess
+import threading
+from collections import namedtuple
+from distutils.spawn import find_executable
+
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+
+FORMAT_GZ = 'gz'
+FORMAT_BZ2 = 'bz2'
+FORMAT_XZ = 'xz'
+FORMAT_ZSTD = 'zst'
+FORMATS = (FORMAT_GZ, FORMAT_BZ2, FORMAT_XZ, FORMAT_ZSTD)
+DEFAULT_FORMATS = (FORMAT_GZ, FORMAT_XZ)
+
+# Compression levels: default, lowest and highest
+LEVELS = {
+    FORMAT_GZ: (9, 1, 9),
+    FORMAT_BZ2: (9, 1, 9),
+    FORMAT_XZ: (6, 0, 9),
+    FORMAT_ZSTD: (3, 1, 19),
+}
+
+# Digests of the Release file: hashlib name, Release field, entry key
+RELEASE_DIGESTS = (('md5', 'MD5sum', 'md5sum'),
+                   ('sha1', 'SHA1', 'sha1'),
+                   ('sha256', 'SHA256', 'sha256'))
+
+# Data written to an index is passed on to the compressors by chunks of
+# this size
+CHUNK_SIZE = 256 * 1024
+
+# Chunks queued for each compressor thread before writing the index waits
+# for it
+QUEUE_SIZE = 8
+
+# Python modules and commands implementing the formats not in the standard
+# library of every supported Python
+_MODULES = {
+    FORMAT_XZ: ('lzma', 'xz'),
+    FORMAT_ZSTD: ('zstandard', 'zstd'),
+}
+
+
+class Error(Exception):
+    pass
+
+
+class IndexCompression(namedtuple('IndexCompression', ['formats', 'levels', 'threads'])):
+    """
+    Compression settings of the indexes: formats, the level of each
+    format, and threads compressors may use
+    """
+    __slots__ = ()
+
+    @classmethod
+    def create(cls, formats=None, levels=None, threads=1):
+        if formats is None:
+            formats = default_formats()
+        levels = levels or {}
+        formats = tuple(fmt for fmt in FORMATS if fmt in formats)
+        return cls(formats, tuple(levels.get(fmt, LEVELS[fmt][0]) for fmt in formats),
+                   threads)
+
+    def fingerprint(self):
+        """
+        Return a string that changes when the files written with these
+        settings may change
+        """
+        ret = ' '.join('%s:%d' % pair for pair in zip(self.formats, self.levels))
+        if self.threads > 1:
+            ret += ' threads:%d' % self.threads
+        return ret
+
+
+def _import(module_name):
+    try:
+        return __import__(module_name)
+    except ImportError:
+        return None
+
+
+def available(fmt):
+    """
+    Whether indexes can be compressed in format fmt here
+    """
+    if fmt not in _MODULES:
+        return fmt in FORMATS
+    module_name, command = _MODULES[fmt]
+    return _import(module_name) is not None or find_executable(command) is not None
+
+
+def default_formats():
+    """
+    Return the formats of DEFAULT_FORMATS available here. Without the lzma
+    module, as on Python 2, xz needs the xz command.
+    """
+    return tuple(fmt for fmt in DEFAULT_FORMATS if available(fmt))
+
+
+class HashingWriter(object):
+    """
+    Writes to fobj, feeding everything written to hashers and counting bytes
+    """
+    def __init__(self, fobj):
+        self.fobj = fobj
+        self.hashers = dict((name, hashlib.new(name)) for name, _f, _k in RELEASE_DIGESTS)
+        self.size = 0
+
+    def write(self, data):
+        self.fobj.write(data)
+        for hasher in self.hashers.values():
+            hasher.update(data)
+        self.size += len(data)
+
+    def flush(self):
+        self.fobj.flush()
+
+    def checksums(self):
+        return dict((name, h.hexdigest()) for name, h in self.hashers.items())
+
+
+class _CompressorWriter(object):
+    """
+    Compresses data with a compressor object into out
+    """
+    def __init__(self, compressor, out):
+        self.compressor = compressor
+        self.out = out
+
+    def write(self, data):
+        data = self.compressor.compress(data)
+        if data:
+            self.out.write(data)
+
+    def close(self):
+        self.out.write(self.compressor.flush())
+
+    def abort(self):
+        pass
+
+
+class _GzipWriter(object):
+    def __init__(self, out, level):
+        # No name and no timestamp in the header: the same index always
+        # compresses to the same file
+        self.gzip = gzip.GzipFile(filename='', mode='wb', compresslevel=level,
+                                  fileobj=out, mtime=0)
+
+    def write(self, data):
+        self.gzip.write(data)
+
+    def close(self):
+        self.gzip.close()
+
+    def abort(self):
+        pass
+
+
+class _CommandWriter(object):
+    """
+    Compresses data by piping it through a command, whose output a thread
+    writes into out
+    """
+    def __init__(self, command, out):
+        self.command = command
+        try:
+            self.proc = subprocess.Popen(command, stdin=subprocess.PIPE,
+                                         stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        except OSError as e:
+            raise Error("Unable to run %s: %s" % (command[0], e))
+        self.thread = threading.Thread(target=self._copy, args=(out, ))
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _copy(self, out):
+        for data in iter(lambda: self.proc.stdout.read(CHUNK_SIZE), b''):
+            out.write(data)
+
+    def write(self, data):
+        try:
+            self.proc.stdin.write(data)
+        except IOError as e:
+            if e.errno != errno.EPIPE:
+                raise
+            # The command failed, close() reports why
+
+    def close(self):
+        try:
+            self.proc.stdin.close()
+        except IOError as e:
+            if e.errno != errno.EPIPE:
+                raise
+        self.thread.join()
+        err = self.proc.stderr.read()
+        self.proc.stdout.close()
+        self.proc.stderr.close()
+        if self.proc.wait() != 0:
+            raise Error("%s failed: %s" % (self.command[0], err.strip()))
+
+    def abort(self):
+        if self.proc.poll() is None:
+            self.proc.kill()
+        self.proc.wait()
+        self.thread.join()
+        for pipe in (self.proc.stdin, self.proc.stdout, self.proc.stderr):
+            pipe.close()
+
+
+class _ThreadedWriter(object):
+    """
+    Runs writer in a thread of its own, fed through a bounded queue, so that
+    the compressors of an index work in parallel
+    """
+    def __init__(self, writer):
+        self.writer = writer
+        self.queue = queue.Queue(QUEUE_SIZE)
+        self.error = None
+        self.aborted = False
+        self.finished = False
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _run(self):
+        try:
+            for data in iter(self.queue.get, None):
+                self.writer.write(data)
+        except Exception as e:
+            self.error = e
+            # Keep consuming, so that write() never blocks
+            for _data in iter(self.queue.get, None):
+                pass
+            return
+        if not self.aborted:
+            try:
+                self.writer.close()
+            except Exception as e:
+                self.error = e
+
+    def write(self, data):
+        if self.error is not None:
+            raise self.error
+        self.queue.put(data)
+
+    def finish(self):
+        """
+        Let the writer complete, without waiting for it
+        """
+        if not self.finished:
+            self.finished = True
+            self.queue.put(None)
+
+    def close(self):
+        self.finish()
+        self.thread.join()
+        if self.error is not None:
+            raise self.error
+
+    def abort(self):
+        self.aborted = True
+        self.finish()
+        self.thread.join()
+        self.writer.abort()
+
+
+def _compressor(fmt, out, level, threads):
+    if fmt == FORMAT_GZ:
+        return _GzipWriter(out, level)
+    if fmt == FORMAT_BZ2:
+        return _CompressorWriter(bz2.BZ2Compressor(level), out)
+    module_name, command = _MODULES[fmt]
+    module = _import(module_name)
+    # Only the commands compress xz with several threads
+    if module is None or (threads > 1 and fmt == FORMAT_XZ and find_executable(command)):
+        return _CommandWriter([command, '-c', '-q', '-%d' % level, '-T%d' % threads], out)
+    if fmt == FORMAT_XZ:
+        return _CompressorWriter(module.LZMACompressor(preset=level), out)
+    compressor = module.ZstdCompressor(level=level, threads=threads if threads > 1 else 0)
+    return _CompressorWriter(compressor.compressobj(), out)
+
+
+class _Tee(object):
+    """
+    Buffers the data of an index and passes it on to the uncompressed file
+    and to every compressor
+    """
+    def __init__(self, writers):
+        self.writers = writers
+        self.chunks = []
+        self.size = 0
+
+    def write(self, data):
+        self.chunks.append(data)
+        self.size += len(data)
+        if self.size >= CHUNK_SIZE:
+            self.flush()
+
+    def flush(self):
+        if not self.chunks:
+            return
+        data = b''.join(self.chunks)
+        self.chunks = []
+        self.size = 0
+        for writer in self.writers:
+            writer.write(data)
+
+
+def write_index(release_dir, relative_path, stanzas, compression):
+    """
+    Write an index and its compressed versions in one pass.
+
+    :param release_dir: directory of the Release file
+    :type release_dir: str
+    :param relative_path: path of the uncompressed index, relative to
+                          release_dir
+    :type relative_path: str
+    :param stanzas: objects with a dump(fd) method writing a stanza
+    :type stanzas: iterable
+    :param compression: compression settings
+    :type compression: IndexCompression
+
+    :returns dict: checksums of the files for the Release file, by Release
+                   field
+    """
+    names = [relative_path] + ['%s.%s' % (relative_path, fmt) for fmt in compression.formats]
+    paths = [os.path.join(release_dir, name) for name in names]
+    try:
+        os.makedirs(os.path.dirname(paths[0]))
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+    files = []
+    compressors = []
+    try:
+        for path in paths:
+            if os.path.lexists(path):
+                # Do not write through a link to a previous publish
+                os.unlink(path)
+            files.append(HashingWriter(open(path, 'wb')))
+        for fmt, level, out in zip(compression.formats, compression.levels, files[1:]):
+            compressors.append(_ThreadedWriter(_compressor(fmt, out, level,
+                                                           compression.threads)))
+        tee = _Tee([files[0]] + compressors)
+        for i, stanza in enumerate(stanzas):
+            if i:
+                tee.write(b"\n")
+            stanza.dump(tee)
+        tee.flush()
+        # Compressors flush their last blocks in parallel too
+        for compressor in compressors:
+            compressor.finish()
+        while compressors:
+            compressors[0].close()
+            compressors.pop(0)
+    finally:
+        for compressor in compressors:
+            compressor.abort()
+        for out in files:
+            out.fobj.close()
+    checksums = dict()
+    for name, out in zip(names, files):
+        digests = out.checksums()
+        for alg, field, key in RELEASE_DIGESTS:
+            entry = dict(name=name, size=str(out.size))
+            entry[key] = digests[alg]
+            checksums.setdefault(field, []).append(entry)
+    return checksums
@@ -1,12 +1,18 @@
 import logging
+import multiprocessing
 import os
 from debpkgr import signer
+from pulp_deb.plugins.distributors import compression
 from gettext import gettext as _
 
 from pulp_deb.common.constants import PUBLISH_HTTP_KEYWORD, \
     PUBLISH_HTTPS_KEYWORD, PUBLISH_RELATIVE_URL_KEYWORD, \
     HTTP_PUBLISH_DIR_KEYWORD, HTTPS_PUBLISH_DIR_KEYWORD, \
-    PUBLISH_DEFAULT_RELEASE_KEYWORD, \
+    PUBLISH_DEFAULT_RELEASE_KEYWORD, PUBLISH_PROCESSES_KEYWORD, \
+    PUBLISH_SEPARATE_ARCH_ALL_KEYWORD, PUBLISH_COMPRESSION_KEYWORD, \
+    PUBLISH_COMPRESSION_LEVELS_KEYWORD, PUBLISH_COMPRESSION_THREADS_KEYWORD, \
+    PUBLISH_BY_HASH_KEYWORD, PUBLISH_BY_HASH_GENERATIONS_KEYWORD, \
+    PUBLISH_BY_HASH_GENERATIONS_DEFAULT, \
     GPG_CMD, GPG_KEY_ID
 
 _LOG = logging.getLogger(__name__)
@@ -15,13 +21,18 @@ REQUIRED_CONFIG_KEYS = (PUBLISH_RELATIVE_URL_KEYWORD, PUBLISH_HTTP_KEYWORD,
                         PUBLISH_HTTPS_KEYWORD)
 
 OPTIONAL_CONFIG_KEYS = (HTTP_PUBLISH_DIR_KEYWORD, HTTPS_PUBLISH_DIR_KEYWORD,
-                        PUBLISH_DEFAULT_RELEASE_KEYWORD,
+                        PUBLISH_DEFAULT_RELEASE_KEYWORD, PUBLISH_PROCESSES_KEYWORD,
+                        PUBLISH_SEPARATE_ARCH_ALL_KEYWORD, PUBLISH_COMPRESSION_KEYWORD,
+                        PUBLISH_COMPRESSION_LEVELS_KEYWORD,
+                        PUBLISH_COMPRESSION_THREADS_KEYWORD,
+                        PUBLISH_BY_HASH_KEYWORD, PUBLISH_BY_HASH_GENERATIONS_KEYWORD,
                         GPG_CMD, GPG_KEY_ID)
 
 LOCAL_CONFIG_KEYS = [GPG_CMD]
 
 ROOT_PUBLISH_DIR = '/var/lib/pulp/published/deb'
 MASTER_PUBLISH_DIR = os.path.join(ROOT_PUBLISH_DIR, 'master')
+POOL_PUBLISH_DIR = os.path.join(ROOT_PUBLISH_DIR, 'pool')
 HTTP_PUBLISH_DIR = os.path.join(ROOT_PUBLISH_DIR, 'http', 'repos')
 HTTPS_PUBLISH_DIR = os.path.join(ROOT_PUBLISH_DIR, 'https', 'repos')
 
@@ -92,6 +103,13 @@ def validate_config(repo, config, config_conduit):
         HTTP_PUBLISH_DIR_KEYWORD: _validate_http_publish_dir,
         HTTPS_PUBLISH_DIR_KEYWORD: _validate_https_publish_dir,
         PUBLISH_DEFAULT_RELEASE_KEYWORD: _validate_publish_default_release,
+        PUBLISH_PROCESSES_KEYWORD: _validate_publish_processes,
+        PUBLISH_SEPARATE_ARCH_ALL_KEYWORD: _validate_publish_separate_arch_all,
+        PUBLISH_COMPRESSION_KEYWORD: _validate_publish_compression,
+        PUBLISH_COMPRESSION_LEVELS_KEYWORD: _validate_publish_compression_levels,
+        PUBLISH_COMPRESSION_THREADS_KEYWORD: _validate_publish_compression_threads,
+        PUBLISH_BY_HASH_KEYWORD: _validate_publish_by_hash,
+        PUBLISH_BY_HASH_GENERATIONS_KEYWORD: _validate_publish_by_hash_generations,
     }
 
     # iterate through the options that have validation methods, validate them
@@ -138,6 +156,31 @@ def get_master_publish_dir(repo, distributor_type):
     return os.path.join(MASTER_PUBLISH_DIR, distributor_type, repo.id)
 
 
+def get_pool_publish_dir(repo, distributor_type, distributor_id=None):
+    """
+    Get the directory of the pool kept across publishes of the given
+    repository by a distributor. Published trees link to it rather than
+    holding a copy. Each distributor has its own pool, as the packages it
+    publishes depend on its configuration and on when it last published.
+
+    :param repo: repository to get the pool directory for
+    :type  repo: pulp.plugins.model.Repository
+    :param distributor_type: The type id of distributor that is being published
+    :type distributor_type: str
+    :param distributor_id: id of the distributor, or None for the directory
+                           holding the pools of all the distributors of
+                           distributor_type
+    :type distributor_id: str
+    :return: pool directory for the given repository
+    :rtype:  str
+    """
+
+    ret = os.path.join(POOL_PUBLISH_DIR, distributor_type, repo.id)
+    if distributor_id is not None:
+        ret = os.path.join(ret, distributor_id)
+    return ret
+
+
 def get_http_publish_dir(config=None):
     """
     Get the configured HTTP publication directory.
@@ -201,6 +244,57 @@ def get_repo_relative_path(repo, config=None):
     return relative_path.lstrip('/')
 
 
+def get_publish_processes(config=None):
+    """
+    Get the number of processes to generate indexes with.
+    Defaults to the number of CPUs.
+
+    :param config: configuration instance
+    :type  config: pulp.plugins.config.PluginCallConfiguration or dict or None
+    :return: number of processes
+    :rtype:  int
+    """
+    cfg = config or {}
+    return cfg.get(PUBLISH_PROCESSES_KEYWORD) or multiprocessing.cpu_count()
+
+
+def get_index_compression(config=None):
+    """
+    Get the compression settings of the Packages indexes.
+    Defaults to the formats of compression.DEFAULT_FORMATS available here,
+    at their default levels, with one thread.
+
+    :param config: configuration instance
+    :type  config: pulp.plugins.config.PluginCallConfiguration or dict or None
+    :return: compression settings
+    :rtype:  pulp_deb.plugins.distributors.compression.IndexCompression
+    """
+    cfg = config or {}
+    formats = cfg.get(PUBLISH_COMPRESSION_KEYWORD)
+    return compression.IndexCompression.create(
+        formats, cfg.get(PUBLISH_COMPRESSION_LEVELS_KEYWORD),
+        cfg.get(PUBLISH_COMPRESSION_THREADS_KEYWORD) or 1)
+
+
+def get_by_hash_generations(config=None):
+    """
+    Get the number of previous generations of the indexes kept in their
+    by-hash directories, or None if indexes are not published by hash.
+
+    :param config: configuration instance
+    :type  config: pulp.plugins.config.PluginCallConfiguration or dict or None
+    :return: number of previous generations, or None
+    :rtype:  int or None
+    """
+    cfg = config or {}
+    if not cfg.get(PUBLISH_BY_HASH_KEYWORD, True):
+        return None
+    generations = cfg.get(PUBLISH_BY_HASH_GENERATIONS_KEYWORD)
+    if generations is None:
+        return PUBLISH_BY_HASH_GENERATIONS_DEFAULT
+    return generations
+
+
 def get_gpg_sign_options(repo=None, config=None):
     cfg = config or {}
     cmd = cfg.get(GPG_CMD)
@@ -239,6 +333,69 @@ def _validate_relative_url(relative_url, error_messages):
 
 # -- optional config validation -----------------------------------------------
 
+def _validate_publish_processes(publish_processes, error_messages):
+    _validate_positive_int(PUBLISH_PROCESSES_KEYWORD, publish_processes, error_messages)
+
+
+def _validate_publish_separate_arch_all(publish_separate_arch_all, error_messages):
+    _validate_boolean(PUBLISH_SEPARATE_ARCH_ALL_KEYWORD, publish_separate_arch_all,
+                      error_messages)
+
+
+def _validate_publish_compression(publish_compression, error_messages):
+    if publish_compression is None:
+        return
+    if not isinstance(publish_compression, (list, tuple)):
+        msg = _('Configuration value for [%(k)s] should be a list, but is a %(t)s')
+        error_messages.append(msg % {'k': PUBLISH_COMPRESSION_KEYWORD,
+                                     't': str(type(publish_compression))})
+        return
+    for fmt in publish_compression:
+        if fmt not in compression.FORMATS:
+            msg = _('Configuration value for [%(k)s] contains the unknown format %(v)r')
+            error_messages.append(msg % {'k': PUBLISH_COMPRESSION_KEYWORD, 'v': fmt})
+        elif not compression.available(fmt):
+            msg = _('Configuration value for [%(k)s] contains the format %(v)r, which '
+                    'this server can not compress')
+            error_messages.append(msg % {'k': PUBLISH_COMPRESSION_KEYWORD, 'v': fmt})
+
+
+def _validate_publish_compression_levels(publish_compression_levels, error_messages):
+    if publish_compression_levels is None:
+        return
+    if not isinstance(publish_compression_levels, dict):
+        msg = _('Configuration value for [%(k)s] should be a dictionary, but is a %(t)s')
+        error_messages.append(msg % {'k': PUBLISH_COMPRESSION_LEVELS_KEYWORD,
+                                     't': str(type(publish_compression_levels))})
+        return
+    for fmt, level in sorted(publish_compression_levels.items()):
+        if fmt not in compression.LEVELS:
+            msg = _('Configuration value for [%(k)s] contains the unknown format %(v)r')
+            error_messages.append(msg % {'k': PUBLISH_COMPRESSION_LEVELS_KEYWORD, 'v': fmt})
+            continue
+        _default, lowest, highest = compression.LEVELS[fmt]
+        valid = isinstance(level, int) and not isinstance(level, bool)
+        if not valid or not lowest <= level <= highest:
+            msg = _('Configuration value for [%(k)s] should set %(f)s to a level from '
+                    '%(l)d to %(h)d, but sets it to %(v)r')
+            error_messages.append(msg % {'k': PUBLISH_COMPRESSION_LEVELS_KEYWORD, 'f': fmt,
+                                         'l': lowest, 'h': highest, 'v': level})
+
+
+def _validate_publish_compression_threads(publish_compression_threads, error_messages):
+    _validate_positive_int(PUBLISH_COMPRESSION_THREADS_KEYWORD, publish_compression_threads,
+                           error_messages)
+
+
+def _validate_publish_by_hash(publish_by_hash, error_messages):
+    _validate_boolean(PUBLISH_BY_HASH_KEYWORD, publish_by_hash, error_messages)
+
+
+def _validate_publish_by_hash_generations(publish_by_hash_generations, error_messages):
+    _validate_non_negative_int(PUBLISH_BY_HASH_GENERATIONS_KEYWORD,
+                               publish_by_hash_generations, error_messages)
+
+
 def _validate_http_publish_dir(http_publish_dir, error_messages):
     _validate_usable_directory(HTTP_PUBLISH_DIR_KEYWORD, http_publish_dir,
                                error_messages)
@@ -260,6 +417,26 @@ def _validate_boolean(key, value, error_messages, none_ok=True):
     error_messages.append(msg % {'k': key, 't': str(type(value))})
 
 
+def _validate_positive_int(key, value, error_messages, none_ok=True):
+    if none_ok and value is None:
+        return
+    if isinstance(value, int) and not isinstance(value, bool) and value > 0:
+        return
+
+    msg = _('Configuration value for [%(k)s] should be a positive integer, but is %(v)r')
+    error_messages.append(msg % {'k': key, 'v': value})
+
+
+def _validate_non_negative_int(key, value, error_messages, none_ok=True):
+    if none_ok and value is None:
+        return
+    if isinstance(value, int) and not isinstance(value, bool) and value >= 0:
+        return
+
+    msg = _('Configuration value for [%(k)s] should be a non-negative integer, but is %(v)r')
+    error_messages.append(msg % {'k': key, 'v': value})
+
+
 def _validate_usable_directory(key, path, error_messages):
     if not os.path.exists(path) or not os.path.isdir(path):
         msg = _('Configuration value for [%(k)s] must be an existing directory')  # noqa
@@ -1,10 +1,16 @@
 from gettext import gettext as _
+import array
 import errno
+import hashlib
+import itertools
 import logging
+import multiprocessing
 import os
 import shutil
+import tempfile
+import uuid
 
-from collections import defaultdict
+from collections import defaultdict, namedtuple
 
 from pulp.common.config import read_json_config
 from pulp.plugins.util.publish_step import AtomicDirectoryPublishStep
@@ -14,13 +20,32 @@ from pulp.plugins.distributor import Distributor
 from pulp_deb.common import ids, constants
 from pulp_deb.plugins.db import models
 from . import configuration, yum_plugin_util
-from debpkgr import aptrepo
+from debpkgr import aptrepo, debpkg
+from pulp_deb.plugins.distributors import compression
+
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
 
 _logger = logging.getLogger(__name__)
 
 
 CONF_FILE_PATH = 'server/plugins.conf.d/%s.json' % ids.TYPE_ID_DISTRIBUTOR
 
+# Distributor scratchpad key of the fingerprints and checksums of the
+# indexes of the last publish
+SCRATCHPAD_INDEXES = 'indexes'
+# Part of every index fingerprint. Change it when the Packages files
+# generated for the same packages change, so no index is reused.
+INDEX_FORMAT = '4'
+# Directory of an index directory the index files are published in by
+# SHA256 digest
+BY_HASH_DIR = os.path.join('by-hash', 'SHA256')
+# Digests of the package files in Packages stanzas, by hashlib name
+STANZA_DIGESTS = (('md5', 'MD5sum'), ('sha1', 'SHA1'), ('sha256', 'SHA256'),
+                  ('sha512', 'SHA512'))
+
 
 def entry_point():
     """
@@ -113,6 +138,10 @@ class DebDistributor(Distributor):
         repo_dir = configuration.get_master_publish_dir(
             repo, ids.TYPE_ID_DISTRIBUTOR)
         shutil.rmtree(repo_dir, ignore_errors=True)
+        # Like the master directory, the pools are only known by repository
+        pool_dir = configuration.get_pool_publish_dir(
+            repo, ids.TYPE_ID_DISTRIBUTOR)
+        shutil.rmtree(pool_dir, ignore_errors=True)
         # remove the symlinks that might have been created for this
         # repo/distributor
         rel_path = configuration.get_repo_relative_path(repo, config)
@@ -178,7 +207,9 @@ class Publisher(PluginStep):
                                         config=config,
                                         plugin_type=plugin_type)
         self.description = self.__class__.description
-        self.add_child(ModulePublisher(conduit=conduit,
+        pool = Pool(configuration.get_pool_publish_dir(repo, plugin_type,
+                                                       conduit.distributor_id))
+        self.add_child(ModulePublisher(pool, conduit=conduit,
                                        config=config, repo=repo))
         repo_relative_path = configuration.get_repo_relative_path(repo, config)
         master_publish_dir = configuration.get_master_publish_dir(
@@ -205,6 +236,7 @@ class Publisher(PluginStep):
             master_publish_dir)
         atomic_publish_step.description = _("Publishing files to web")
         self.add_child(atomic_publish_step)
+        self.add_child(PrunePoolStep(pool))
         for step in listing_steps:
             self.add_child(step)
 
@@ -212,7 +244,7 @@ class Publisher(PluginStep):
 class ModulePublisher(PluginStep):
     description = _("Publishing modules")
 
-    def __init__(self, **kwargs):
+    def __init__(self, pool, **kwargs):
         kwargs.setdefault('step_type', constants.PUBLISH_MODULES_STEP)
         super(ModulePublisher, self).__init__(**kwargs)
         self.description = self.__class__.description
@@ -226,7 +258,7 @@ class ModulePublisher(PluginStep):
         self.publish_units = PublishDebStep()
         self.add_child(self.publish_units)
 
-        self.add_child(MetadataStep())
+        self.add_child(MetadataStep(pool))
 
         if self.non_halting_exceptions is None:
             self.non_halting_exceptions = []
@@ -262,30 +294,117 @@ class PublishDebComponentStep(UnitModelPluginStep):
 
 
 class PublishDebStep(UnitModelPluginStep):
+    """
+    Read the packages of the repository from a cursor, loading only the
+    fields publishing needs. What index generation needs of each package is
+    written to a PackageFileStore as it is read; unit_dict only keeps the
+    PublishedPackage of each, which MetadataStep needs for the whole
+    publish to group packages by component and to link them into the pool.
+    """
     ID_PUBLISH_STEP = constants.PUBLISH_DEB_STEP
     Model = models.DebPackage
+    FIELDS = ('id', 'architecture', 'filename', '_storage_path', 'control', 'size',
+              'checksums')
 
     def __init__(self, **kwargs):
         super(PublishDebStep, self).__init__(
             self.ID_PUBLISH_STEP, [self.Model], **kwargs)
         self.unit_dict = {}
+        self.package_files = None
+
+    def get_iterator(self):
+        querysets = models.repo_controller.get_unit_model_querysets(
+            self.get_repo().id, self.Model, None)
+        return (unit for queryset in querysets for unit in queryset.only(*self.FIELDS))
 
     def process_main(self, item=None):
-        self.unit_dict[item.id] = item
+        if self.package_files is None:
+            self.package_files = PackageFileStore(self.get_working_dir())
+        self.unit_dict[item.id] = PublishedPackage(
+            item.id, item.architecture, item.filename, item.storage_path,
+            self.package_files.add(PackageFile.from_unit(item)))
 
 
 class MetadataStep(PluginStep):
-    def __init__(self):
+    """
+    Write the Packages indexes and the Release file of every release.
+
+    Each (release, component, architecture) index is identified by a
+    fingerprint of the packages it lists, saved in the distributor's
+    scratchpad with the checksums of its files. An index whose fingerprint
+    did not change since the previous publish is linked from that publish
+    instead of being generated again from the package files. The indexes
+    that changed are generated by a pool of processes, one job per index,
+    after which the Release files are written and signed.
+
+    The stanzas of the architecture "all" packages of a component are
+    rendered once, and the same block is appended to the index of every
+    architecture, unless they are only published in the binary-all index.
+
+    Index files are also published under by-hash/SHA256/<digest>, along with
+    the files of the previous generations of each index, which clients
+    reading an older Release file may still fetch. The digests of those
+    generations are saved with the index in the scratchpad.
+
+    The published tree only holds a link to the Pool of the repository,
+    which is kept across publishes: only the packages added to a component
+    are linked into it here, and the links of the removed ones are left for
+    PrunePoolStep to remove once the new tree is published.
+
+    Jobs list packages by their offset in the PackageFileStore of
+    PublishDebStep, as arrays of integers, and stanzas rendered beforehand
+    are passed as files, so memory use does not grow with the size of the
+    indexes. Memory still grows with the number of packages: the
+    PublishedPackage of each (a few hundred bytes), one entry per component
+    listing it in the pool entries, and one 8-byte offset per index listing
+    it. Pool.update also loads the entries of the previous publish.
+    """
+    def __init__(self, pool):
         super(MetadataStep, self).__init__(constants.PUBLISH_REPODATA)
+        self.pool = pool
+        self._sign_options = None
+        self._previous_indexes = {}
+        self._previous_dir = None
+        self._indexes = []
+        self._releases = []
+        self._separate_arch_all = False
+        self._compression = None
+        self._by_hash_generations = None
+        # (pool path, fingerprint) -> the architecture "all" packages of a
+        # component, as package_stanzas takes them
+        self._arch_all_packages = {}
+        # component -> {file name: storage path} of its packages
+        self._pool_units = {}
 
     def process_main(self, item=None):
+        package_files = self.parent.publish_units.package_files
+        try:
+            if package_files is not None:
+                package_files.close()
+            self._publish(package_files)
+        finally:
+            if package_files is not None:
+                package_files.remove()
+
+    def _publish(self, package_files):
         unit_dict = self.parent.publish_units.unit_dict
         comp_units = self.parent.publish_components.units
         release_units = self.parent.publish_releases.units
 
-        sign_options = configuration.get_gpg_sign_options(self.get_repo(),
-                                                          self.get_config())
-        repo = self.get_repo()
+        self._sign_options = configuration.get_gpg_sign_options(self.get_repo(),
+                                                                self.get_config())
+        scratchpad = self.get_conduit().get_scratchpad() or {}
+        self._previous_indexes = dict(
+            (tuple(index['key']), index) for index in scratchpad.get(SCRATCHPAD_INDEXES) or [])
+        self._previous_dir = self._previous_publish_dir()
+        self._indexes = []
+        self._releases = []
+        self._separate_arch_all = bool(
+            self.get_config().get(constants.PUBLISH_SEPARATE_ARCH_ALL_KEYWORD, False))
+        self._arch_all_packages = {}
+        self._pool_units = {}
+        self._compression = configuration.get_index_compression(self.get_config())
+        self._by_hash_generations = configuration.get_by_hash_generations(self.get_config())
 
         for release_unit in release_units:
             codename = release_unit.codename
@@ -293,45 +412,23 @@ class MetadataStep(PluginStep):
                               if comp.release == codename]
             architectures = set(['all'])
 
+            comp_packages = models.DebComponentPackage.unit_ids_by_component(
+                [comp.id for comp in rel_components])
             comp_arch_units = {}
             for component_unit in rel_components:
                 # group units by architecture (all, amd64, armeb, ...)
                 arch_units = defaultdict(list)
-                for unit_id in component_unit.packages:
+                for unit_id in sorted(comp_packages[component_unit.id]):
                     unit = unit_dict.get(unit_id)
                     if unit:
                         arch_units[unit.architecture].append(unit)
-                # architecture 'all' is special; append it to all other architectures...
-                all_units = arch_units.pop('all', [])
-                for arch in arch_units:
-                    arch_units[arch].extend(all_units)
-                    architectures.add(arch)
-                # ...and make sure it is present as architecture as well
-                arch_units['all'] = all_units
+                # architecture 'all' is special; it is added to all other
+                # architectures when writing their indexes
+                architectures.update(arch_units)
                 comp_arch_units[component_unit.name] = arch_units
 
-            repometa = aptrepo.AptRepoMeta(
-                codename=codename,
-                components=[comp.name for comp in rel_components],
-                architectures=list(architectures),
-                description=repo.description,
-                label=repo.id,
-            )
-            # TODO Get the suite to work in debpkgr
-            # repometa.release.setdefault('Suite', suite)
-
-            arepo = aptrepo.AptRepo(self.get_working_dir(),
-                                    repo_name=repo.id,
-                                    metadata=repometa,
-                                    gpg_sign_options=sign_options)
-
-            for component in comp_arch_units:
-                for architecture, ca_units in comp_arch_units[component].iteritems():
-                    filenames = [_unit.storage_path for _unit in ca_units]
-                    arepo.create(filenames,
-                                 component=component,
-                                 architecture=architecture,
-                                 with_symlinks=True)
+            self._add_release(codename, [comp.name for comp in rel_components],
+                              architectures, comp_arch_units)
 
         # Prepare generic releases containing all packages in one component
         generic_release_names = []
@@ -353,32 +450,598 @@ class MetadataStep(PluginStep):
             arch_units = defaultdict(list)
             for unit in unit_dict.values():
                 arch_units[unit.architecture].append(unit)
-            # architecture 'all' is special; append it to all other architectures...
-            all_units = arch_units.pop('all', [])
-            for arch in arch_units:
-                arch_units[arch].extend(all_units)
-                architectures.add(arch)
-            # ...and make sure it is present as architecture as well
-            arch_units['all'] = all_units
+            architectures.update(arch_units)
 
             for codename, component_name in generic_release_names:
-                repo_meta = aptrepo.AptRepoMeta(
-                    codename=codename,
-                    components=[component_name],
-                    architectures=list(architectures),
-                    description=repo.description,
-                    label=repo.id,
-                )
-                arepo = aptrepo.AptRepo(self.get_working_dir(),
-                                        repo_name=self.get_repo().id,
-                                        metadata=repo_meta,
-                                        gpg_sign_options=sign_options)
-                for architecture, a_units in arch_units.iteritems():
-                    filenames = [unit.storage_path for unit in a_units]
-                    arepo.create(filenames,
-                                 component=component_name,
-                                 architecture=architecture,
-                                 with_symlinks=True)
+                self._add_release(codename, [component_name], architectures,
+                                  {component_name: arch_units})
+
+        self._link_pool()
+        self._write_indexes(package_files)
+        for repometa, indexes in self._releases:
+            self._write_release(repometa, indexes)
+
+        scratchpad = dict(scratchpad)
+        scratchpad[SCRATCHPAD_INDEXES] = self._indexes
+        self.get_conduit().set_scratchpad(scratchpad)
+
+    def _add_release(self, codename, components, architectures, comp_arch_units):
+        """
+        Add the packages of a release to the pool and plan its indexes
+        """
+        repo = self.get_repo()
+        working_dir = self.get_working_dir()
+        repometa = aptrepo.AptRepoMeta(
+            codename=codename,
+            components=components,
+            architectures=list(architectures),
+            description=repo.description,
+            label=repo.id,
+        )
+        # TODO Get the suite to work in debpkgr
+        # repometa.release.setdefault('Suite', suite)
+
+        # Clients skip the binary-all index when the indexes of the other
+        # architectures list its packages too
+        if not self._separate_arch_all:
+            repometa.release['No-Support-for-Architecture-all'] = 'Packages'
+        if self._by_hash_generations is not None:
+            repometa.release['Acquire-By-Hash'] = 'yes'
+
+        release_dir = repometa.release_dir(working_dir)
+        indexes = []
+        for component in repometa.components:
+            arch_units = comp_arch_units.get(component, {})
+            pool_units = self._pool_units.setdefault(component, {})
+            for units in arch_units.values():
+                for unit in units:
+                    pool_units[unit.filename] = unit.storage_path
+            for architecture in repometa.architectures:
+                units = []
+                all_units = arch_units.get('all', [])
+                if architecture != 'all':
+                    units = arch_units.get(architecture, [])
+                    if self._separate_arch_all:
+                        all_units = []
+                indexes.append(self._add_index(release_dir, codename, component,
+                                               architecture, units, all_units))
+        self._releases.append((repometa, indexes))
+
+    def _link_pool(self):
+        """
+        Link the packages of every component into the pool, and the pool
+        into the published tree
+        """
+        linked = self.pool.update(self._pool_units)
+        os.symlink(self.pool.path, os.path.join(self.get_working_dir(), 'pool'))
+        _logger.debug("Pool: %d packages linked, %d to remove", linked,
+                      sum(len(names) for names in self.pool.stale.values()))
+
+    def _add_index(self, release_dir, codename, component, architecture, units, all_units):
+        """
+        Link the Packages files of an index from the previous publish if it
+        has them for the same packages.
+
+        :param units: packages of the architecture of the index
+        :param all_units: architecture "all" packages listed after them
+
+        :returns dict: the index, with a job to generate its files if they
+                       could not be reused
+        """
+        pool_relative_path = os.path.join('pool', component)
+        key = (codename, component, architecture)
+        fingerprint = index_fingerprint(units + all_units, self._compression.fingerprint())
+        # A list, since release names may not be valid document keys
+        index = dict(key=list(key), fingerprint=fingerprint, checksums=None)
+        previous = self._previous_indexes.get(key)
+        if previous and previous.get('fingerprint') == fingerprint:
+            index['checksums'] = self._reuse_index(release_dir, previous.get('checksums'))
+        if index['checksums'] is None:
+            relative_path = os.path.join(component, 'binary-%s' % architecture, 'Packages')
+            all_key = None
+            if all_units:
+                all_key = (pool_relative_path, index_fingerprint(all_units))
+                if all_key not in self._arch_all_packages:
+                    self._arch_all_packages[all_key] = self._packages(
+                        pool_relative_path, all_units)
+            index['job'] = (release_dir, relative_path,
+                            self._packages(pool_relative_path, units), all_key)
+        else:
+            _logger.debug("Reusing unchanged index %s", '/'.join(key))
+        return index
+
+    @staticmethod
+    def _packages(pool_relative_path, units):
+        # Offsets only: the file names are read back with the PackageFiles
+        return (pool_relative_path, array.array('l', [unit.offset for unit in units]))
+
+    def _write_indexes(self, package_files):
+        """
+        Generate the files of all the indexes that could not be reused:
+        first the blocks of architecture "all" stanzas they need, then the
+        indexes themselves
+        """
+        indexes = [index for _repometa, release_indexes in self._releases
+                   for index in release_indexes if 'job' in index]
+        if not indexes:
+            return
+        packages_path = package_files.path if package_files is not None else None
+        processes = configuration.get_publish_processes(self.get_config())
+        all_keys = sorted(set(index['job'][-1] for index in indexes) - set([None]))
+        blocks = dict((key, package_files.new_path('all-%d' % i))
+                      for i, key in enumerate(all_keys))
+        map_jobs(render_stanzas, [(packages_path, self._arch_all_packages[key], blocks[key])
+                                  for key in all_keys], processes)
+        jobs = []
+        for index in indexes:
+            release_dir, relative_path, packages, all_key = index.pop('job')
+            jobs.append((packages_path, release_dir, relative_path, packages,
+                         blocks.get(all_key), self._compression))
+        results = map_jobs(write_index, jobs, processes)
+        for index, checksums in zip(indexes, results):
+            index['checksums'] = checksums
+
+    def _write_release(self, repometa, indexes):
+        repo = self.get_repo()
+        working_dir = self.get_working_dir()
+        arepo = aptrepo.AptRepo(working_dir,
+                                repo_name=repo.id,
+                                metadata=repometa,
+                                gpg_sign_options=self._sign_options)
+        release_dir = repometa.release_dir(working_dir)
+        all_checksums = dict()
+        for index in indexes:
+            for k, vlist in index['checksums'].items():
+                all_checksums.setdefault(k, []).extend(vlist)
+            if self._by_hash_generations is not None:
+                self._publish_by_hash(release_dir, index)
+            self._indexes.append(index)
+        repometa.release.update(all_checksums)
+        repometa.write_release(working_dir)
+        arepo.sign(repometa.release_path(working_dir))
+
+    def _reuse_index(self, release_dir, checksums):
+        """
+        Link the Packages files listed in checksums from the previous
+        publish, if they are still there and intact.
+
+        :returns dict: checksums, or None if the files can not be reused
+        """
+        if self._previous_dir is None or not checksums:
+            return None
+        previous_release_dir = os.path.join(
+            self._previous_dir, os.path.relpath(release_dir, self.get_working_dir()))
+        entries = checksums.get('SHA256') or []
+        for entry in entries:
+            path = os.path.join(previous_release_dir, entry['name'])
+            if not os.path.isfile(path) or os.path.getsize(path) != int(entry['size']):
+                return None
+            if _sha256_file(path) != entry['sha256']:
+                return None
+        for entry in entries:
+            _link_or_copy(os.path.join(previous_release_dir, entry['name']),
+                          os.path.join(release_dir, entry['name']))
+        return checksums
+
+    def _publish_by_hash(self, release_dir, index):
+        """
+        Link the files of an index into its by-hash directory, with the
+        files of its previous generations found in the previous publish
+        """
+        entries = index['checksums'].get('SHA256') or []
+        if not entries:
+            return
+        by_hash_dir = os.path.join(release_dir, os.path.dirname(entries[0]['name']), BY_HASH_DIR)
+        digests = sorted(set(entry['sha256'] for entry in entries))
+        for entry in entries:
+            _link_or_copy(os.path.join(release_dir, entry['name']),
+                          os.path.join(by_hash_dir, entry['sha256']))
+
+        previous = self._previous_indexes.get(tuple(index['key'])) or {}
+        generations = list(previous.get('by_hash') or [])
+        previous_digests = sorted(set(
+            entry['sha256'] for entry in (previous.get('checksums') or {}).get('SHA256') or []))
+        if previous_digests and previous_digests != digests:
+            generations.insert(0, previous_digests)
+        generations = generations[:self._by_hash_generations]
+        index['by_hash'] = generations
+        if self._previous_dir is None:
+            return
+        previous_by_hash_dir = os.path.join(
+            self._previous_dir, os.path.relpath(by_hash_dir, self.get_working_dir()))
+        for digest in set(digest for generation in generations for digest in generation):
+            source = os.path.join(previous_by_hash_dir, digest)
+            destination = os.path.join(by_hash_dir, digest)
+            if os.path.isfile(source) and not os.path.exists(destination):
+                _link_or_copy(source, destination)
+
+    def _previous_publish_dir(self):
+        """
+        Return the directory of the last publish of the repository, if any
+        """
+        master_dir = configuration.get_master_publish_dir(
+            self.get_repo(), ids.TYPE_ID_DISTRIBUTOR)
+        try:
+            names = os.listdir(master_dir)
+        except OSError:
+            return None
+        dirs = [os.path.join(master_dir, name) for name in names]
+        dirs = [path for path in dirs if os.path.isdir(path)]
+        if not dirs:
+            return None
+        return max(dirs, key=os.path.getmtime)
+
+
+class Pool(object):
+    """
+    Pool directory of a repository, kept across publishes instead of being
+    rebuilt in every published tree: <root>/pool/<component>/<file name>
+    links to the storage path of each package.
+
+    The entries of every component are saved in a manifest next to the
+    directory once a publish is complete, so that a publish only creates
+    the links of the packages added since the previous one, and only removes
+    those of the packages removed from it, without reading the directory.
+    Without a manifest, as after a failed publish, the directory is read.
+    """
+    MANIFEST = 'manifest'
+
+    def __init__(self, root):
+        self.root = root
+        self.path = os.path.join(root, 'pool')
+        self.manifest_path = os.path.join(root, self.MANIFEST)
+        # component -> {file name: storage path} of the publish
+        self.entries = None
+        # component -> file names of the packages no longer published
+        self.stale = {}
+
+    def update(self, entries):
+        """
+        Link the packages missing from the pool, or linked to another path.
+        The links of the other packages are left for prune().
+
+        :param entries: storage paths of the packages, by file name, by component
+        :type entries: dict
+        :returns int: number of links created
+        """
+        current = self._load()
+        # The pool no longer matches the manifest until prune() saves it
+        _remove(self.manifest_path)
+        if current is None:
+            current = self._scan()
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+        linked = 0
+        for component, comp_entries in entries.items():
+            comp_dir = os.path.join(self.path, component)
+            comp_current = current.get(component)
+            if comp_current is None:
+                comp_current = {}
+                if comp_entries and not os.path.isdir(comp_dir):
+                    os.makedirs(comp_dir)
+            for name, storage_path in comp_entries.items():
+                if comp_current.get(name) == storage_path:
+                    continue
+                path = os.path.join(comp_dir, name)
+                if name in comp_current:
+                    # Linked to another path: replace the link atomically
+                    tmp_path = _temp_path(path)
+                    os.symlink(storage_path, tmp_path)
+                    os.rename(tmp_path, path)
+                else:
+                    os.symlink(storage_path, path)
+                linked += 1
+        self.stale = {}
+        for component, comp_current in current.items():
+            comp_entries = entries.get(component) or {}
+            names = [name for name in comp_current if name not in comp_entries]
+            if names:
+                self.stale[component] = names
+        self.entries = entries
+        return linked
+
+    def prune(self):
+        """
+        Remove the links of the packages no longer published, and save the
+        manifest of the pool
+
+        :returns int: number of links removed
+        """
+        if self.entries is None:
+            return 0
+        removed = 0
+        for component, names in self.stale.items():
+            comp_dir = os.path.join(self.path, component)
+            for name in names:
+                _remove(os.path.join(comp_dir, name))
+                removed += 1
+            if not self.entries.get(component):
+                try:
+                    os.rmdir(comp_dir)
+                except OSError:
+                    pass
+        self.stale = {}
+        tmp_path = _temp_path(self.manifest_path)
+        with open(tmp_path, 'wb') as fobj:
+            pickle.dump(self.entries, fobj, pickle.HIGHEST_PROTOCOL)
+        os.rename(tmp_path, self.manifest_path)
+        return removed
+
+    def _load(self):
+        try:
+            with open(self.manifest_path, 'rb') as fobj:
+                return pickle.load(fobj)
+        except (IOError, EOFError, pickle.UnpicklingError):
+            return None
+
+    def _scan(self):
+        ret = {}
+        try:
+            components = os.listdir(self.path)
+        except OSError:
+            return ret
+        for component in components:
+            comp_dir = os.path.join(self.path, component)
+            ret[component] = dict((name, _readlink(os.path.join(comp_dir, name)))
+                                  for name in os.listdir(comp_dir))
+        return ret
+
+
+class PrunePoolStep(PluginStep):
+    description = _("Removing packages from the pool")
+
+    def __init__(self, pool, **kwargs):
+        super(PrunePoolStep, self).__init__(constants.PUBLISH_PRUNE_POOL_STEP, **kwargs)
+        self.description = self.__class__.description
+        self.pool = pool
+
+    def process_main(self, item=None):
+        removed = self.pool.prune()
+        _logger.debug("Pool: %d packages removed", removed)
+
+
+class PublishedPackage(namedtuple(
+        'PublishedPackage', ['id', 'architecture', 'filename', 'storage_path', 'offset'])):
+    """
+    What publishing keeps in memory of a DebPackage unit: enough to link it
+    into the pool and to plan the indexes listing it. Its PackageFile is at
+    offset in the PackageFileStore.
+    """
+    __slots__ = ()
+
+
+class PackageFileStore(object):
+    """
+    Scratch directory of a publish. The PackageFile of every package is
+    appended to a file as the package is read, and read back by offset by
+    the jobs generating the indexes listing it.
+    """
+    def __init__(self, parent_dir):
+        self.dir = tempfile.mkdtemp(prefix='.packages-', dir=parent_dir)
+        self.path = self.new_path('packages')
+        self._fobj = open(self.path, 'wb')
+
+    def new_path(self, name):
+        return os.path.join(self.dir, name)
+
+    def add(self, package_file):
+        """
+        :returns int: offset of package_file
+        """
+        offset = self._fobj.tell()
+        pickle.dump(tuple(package_file), self._fobj, pickle.HIGHEST_PROTOCOL)
+        return offset
+
+    def close(self):
+        self._fobj.close()
+
+    def remove(self):
+        self.close()
+        shutil.rmtree(self.dir, ignore_errors=True)
+
+
+class PackageFile(namedtuple(
+        'PackageFile', ['storage_path', 'control', 'size', 'checksums', 'filename'])):
+    """
+    What publishing needs of a DebPackage unit, sent to index generation
+    jobs instead of the unit
+    """
+    __slots__ = ()
+
+    @classmethod
+    def from_unit(cls, unit):
+        # Plain values only: jobs are pickled to the worker processes
+        return cls(unit.storage_path, unit.control, unit.size,
+                   dict(unit.checksums) if unit.checksums else None, unit.filename)
+
+
+def deb_package(package, relative_path):
+    """
+    Return the Packages stanza of a package published at relative_path
+    """
+    if package.control is not None:
+        return PackageStanza(package, relative_path)
+    # Stored before control paragraphs were: read the package
+    path = package.storage_path
+    pkg = debpkg.DebPkg.from_file(path, Size=str(os.stat(path).st_size))
+    pkg.relative_path = relative_path
+    return pkg
+
+
+class StanzaBlock(object):
+    """
+    File of stanzas rendered beforehand, written to an index as one
+    """
+    def __init__(self, path):
+        self.path = path
+
+    def dump(self, fd):
+        with open(self.path, 'rb') as fobj:
+            shutil.copyfileobj(fobj, fd, compression.CHUNK_SIZE)
+
+
+def package_stanzas(packages_path, packages):
+    """
+    Yield the Packages stanzas of packages, reading their PackageFile from
+    the file of a PackageFileStore one at a time
+
+    :param packages_path: path of the file of the PackageFileStore
+    :type packages_path: str
+    :param packages: relative path of the pool directory of the packages,
+                     and their offsets
+    :type packages: tuple
+    """
+    pool_relative_path, offsets = packages
+    if not offsets:
+        return
+    with open(packages_path, 'rb') as fobj:
+        for offset in offsets:
+            fobj.seek(offset)
+            package = PackageFile(*pickle.load(fobj))
+            yield deb_package(package, os.path.join(pool_relative_path, package.filename))
+
+
+def render_stanzas(job):
+    """
+    Render the Packages stanzas of packages into a file, the way an index
+    lists them. Runs in index generation worker processes.
+
+    :param job: path of the file of the PackageFileStore, packages as
+                package_stanzas takes them, and path of the file to write
+    :type job: tuple
+    """
+    packages_path, packages, block_path = job
+    with open(block_path, 'wb') as fobj:
+        for i, stanza in enumerate(package_stanzas(packages_path, packages)):
+            if i:
+                fobj.write(b"\n")
+            stanza.dump(fobj)
+
+
+def write_index(job):
+    """
+    Write the Packages files of an index. Runs in index generation worker
+    processes.
+
+    :param job: path of the file of the PackageFileStore, release
+                directory, relative path of the Packages file, packages as
+                package_stanzas takes them, file of stanzas rendered by
+                render_stanzas to list after them or None, and compression
+                settings
+    :type job: tuple
+
+    :returns dict: checksums of the Packages files, for the Release file
+    """
+    packages_path, release_dir, relative_path, packages, block_path, index_compression = job
+    stanzas = package_stanzas(packages_path, packages)
+    if block_path:
+        stanzas = itertools.chain(stanzas, [StanzaBlock(block_path)])
+    return compression.write_index(release_dir, relative_path, stanzas, index_compression)
+
+
+def map_jobs(func, jobs, processes):
+    """
+    Return [func(job) for job in jobs], computed by up to processes worker
+    processes
+    """
+    processes = min(processes, len(jobs))
+    if processes <= 1:
+        return [func(job) for job in jobs]
+    pool = multiprocessing.Pool(processes)
+    try:
+        return pool.map(func, jobs, chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+
+
+class PackageStanza(object):
+    """
+    Packages stanza of a unit, made of its stored control paragraph and of
+    the fields describing the published file
+    """
+    def __init__(self, unit, relative_path):
+        self.unit = unit
+        self.relative_path = relative_path
+
+    def hashes(self):
+        """
+        Return the digests of the package file, as (field, digest) pairs
+        """
+        unit = self.unit
+        digests = unit.checksums or {}
+        if any(alg not in digests for alg, _field in STANZA_DIGESTS):
+            # Only units imported before their digests were stored, and not
+            # migrated since, are read here
+            _logger.debug("Computing the digests of %s", unit.storage_path)
+            with open(unit.storage_path, 'rb') as fobj:
+                digests = models.DebPackage._compute_checksums(fobj)
+        return [(field, digests[alg]) for alg, field in STANZA_DIGESTS]
+
+    def dump(self, fd):
+        unit = self.unit
+        size = unit.size
+        if size is None:
+            size = os.stat(unit.storage_path).st_size
+        lines = [unit.control.rstrip('\n'),
+                 'Filename: %s' % self.relative_path,
+                 'Size: %d' % size]
+        lines.extend('%s: %s' % field for field in self.hashes())
+        fd.write(('\n'.join(lines) + '\n').encode('utf-8'))
+
+
+def index_fingerprint(units, options=''):
+    """
+    Return a fingerprint of the packages listed in an index, and of the
+    options it is written with
+    """
+    ret = hashlib.sha256(INDEX_FORMAT.encode('ascii'))
+    ret.update(options.encode('utf-8'))
+    ret.update(b'\n')
+    for unit_id in sorted(unit.id for unit in units):
+        ret.update(unit_id.encode('utf-8'))
+        ret.update(b'\n')
+    return ret.hexdigest()
+
+
+def _readlink(path):
+    try:
+        return os.readlink(path)
+    except OSError:
+        return None
+
+
+def _temp_path(path):
+    """
+    Return a new hidden path next to path, to be renamed over it
+    """
+    return os.path.join(os.path.dirname(path), '.%s.%s' % (os.path.basename(path),
+                                                           uuid.uuid4().hex))
+
+
+def _remove(path):
+    try:
+        os.unlink(path)
+    except OSError as error:
+        if error.errno != errno.ENOENT:
+            raise
+
+
+def _link_or_copy(source, destination):
+    if not os.path.isdir(os.path.dirname(destination)):
+        os.makedirs(os.path.dirname(destination))
+    try:
+        os.link(source, destination)
+    except OSError:
+        shutil.copy2(source, destination)
+
+
+def _sha256_file(path):
+    ret = hashlib.sha256()
+    with open(path, 'rb') as fobj:
+        for chunk in iter(lambda: fobj.read(1024 * 1024), b''):
+            ret.update(chunk)
+    return ret.hexdigest()
 
 
 class GenerateListingFileStep(PluginStep):
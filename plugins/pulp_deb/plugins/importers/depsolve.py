@@ -0,0 +1,183 @@
+"""
+Dependency resolution for recursive copies.
+
+Computes the closure of a set of DebPackage units under their Pre-Depends and
+Depends relations, within the packages of one repository. Candidates are
+looked up by name and by provided name among the unit ids of the repository,
+one query per round of new dependencies and chunk of unit ids. The
+dependencies of Architecture: all packages are resolved for every
+architecture of the repository.
+"""
+import logging
+
+from pulp.server.db import model as platform_models
+
+from pulp_deb.common import ids, version
+from pulp_deb.plugins.db import bulk, models
+
+_logger = logging.getLogger(__name__)
+
+RELATION_FIELDS = ('pre_depends', 'depends')
+
+# Unit ids per query, keeping the queries well below the document size limit
+UNIT_ID_CHUNK_SIZE = 50000
+
+# Fields the resolver needs from candidate packages
+_CANDIDATE_FIELDS = tuple(ids.UNIT_KEY_DEB) + ('id', 'provides', 'version_sort_key')
+_CANDIDATE_FIELDS += RELATION_FIELDS
+
+_VERSION_FLAGS = {
+    'EQ': lambda cmp: cmp == 0,
+    'GE': lambda cmp: cmp >= 0,
+    'GT': lambda cmp: cmp > 0,
+    'LE': lambda cmp: cmp <= 0,
+    'LT': lambda cmp: cmp < 0,
+}
+
+
+def relations(unit, fields=RELATION_FIELDS):
+    """
+    Yield the relations of unit as lists of alternatives
+    """
+    for field in fields:
+        value = getattr(unit, field, None)
+        if not value:
+            continue
+        if isinstance(value, models.STRING_TYPES):
+            value = models.DependencyParser.parse_field(value)
+        for rel in value:
+            yield rel if isinstance(rel, (list, tuple)) else [rel]
+
+
+def version_matches(relation, candidate_version):
+    """
+    Whether candidate_version (None for a package providing the name without
+    a version) satisfies the version constraint of relation
+    """
+    flag = relation.get('flag')
+    if flag is None:
+        return True
+    if candidate_version is None:
+        return False
+    return _VERSION_FLAGS[flag](version.compare(candidate_version, relation['version']))
+
+
+def _version_key(unit):
+    return unit.version_sort_key or version.sort_key(unit.version)
+
+
+def arch_matches(architecture, candidate):
+    return candidate.architecture in ('all', architecture)
+
+
+class DependencyResolver(object):
+    def __init__(self, repo_id):
+        """
+        :param repo_id: id of the repository to resolve dependencies in
+        :type repo_id: str
+        """
+        self.repo_id = repo_id
+        self.unresolved = []
+        self._unit_ids = None
+        self._architectures = None
+        # name -> [(unit, provided version)]
+        self._candidates = {}
+
+    @property
+    def unit_ids(self):
+        if self._unit_ids is None:
+            self._unit_ids = set(platform_models.RepositoryContentUnit.objects.filter(
+                repo_id=self.repo_id, unit_type_id=ids.TYPE_ID_DEB).scalar('unit_id'))
+        return self._unit_ids
+
+    @property
+    def architectures(self):
+        """
+        Architectures of the packages of the repository, besides all
+        """
+        if self._architectures is None:
+            architectures = set()
+            for chunk in self._unit_id_chunks():
+                architectures.update(models.DebPackage.objects.filter(
+                    id__in=chunk).distinct('architecture'))
+            architectures.discard('all')
+            self._architectures = sorted(architectures) or ['all']
+        return self._architectures
+
+    def resolve(self, units):
+        """
+        Return units and all the packages they depend on, directly or not.
+        Of the packages satisfying a relation, packages already in the
+        result are preferred, then the first alternative, then the highest
+        version. The relations of Architecture: all packages are resolved
+        once for every architecture of the repository. Relations that
+        cannot be satisfied are collected in self.unresolved.
+
+        :param units: packages to start from
+        :type units: list of pulp_deb.plugins.db.models.DebPackage
+
+        :returns list: the packages in the closure
+        """
+        selected = dict((unit.id, unit) for unit in units)
+        pending = list(selected.values())
+        while pending:
+            rels = [(unit, rel) for unit in pending for rel in relations(unit)]
+            self._lookup(set(alt['name'] for _unit, rel in rels for alt in rel))
+            pending = []
+            for unit, rel in rels:
+                resolved = True
+                for architecture in self._target_architectures(unit):
+                    matches = [self._matches(architecture, alt) for alt in rel]
+                    if any(c.id in selected for alt_matches in matches for c in alt_matches):
+                        continue
+                    for alt_matches in matches:
+                        if alt_matches:
+                            best = max(alt_matches, key=_version_key)
+                            selected[best.id] = best
+                            pending.append(best)
+                            break
+                    else:
+                        resolved = False
+                if not resolved:
+                    self.unresolved.append((unit, rel))
+        for unit, rel in self.unresolved:
+            _logger.warning("Unresolved dependency of %s %s: %s", unit.name, unit.version,
+                            ' | '.join(alt['name'] for alt in rel))
+        return list(selected.values())
+
+    def _target_architectures(self, unit):
+        if unit.architecture == 'all':
+            return self.architectures
+        return [unit.architecture]
+
+    def _matches(self, architecture, relation):
+        return [candidate
+                for candidate, provided in self._candidates.get(relation['name'], [])
+                if arch_matches(architecture, candidate) and version_matches(relation, provided)]
+
+    def _unit_id_chunks(self):
+        return bulk.chunks(self.unit_ids, UNIT_ID_CHUNK_SIZE)
+
+    def _find(self, **query):
+        """
+        Yield the packages of the repository matching query
+        """
+        for chunk in self._unit_id_chunks():
+            for unit in models.DebPackage.objects.filter(
+                    id__in=chunk, **query).only(*_CANDIDATE_FIELDS):
+                yield unit
+
+    def _lookup(self, names):
+        names = [name for name in names if name not in self._candidates]
+        if not names:
+            return
+        for name in names:
+            self._candidates[name] = []
+        for unit in self._find(name__in=names):
+            self._candidates[unit.name].append((unit, unit.version))
+        wanted = set(names)
+        for unit in self._find(provides__name__in=names):
+            for rel in relations(unit, ['provides']):
+                provided = rel[0]
+                if provided['name'] in wanted:
+                    self._candidates[provided['name']].append((unit, provided.get('version')))
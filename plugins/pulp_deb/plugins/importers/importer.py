@@ -1,13 +1,23 @@
 import logging
+import multiprocessing
+import os
+import shutil
+import tarfile
+import tempfile
 from pulp.common import config as config_utils
 from pulp.plugins.loader import api as plugin_api
 from pulp.plugins.importer import Importer
 from pulp.plugins.util import importer_config
+from pulp.server.controllers import units as units_controller
 from pulp.server.db import model as platform_models
 from gettext import gettext as _
+from pulp_deb.common import constants
 from pulp_deb.common.ids import SUPPORTED_TYPES, TYPE_ID_IMPORTER
-from pulp_deb.plugins.db import models
-from pulp_deb.plugins.importers import sync
+from pulp_deb.plugins import storage
+# Loading the importer registers the scrubber tasks with the workers
+from pulp_deb.plugins import scrubber  # noqa
+from pulp_deb.plugins.db import bulk, models
+from pulp_deb.plugins.importers import depsolve, sync
 
 _LOG = logging.getLogger(__name__)
 # The leading '/etc/pulp/' will be added by the read_json_config method.
@@ -36,7 +46,6 @@ class DebImporter(Importer):
     def validate_config(self, repo, config):
         try:
             importer_config.validate_config(config)
-            return True, None
         except importer_config.InvalidConfig as e:
             # Concatenate all of the failure messages into a single message
             msg = _('Configuration errors:\n')
@@ -44,6 +53,39 @@ class DebImporter(Importer):
                 msg += failure_message + '\n'
             msg = msg.rstrip()  # remove the trailing \n
             return False, msg
+        import_method = config.get(constants.CONFIG_IMPORT_METHOD)
+        if import_method is not None and import_method not in constants.IMPORT_METHODS:
+            msg = _('Configuration errors:\n'
+                    'The configuration parameter <%(name)s> must be one of: %(values)s')
+            return False, msg % dict(name=constants.CONFIG_IMPORT_METHOD,
+                                     values=', '.join(constants.IMPORT_METHODS))
+        layout = config.get(constants.CONFIG_STORAGE_LAYOUT)
+        if layout is not None and layout not in constants.STORAGE_LAYOUTS:
+            msg = _('Configuration errors:\n'
+                    'The configuration parameter <%(name)s> must be one of: %(values)s')
+            return False, msg % dict(name=constants.CONFIG_STORAGE_LAYOUT,
+                                     values=', '.join(constants.STORAGE_LAYOUTS))
+        fanout = config.get(constants.CONFIG_STORAGE_FANOUT)
+        if fanout is not None:
+            try:
+                storage.ContentAddressedLayout(int(fanout))
+            except ValueError:
+                msg = _('Configuration errors:\n'
+                        'The configuration parameter <%(name)s> must be an integer '
+                        'between 1 and %(max)d')
+                return False, msg % dict(name=constants.CONFIG_STORAGE_FANOUT,
+                                         max=storage.ContentAddressedLayout.MAX_DEPTH)
+        processes = config.get(constants.CONFIG_PROCESSES)
+        if processes is not None:
+            try:
+                valid = int(processes) > 0
+            except (TypeError, ValueError):
+                valid = False
+            if not valid:
+                msg = _('Configuration errors:\n'
+                        'The configuration parameter <%(name)s> must be a positive integer')
+                return False, msg % dict(name=constants.CONFIG_PROCESSES)
+        return True, None
 
     def upload_unit(self, transfer_repo, type_id, unit_key, metadata,
                     file_path, conduit, config):
@@ -53,6 +95,9 @@ class DebImporter(Importer):
         model_class = plugin_api.get_unit_model_by_id(type_id)
         repo = transfer_repo.repo_obj
         conduit.repo = repo
+        if type_id == models.DebPackage.TYPE_ID and tarfile.is_tarfile(file_path):
+            # A tar archive of packages (a .deb is an ar archive)
+            return self.upload_archive(repo, file_path, config)
         metadata = metadata or {}
 
         unit_data = {}
@@ -64,33 +109,205 @@ class DebImporter(Importer):
         except models.Error as e:
             return self.fail_report(str(e))
 
-        unit = unit.save_and_associate(file_path, repo)
+        unit = unit.save_and_associate(file_path, repo,
+                                       storage_layout=storage.get_layout(config))
         return dict(success_flag=True, summary="",
                     details=dict(
                         unit=dict(unit_key=unit.unit_key,
                                   metadata=unit.all_properties)))
 
+    def upload_archive(self, repo, file_path, config):
+        """
+        Upload all the packages in the tar archive file_path.
+        """
+        work_dir = tempfile.mkdtemp(dir=os.path.dirname(file_path))
+        try:
+            paths = {}
+            with tarfile.open(file_path) as archive:
+                for member in archive:
+                    if not member.isfile():
+                        continue
+                    # Never trust the member path
+                    path = os.path.join(work_dir, '%d.deb' % len(paths))
+                    with open(path, 'wb') as fobj:
+                        shutil.copyfileobj(archive.extractfile(member), fobj)
+                    paths[path] = member.name
+            return self.upload_units(repo, sorted(paths), config, names=paths)
+        finally:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    def upload_units(self, repo, file_paths, config, names=None):
+        """
+        Upload many packages at once: the packages are read on a process
+        pool, and the new units inserted and all of them associated with
+        repo in bulk.
+
+        :param repo: repository to upload into
+        :type repo: pulp.server.db.model.Repository
+        :param file_paths: paths of the package files; they may get moved
+                           into the content storage
+        :type file_paths: list
+        :param config: importer configuration
+        :param names: names to report errors with, by path
+        :type names: dict
+
+        :returns dict: aggregated upload report
+        """
+        names = names or {}
+        errors = []
+        units = {}
+        pool = multiprocessing.Pool(sync.get_processes(config))
+        try:
+            results = pool.map(read_package, file_paths)
+        finally:
+            pool.close()
+            pool.join()
+        for path, (unit_md, error) in zip(file_paths, results):
+            if error is None:
+                try:
+                    unit = models.DebPackage.from_metadata(unit_md)
+                except models.Error as e:
+                    error = str(e)
+            if error is not None:
+                errors.append('%s: %s' % (names.get(path, path), error))
+                continue
+            units.setdefault(sync.unit_key_as_tuple(unit.unit_key), (path, unit))
+
+        existing = dict((sync.unit_key_as_tuple(unit.unit_key), unit)
+                        for unit in units_controller.find_units(
+                            [unit for path, unit in units.values()]))
+        new_units = []
+        storage_layout = storage.get_layout(config)
+        for key, (path, unit) in sorted(units.items()):
+            if key in existing:
+                continue
+            if storage_layout is not None:
+                unit._storage_path = storage_layout.path(unit.checksum)
+            else:
+                unit.set_storage_path(unit.filename)
+            new_units.append((path, unit))
+        stored = self._store_units(new_units) + list(existing.values())
+        bulk.associate_units(repo, stored)
+        _LOG.info("Uploaded %d packages (%d new) into %s, %d failed",
+                  len(stored), len(new_units), repo.repo_id, len(errors))
+
+        return dict(success_flag=not errors,
+                    summary=_("%(uploaded)d packages uploaded, %(failed)d failed") % dict(
+                        uploaded=len(stored), failed=len(errors)),
+                    details=dict(units=[unit.unit_key for unit in stored],
+                                 errors=errors))
+
+    @staticmethod
+    def _store_units(new_units):
+        """
+        Insert new units and move their files into the content storage.
+
+        The files are staged under temporary names next to their storage
+        paths, and only renamed into place for the units that got inserted.
+        Units uploaded concurrently keep the file they were stored with. On
+        failure, the files not in place yet are moved back and their units
+        deleted.
+
+        :param new_units: (path, unit) of the units to store
+        :type new_units: list
+
+        :returns list: the stored units
+        """
+        staged = []
+        try:
+            for path, unit in new_units:
+                staged_path = storage.temp_path(unit._storage_path)
+                storage.import_file(path, staged_path, [storage.IMPORT_MOVE])
+                staged.append(staged_path)
+            stored = bulk.insert_units(models.DebPackage, [unit for path, unit in new_units])
+        except Exception:
+            for (path, unit), staged_path in zip(new_units, staged):
+                _unstage(staged_path, path)
+            raise
+        placed = set()
+        try:
+            for (path, unit), stored_unit, staged_path in zip(new_units, stored, staged):
+                if stored_unit is unit:
+                    os.rename(staged_path, unit._storage_path)
+                    placed.add(unit.id)
+                else:
+                    _remove(staged_path)
+        except Exception:
+            failed = [unit.id for path, unit in new_units if unit.id not in placed]
+            models.DebPackage.objects.filter(id__in=failed).delete()
+            for (path, unit), staged_path in zip(new_units, staged):
+                if os.path.exists(staged_path):
+                    _unstage(staged_path, path)
+            raise
+        return stored
+
     def import_units(self, source_transfer_repo, dest_transfer_repo,
                      import_conduit, config, units=None):
+        """
+        Copy units, by default all the units of the source repository, into
+        the destination repository.
+
+        :return: iterator over the units copied, which associates them as it
+                 is read
+        """
         source_repo = platform_models.Repository.objects.get(
             repo_id=source_transfer_repo.id)
         dest_repo = platform_models.Repository.objects.get(
             repo_id=dest_transfer_repo.id)
 
+        # Units of the source repository are unique, those passed in may not be
+        unique = not units
         if not units:
             # If no units are passed in, assume we will use all units from
             # source repo
             units = models.repo_controller.find_repo_content_units(
                 source_repo, yield_content_unit=True)
 
-        units = sorted(set(units))
-        _LOG.info("Importing %s units from %s to %s" %
-                  (len(units), source_repo.id, dest_repo.id))
-        for u in units:
-            u.associate(dest_repo)
+        if config.get_boolean(constants.CONFIG_RECURSIVE):
+            units = self._with_dependencies(source_repo, units)
+            unique = False
+
+        _LOG.info("Importing units from %s to %s" % (source_repo.id, dest_repo.id))
+        return self._import_chunks(source_repo, dest_repo, units, unique)
+
+    @staticmethod
+    def _import_chunks(source_repo, dest_repo, units, unique):
+        """
+        Associate units with dest_repo one chunk at a time, yielding each
+        unit once its chunk is associated. The platform reads the units
+        copied once, so they are not kept: only the ids of units that may
+        be repeated are.
+        """
+        seen = None if unique else set()
+        count = 0
+        for chunk in bulk.chunks(units):
+            if seen is not None:
+                chunk = [u for u in chunk if (u.type_id, u.id) not in seen]
+                seen.update((u.type_id, u.id) for u in chunk)
+            # Releases and components are copies specific to each repository
+            bulk.associate_units(dest_repo, [
+                u if u.type_id == models.DebPackage.TYPE_ID else u.copy_to(dest_repo)
+                for u in chunk])
+            count += len(chunk)
+            for u in chunk:
+                yield u
         _LOG.debug("%s units from %s have been associated to %s" %
-                   (len(units), source_repo.id, dest_repo.id))
-        return units
+                   (count, source_repo.id, dest_repo.id))
+
+    @staticmethod
+    def _with_dependencies(source_repo, units):
+        """
+        Add the packages that the packages in units depend on
+        """
+        debs = []
+        others = []
+        for u in units:
+            (debs if u.type_id == models.DebPackage.TYPE_ID else others).append(u)
+        resolver = depsolve.DependencyResolver(source_repo.repo_id)
+        resolved = resolver.resolve(debs)
+        _LOG.info("Adding %s dependencies of %s packages from %s" %
+                  (len(resolved) - len(set(debs)), len(debs), source_repo.id))
+        return resolved + others
 
     @classmethod
     def fail_report(cls, message):
@@ -135,3 +352,36 @@ class DebImporter(Importer):
         report = self._current_sync.process_lifecycle()
         _LOG.info("Repo sync finished.")
         return report
+
+
+def read_package(path):
+    """
+    Read the unit metadata of the package at path, in a pool worker.
+
+    :returns tuple: metadata, or None and an error message
+    """
+    try:
+        return models.DebPackage.read_file(path), None
+    except models.Error as e:
+        return None, str(e)
+
+
+def _remove(path):
+    try:
+        os.unlink(path)
+    except OSError:
+        pass
+
+
+def _unstage(staged_path, path):
+    """
+    Move a staged file back to where it was uploaded, or drop it if it was
+    copied
+    """
+    if os.path.exists(path):
+        _remove(staged_path)
+        return
+    try:
+        os.rename(staged_path, path)
+    except OSError:
+        _remove(staged_path)
@@ -1,23 +1,41 @@
 import logging
+import multiprocessing
 import os
+import shutil
+import threading
+import time
 import urlparse
 import hashlib
 import gnupg
 from collections import defaultdict
 from gettext import gettext as _
 from distutils.version import LooseVersion
+from multiprocessing.pool import ThreadPool
 
 from debpkgr import aptrepo
+from nectar.downloaders.threaded import HTTPThreadedDownloader
+from nectar.listener import AggregatingEventListener
 from nectar.request import DownloadRequest
 from pulp.plugins.util import misc, publish_step
+from pulp.plugins.util import nectar_config as nectar_utils
 from pulp.common.error_codes import Error
+from pulp.server import util
+from pulp.server.config import config as pulp_config
+from pulp.server.controllers import units as units_controller
 from pulp.server.exceptions import PulpCodedTaskFailedException
 
 from pulp_deb.common import constants, ids
+from pulp_deb.plugins import storage
 from pulp_deb.plugins.db import models
 
 _logger = logging.getLogger(__name__)
 
+# Importer scratchpad key of the download throughput of the last sync, in
+# bytes per second
+SCRATCHPAD_THROUGHPUT = 'download_throughput'
+# Download throughput sync plans assume before any was measured
+DEFAULT_THROUGHPUT = 10 * 1024 * 1024
+
 
 DEBSYNC001 = Error(
     "DEBSYNC001",
@@ -32,6 +50,12 @@ DEBSYNC002 = Error(
     " actual %(checksum_actual)s",
     ["repo_id", "feed_url", "filename", "checksum_expected", "checksum_actual"])
 
+DEBSYNC003 = Error(
+    "DEBSYNC003",
+    "Unable to sync %(repo_id)s from %(feed_url)s: insufficient disk space"
+    " in %(path)s: %(required)s bytes required, %(available)s bytes available",
+    ["repo_id", "feed_url", "path", "required", "available"])
+
 
 class RepoSync(publish_step.PluginStep):
     Type_Class_Map = {
@@ -53,15 +77,29 @@ class RepoSync(publish_step.PluginStep):
                                        config=config)
         self.description = _('Syncing Repository')
 
-        self.feed_url = self.get_config().get('feed').strip('/')
-        self.releases = self.get_config().get('releases', 'stable').split(',')
+        self.feed_url = self.get_config().get('feed').rstrip('/')
+        # An apt mirror tree on local (or NFS) storage is read in place
+        self.local_tree = local_tree_path(self.feed_url)
+        releases = self.get_config().get('releases')
+        if releases is None and self.local_tree:
+            releases = ','.join(find_local_releases(self.local_tree)) or None
+        self.releases = (releases or 'stable').split(',')
         self.architectures = split_or_none(self.get_config().get('architectures'))
         self.components = split_or_none(self.get_config().get('components'))
         self.remove_missing = self.get_config().get_boolean(
             constants.CONFIG_REMOVE_MISSING_UNITS, constants.CONFIG_REMOVE_MISSING_UNITS_DEFAULT)
+        self.dry_run = self.get_config().get_boolean(
+            constants.CONFIG_DRY_RUN, constants.CONFIG_DRY_RUN_DEFAULT)
+        self.import_methods = get_import_methods(
+            self.get_config().get(constants.CONFIG_IMPORT_METHOD,
+                                  constants.CONFIG_IMPORT_METHOD_DEFAULT),
+            self.local_tree is not None)
+        self.storage_layout = storage.get_layout(self.get_config())
 
         self.unit_relative_urls = {}
         self.available_units = None
+        self.sync_plan = None
+        self.download_started = None
         # dicts with release names as keys to multiplex variables
         self.apt_repo_meta = {}
         self.release_units = {}
@@ -74,44 +112,44 @@ class RepoSync(publish_step.PluginStep):
         self.release_urls = {
             release: urlparse.urljoin(self.feed_urls[release] + '/', 'Release')
             for release in self.releases}
-        self.packages_urls = {}
         # double dicts with release/component as keys
         self.component_units = defaultdict(dict)
         self.component_packages = defaultdict(dict)
 
         for release in self.releases:
             misc.mkdir(os.path.dirname(self.release_files[release]))
-            _logger.info("Downloading %s", self.release_urls[release])
 
         # defining lifecycle
-        #  metadata
-        self.add_child(publish_step.DownloadStep(
-            constants.SYNC_STEP_RELEASE_DOWNLOAD,
-            plugin_type=ids.TYPE_ID_IMPORTER,
-            description=_('Retrieving metadata: release file(s)'),
-            downloads=[
-                DownloadRequest(self.release_urls[release], self.release_files[release])
-                for release in self.releases] + [
-                DownloadRequest(self.release_urls[release] + '.gpg',
-                                self.release_files[release] + '.gpg')
-                for release in self.releases]
-        ))
-
-        self.add_child(ParseReleaseStep(constants.SYNC_STEP_RELEASE_PARSE))
-
-        self.step_download_Packages = publish_step.DownloadStep(
-            constants.SYNC_STEP_PACKAGES_DOWNLOAD,
-            plugin_type=ids.TYPE_ID_IMPORTER,
-            description=_('Retrieving metadata: Packages files'))
-        self.add_child(self.step_download_Packages)
+        #  metadata, one pipeline per release
+        self.add_child(SyncReleasesStep(constants.SYNC_STEP_RELEASES))
 
-        self.add_child(ParsePackagesStep(constants.SYNC_STEP_PACKAGES_PARSE))
+        self.debs_to_check = []
+        self.deb_comps_to_check = []
+        self.deb_releases_to_check = []
+        if self.remove_missing:
+            units_to_check = self.conduit.get_units()
+            self.debs_to_check = [unit for unit in units_to_check
+                                  if unit.type_id == ids.TYPE_ID_DEB]
+            self.deb_comps_to_check = [unit for unit in units_to_check
+                                       if unit.type_id == ids.TYPE_ID_DEB_COMP]
+            self.deb_releases_to_check = [unit for unit in units_to_check
+                                          if unit.type_id == ids.TYPE_ID_DEB_RELEASE]
+            del units_to_check
 
         #  packages
+        if self.dry_run:
+            # A dry run stops after planning; nothing gets associated,
+            # downloaded or saved
+            self.step_local_units = None
+            self.add_child(PlanSyncStep(constants.SYNC_STEP_PLAN))
+            return
+
         self.step_local_units = publish_step.GetLocalUnitsStep(
             importer_type=ids.TYPE_ID_IMPORTER)
         self.add_child(self.step_local_units)
 
+        self.add_child(PlanSyncStep(constants.SYNC_STEP_PLAN))
+
         self.add_child(CreateRequestsUnitsToDownload(
             constants.SYNC_STEP_UNITS_DOWNLOAD_REQUESTS))
 
@@ -126,26 +164,29 @@ class RepoSync(publish_step.PluginStep):
         #  metadata
         self.add_child(SaveMetadataStep(constants.SYNC_STEP_SAVE_META))
 
-        self.debs_to_check = []
-        self.deb_comps_to_check = []
-        self.deb_releases_to_check = []
         # cleanup
         if self.remove_missing:
-            units_to_check = self.conduit.get_units()
-            self.debs_to_check = [unit for unit in units_to_check
-                                  if unit.type_id == ids.TYPE_ID_DEB]
-            self.deb_comps_to_check = [unit for unit in units_to_check
-                                       if unit.type_id == ids.TYPE_ID_DEB_COMP]
-            self.deb_releases_to_check = [unit for unit in units_to_check
-                                          if unit.type_id == ids.TYPE_ID_DEB_RELEASE]
-            del units_to_check
             self.add_child(OrphanRemovedUnits(constants.SYNC_STEP_ORPHAN_REMOVED_UNITS))
 
 
-class ParseReleaseStep(publish_step.PluginStep):
+class SyncReleasesStep(publish_step.PluginStep):
+    """
+    Run the metadata pipeline (download, verify, index fetch and parse) of
+    every release on a worker pool, so that a slow mirror path only holds up
+    its own release. The results are joined into the parent step once all
+    pipelines have finished.
+
+    The Release and Packages downloads of all pipelines are reported as the
+    progress of this step, and canceling the step cancels them.
+    """
     def __init__(self, *args, **kwargs):
-        super(ParseReleaseStep, self).__init__(*args, **kwargs)
-        self.description = _('Parse Release Files')
+        super(SyncReleasesStep, self).__init__(*args, **kwargs)
+        self.description = _('Retrieving and parsing metadata')
+        self.gpg = None
+        # Guards the progress counters and the running downloaders, which
+        # are shared by the pipelines
+        self._lock = threading.Lock()
+        self._downloaders = []
 
     def gnupg_factory(self, *args, **kwargs):
         if 'homedir' in kwargs.keys():
@@ -155,14 +196,11 @@ class ParseReleaseStep(publish_step.PluginStep):
                 del(kwargs['homedir'])
         return gnupg.GPG(*args, **kwargs)
 
-    def verify_release(self, release):
-        rel_file = self.parent.release_files[release]
-        # check if Release file exists
-        if not os.path.isfile(rel_file):
-            raise Exception("Release file not found. Check the feed option.")
-        # check signature
-        if not self.get_config().get_boolean(constants.CONFIG_REQUIRE_SIGNATURE, False):
-            return
+    def prepare_keyring(self):
+        """
+        Import the keys used to verify Release files; this is done once,
+        before any pipeline starts.
+        """
         gpg = self.gnupg_factory(homedir=os.path.join(self.get_working_dir(), 'gpg-home'))
         shared_gpg = self.gnupg_factory(homedir=os.path.join('/', 'var', 'lib', 'pulp', 'gpg-home'))
 
@@ -188,6 +226,17 @@ class ParseReleaseStep(publish_step.PluginStep):
 
         if len(gpg.list_keys()) == 0:
             raise Exception("No GPG-keys in keyring, did the import fail?")
+        return gpg
+
+    def verify_release(self, release):
+        rel_file = self.parent.release_files[release]
+        # check if Release file exists
+        if not os.path.isfile(rel_file):
+            raise Exception("Release file not found. Check the feed option.")
+        # check signature
+        if self.gpg is None:
+            return
+        gpg = self.gpg
 
         if not os.path.isfile(rel_file + '.gpg'):
             raise Exception("Release.gpg not found. Could not verify release integrity.")
@@ -203,85 +252,288 @@ class ParseReleaseStep(publish_step.PluginStep):
                 if not verified.valid:
                     raise Exception("Verification of Release failed! {}".format(verified.stderr))
 
+    def download(self, requests):
+        """
+        Download the requests with a downloader private to the calling
+        pipeline. Files from a local tree are copied instead.
+
+        :returns list: the failed download reports
+        """
+        with self._lock:
+            self.total_units += len(requests)
+        if self.parent.local_tree:
+            failed = copy_local_files(requests)
+            self.download_done(len(requests) - len(failed), len(failed))
+            return failed
+        config = nectar_utils.importer_config_to_nectar_config(
+            self.get_config().flatten())
+        downloader = HTTPThreadedDownloader(config)
+        listener = ReleaseDownloadListener(self)
+        downloader.event_listener = listener
+        with self._lock:
+            if self.canceled:
+                return []
+            self._downloaders.append(downloader)
+        try:
+            downloader.download(requests)
+        finally:
+            with self._lock:
+                self._downloaders.remove(downloader)
+        if self.canceled:
+            # Downloads stopped by cancel() are not failures
+            return []
+        return listener.failed_reports
+
+    def download_done(self, successes, failures):
+        with self._lock:
+            self.progress_successes += successes
+            self.progress_failures += failures
+        self.report_progress()
+
+    def cancel(self):
+        super(SyncReleasesStep, self).cancel()
+        with self._lock:
+            downloaders = list(self._downloaders)
+        for downloader in downloaders:
+            downloader.cancel()
+
     def process_main(self, item=None):
-        releases = self.parent.releases
-        components = self.parent.components
-        architectures = self.parent.architectures
-        dl_reqs = []
-        for release in releases:
-            self.verify_release(release)
-            # generate repo_metas for Releases
-            self.parent.apt_repo_meta[release] = repometa = aptrepo.AptRepoMeta(
-                release=open(self.parent.release_files[release], "rb"),
-                upstream_url=self.parent.feed_urls[release])
-            # get release unit
-            codename = repometa.codename
-            suite = repometa.release.get('suite')
-            rel_unit = self.parent.release_units[release] = models.DebRelease.\
-                get_or_create_and_associate(self.parent.repo, codename, suite)
-            # Prevent this unit from being cleaned up
+        if self.get_config().get_boolean(constants.CONFIG_REQUIRE_SIGNATURE, False):
+            self.gpg = self.prepare_keyring()
+        pipelines = [ReleasePipeline(self, release) for release in self.parent.releases]
+        num_workers = min(len(pipelines), int(self.get_config().get(
+            constants.CONFIG_NUM_THREADS, constants.CONFIG_NUM_THREADS_DEFAULT)))
+        pool = ThreadPool(max(num_workers, 1))
+        try:
+            # map() re-raises the first error of any pipeline
+            pool.map(ReleasePipeline.run, pipelines)
+        finally:
+            pool.close()
+            pool.join()
+        if self.canceled:
+            return
+        self.join(pipelines)
+
+    def join(self, pipelines):
+        units = {}
+        for pipeline in pipelines:
+            release = pipeline.release
+            self.parent.apt_repo_meta[release] = pipeline.repometa
+            self.parent.component_packages[release] = pipeline.component_packages
+            self.parent.unit_relative_urls.update(pipeline.unit_relative_urls)
+            for checksum, unit in pipeline.units.items():
+                units.setdefault(checksum, unit)
+            if pipeline.release_unit is None:
+                continue
+            self.parent.release_units[release] = pipeline.release_unit
+            self.parent.component_units[release] = pipeline.component_units
+            # Prevent these units from being cleaned up
             try:
-                self.parent.deb_releases_to_check.remove(rel_unit)
+                self.parent.deb_releases_to_check.remove(pipeline.release_unit)
             except ValueError:
                 pass
-            # get release component units
-            for component in repometa.components:
-                if components is None or component in components:
-                    comp_unit = self.parent.component_units[release][component] = \
-                        models.DebComponent.get_or_create_and_associate(self.parent.repo,
-                                                                        rel_unit,
-                                                                        component)
-                    self.parent.component_packages[release][component] = []
-                    # Prevent this unit from being cleaned up
-                    try:
-                        self.parent.deb_comps_to_check.remove(comp_unit)
-                    except ValueError:
-                        pass
-            # generate download requests for all relevant packages files
-            rel_dl_reqs = repometa.create_Packages_download_requests(
-                self.get_working_dir())
-            # Filter the rel_dl_reqs by selected components and architectures
-            if components:
-                rel_dl_reqs = [
-                    dlr for dlr in rel_dl_reqs
-                    if dlr.data['component'] in components]
-            if architectures:
-                rel_dl_reqs = [
-                    dlr for dlr in rel_dl_reqs
-                    if dlr.data['architecture'] in architectures]
-            self.parent.packages_urls[release] = set([dlr.url for dlr in rel_dl_reqs])
-            dl_reqs.extend(rel_dl_reqs)
-        self.parent.step_download_Packages._downloads = [
+            for comp_unit in pipeline.component_units.values():
+                try:
+                    self.parent.deb_comps_to_check.remove(comp_unit)
+                except ValueError:
+                    pass
+        self.parent.available_units = units.values()
+
+
+class ReleaseDownloadListener(AggregatingEventListener):
+    """
+    Collect the reports of the downloads of a pipeline, and count them in
+    the progress of the SyncReleasesStep.
+    """
+    def __init__(self, step):
+        super(ReleaseDownloadListener, self).__init__()
+        self.step = step
+
+    def download_succeeded(self, report):
+        super(ReleaseDownloadListener, self).download_succeeded(report)
+        self.step.download_done(1, 0)
+
+    def download_failed(self, report):
+        super(ReleaseDownloadListener, self).download_failed(report)
+        self.step.download_done(0, 1)
+
+
+class ReleasePipeline(object):
+    """
+    The metadata pipeline of a single release. Pipelines only share the
+    (read-only) configuration of the sync, their results are collected by
+    SyncReleasesStep.join().
+    """
+    def __init__(self, step, release):
+        self.step = step
+        self.release = release
+        self.repometa = None
+        self.release_unit = None
+        self.component_units = {}
+        self.component_packages = {}
+        self.unit_relative_urls = {}
+        self.units = {}
+
+    def run(self):
+        self.download_release()
+        if self.step.canceled:
+            return self
+        self.step.verify_release(self.release)
+        self.parse_release()
+        dl_reqs = self.download_packages()
+        if self.step.canceled:
+            return self
+        self.parse_packages(dl_reqs)
+        return self
+
+    def download_release(self):
+        sync = self.step.parent
+        release_url = sync.release_urls[self.release]
+        release_file = sync.release_files[self.release]
+        _logger.info("Downloading %s", release_url)
+        # A missing Release file is reported by verify_release()
+        self.step.download([
+            DownloadRequest(release_url, release_file),
+            DownloadRequest(release_url + '.gpg', release_file + '.gpg')])
+
+    def parse_release(self):
+        sync = self.step.parent
+        components = sync.components
+        # generate repo_metas for Releases
+        self.repometa = repometa = aptrepo.AptRepoMeta(
+            release=open(sync.release_files[self.release], "rb"),
+            upstream_url=sync.feed_urls[self.release])
+        # get release unit
+        codename = repometa.codename
+        suite = repometa.release.get('suite')
+        if not sync.dry_run:
+            self.release_unit = models.DebRelease.\
+                get_or_create_and_associate(sync.repo, codename, suite)
+        # get release component units
+        for component in repometa.components:
+            if components is None or component in components:
+                self.component_packages[component] = []
+                if sync.dry_run:
+                    continue
+                self.component_units[component] = \
+                    models.DebComponent.get_or_create_and_associate(sync.repo,
+                                                                    self.release_unit,
+                                                                    component)
+
+    def download_packages(self):
+        sync = self.step.parent
+        components = sync.components
+        architectures = sync.architectures
+        # generate download requests for all relevant packages files
+        dl_reqs = self.repometa.create_Packages_download_requests(
+            self.step.get_working_dir())
+        # Filter the dl_reqs by selected components and architectures
+        if components:
+            dl_reqs = [
+                dlr for dlr in dl_reqs
+                if dlr.data['component'] in components]
+        if architectures:
+            dl_reqs = [
+                dlr for dlr in dl_reqs
+                if dlr.data['architecture'] in architectures]
+        failed_reports = self.step.download([
             DownloadRequest(dlr.url, dlr.destination, data=dlr.data)
-            for dlr in dl_reqs]
+            for dlr in dl_reqs])
+        if failed_reports:
+            raise Exception("Failed to download {}".format(
+                ', '.join(report.url for report in failed_reports)))
+        return dl_reqs
+
+    def parse_packages(self, dl_reqs):
+        self.repometa.validate_component_arch_packages_downloads(dl_reqs)
+        for ca in self.repometa.iter_component_arch_binaries():
+            for pkg in ca.iter_packages():
+                pkg['checksumtype'] = 'sha256'
+                pkg['checksum'] = pkg['SHA256']
+                self.unit_relative_urls[pkg['checksum']] = pkg['Filename']
+                if pkg['checksum'] in self.units:
+                    unit = self.units[pkg['checksum']]
+                else:
+                    unit = models.DebPackage.from_metadata(pkg)
+                    self.units[pkg['checksum']] = unit
+                self.component_packages[ca.component].append(unit.unit_key)
+
 
+class PlanSyncStep(publish_step.PluginStep):
+    """
+    Summarize what the sync is about to do, based on the Size fields from the
+    Packages files, and refuse to start downloading if the working directory
+    and the content storage cannot hold the new units.
 
-class ParsePackagesStep(publish_step.PluginStep):
+    The duration is estimated from the throughput of the downloads of the
+    last sync, or DEFAULT_THROUGHPUT before the first, capped by max_speed.
+    """
     def __init__(self, *args, **kwargs):
-        super(ParsePackagesStep, self).__init__(*args, **kwargs)
-        self.description = _('Parse Packages Files')
+        super(PlanSyncStep, self).__init__(*args, **kwargs)
+        self.description = _('Plan sync')
 
     def process_main(self, item=None):
-        releases = self.parent.releases
-        dl_reqs = self.parent.step_download_Packages.downloads
-        units = {}
-        for release in releases:
-            repometa = self.parent.apt_repo_meta[release]
-            repometa.validate_component_arch_packages_downloads(
-                [dlr for dlr in dl_reqs
-                    if dlr.url in self.parent.packages_urls[release]])
-            for ca in repometa.iter_component_arch_binaries():
-                for pkg in ca.iter_packages():
-                    pkg['checksumtype'] = 'sha256'
-                    pkg['checksum'] = pkg['SHA256']
-                    self.parent.unit_relative_urls[pkg['checksum']] = pkg['Filename']
-                    if pkg['checksum'] in units:
-                        unit = units[pkg['checksum']]
-                    else:
-                        unit = models.DebPackage.from_metadata(pkg)
-                        units[pkg['checksum']] = unit
-                    self.parent.component_packages[release][ca.component].append(unit.unit_key)
-        self.parent.available_units = units.values()
+        if self.parent.dry_run:
+            units_to_download = self._find_units_to_download()
+        else:
+            units_to_download = self.parent.step_local_units.units_to_download
+            # Units whose stored file went bad get downloaded again
+            units_to_download.extend(find_units_to_repair(
+                self.parent.available_units, units_to_download))
+        bytes_to_download = sum(unit.size or 0 for unit in units_to_download)
+
+        available_keys = set(unit_key_as_tuple(unit.unit_key)
+                             for unit in self.parent.available_units)
+        units_to_orphan = [unit for unit in self.parent.debs_to_check
+                           if unit_key_as_tuple(unit.unit_key) not in available_keys]
+
+        throughput = (self.get_conduit().get_scratchpad() or {}).get(
+            SCRATCHPAD_THROUGHPUT) or DEFAULT_THROUGHPUT
+        max_speed = self.get_config().get(constants.CONFIG_MAX_SPEED)
+        if max_speed:
+            throughput = min(throughput, float(max_speed))
+        estimated_duration = int(bytes_to_download / float(throughput))
+
+        storage_dir = os.path.join(pulp_config.get('server', 'storage_dir'), 'content')
+        working_dir = self.get_working_dir()
+        moved = storage.IMPORT_MOVE in (self.parent.import_methods or [])
+        if self.parent.local_tree:
+            requirements = [(storage_dir, bytes_to_download)]
+        elif moved and storage.device_of(working_dir) == storage.device_of(storage_dir):
+            # Downloads are renamed into the storage, they only take up
+            # space once
+            requirements = [(working_dir, bytes_to_download)]
+        else:
+            # Downloads land in the working dir first
+            requirements = [(working_dir, bytes_to_download),
+                            (storage_dir, bytes_to_download)]
+        shortfalls = free_space_shortfalls(requirements)
+
+        self.parent.sync_plan = self.progress_details = dict(
+            units_to_download=len(units_to_download),
+            bytes_to_download=bytes_to_download,
+            units_to_orphan=len(units_to_orphan),
+            estimated_duration=estimated_duration,
+            free_space_sufficient=not shortfalls,
+        )
+        _logger.info("Sync plan for %s: %r", self.get_repo().id, self.parent.sync_plan)
+
+        if shortfalls and not self.parent.dry_run:
+            path, required, available = shortfalls[0]
+            raise PulpCodedTaskFailedException(
+                DEBSYNC003, repo_id=self.get_repo().id,
+                feed_url=self.parent.feed_url,
+                path=path, required=required, available=available)
+
+    def _find_units_to_download(self):
+        # Same as GetLocalUnitsStep, without associating the units we
+        # already have
+        available_units = self.parent.available_units
+        units_we_already_had = set(unit_key_as_tuple(unit.unit_key)
+                                   for unit in units_controller.find_units(available_units)
+                                   if unit.downloaded)
+        return [unit for unit in available_units
+                if unit_key_as_tuple(unit.unit_key) not in units_we_already_had]
 
 
 class CreateRequestsUnitsToDownload(publish_step.PluginStep):
@@ -299,6 +551,15 @@ class CreateRequestsUnitsToDownload(publish_step.PluginStep):
         step_download_units.path_to_unit = dict()
         dirs_to_create = set()
 
+        if self.parent.local_tree:
+            # Nothing to download, units get imported from the tree itself
+            for unit in self.parent.step_local_units.units_to_download:
+                path = os.path.join(self.parent.local_tree,
+                                    self.parent.unit_relative_urls[unit.checksum])
+                step_download_units.path_to_unit[path] = unit
+            step_download_units._downloads = reqs
+            return
+
         for unit in self.parent.step_local_units.units_to_download:
             url = os.path.join(feed_url, self.parent.unit_relative_urls[unit.checksum])
             filename = os.path.basename(url)
@@ -311,6 +572,8 @@ class CreateRequestsUnitsToDownload(publish_step.PluginStep):
         for dest_dir in dirs_to_create:
             misc.mkdir(dest_dir)
         step_download_units._downloads = reqs
+        # The download step runs next
+        self.parent.download_started = time.time()
 
 
 class SaveDownloadedUnits(publish_step.PluginStep):
@@ -320,11 +583,28 @@ class SaveDownloadedUnits(publish_step.PluginStep):
 
     def process_main(self, item=None):
         path_to_unit = self.parent.step_download_units.path_to_unit
+        self._save_throughput(path_to_unit.values())
         repo = self.get_repo().repo_obj
+        import_methods = self.parent.import_methods
+        storage_layout = self.parent.storage_layout
+        checksums = {}
+        if self.parent.local_tree:
+            # Reading a whole mirror is worth spreading over processes
+            paths = sorted(path_to_unit)
+            pool = multiprocessing.Pool(get_processes(self.get_config()))
+            try:
+                checksums = dict(zip(paths, pool.map(compute_checksums, paths)))
+            finally:
+                pool.close()
+                pool.join()
         for path, unit in sorted(path_to_unit.items()):
-            # Verify checksum first
-            with open(path, "rb") as fobj:
-                csum = unit._compute_checksum(fobj)
+            # Verify checksum first. All the digests publishing needs are
+            # computed in the same pass and stored with the unit.
+            csums = checksums.get(path)
+            if csums is None:
+                with open(path, "rb") as fobj:
+                    csums = unit._compute_checksums(fobj)
+            csum = csums[util.TYPE_SHA256]
             if csum != unit.checksum:
                 raise PulpCodedTaskFailedException(
                     DEBSYNC002, repo_id=self.get_repo().repo_obj.repo_id,
@@ -332,7 +612,25 @@ class SaveDownloadedUnits(publish_step.PluginStep):
                     filename=os.path.basename(path),
                     checksum_expected=unit.checksum,
                     checksum_actual=csum)
-            unit.save_and_associate(path, repo)
+            unit.checksums = csums
+            unit.save_and_associate(path, repo, import_methods=import_methods,
+                                    storage_layout=storage_layout)
+
+    def _save_throughput(self, units):
+        """
+        Save the throughput of the downloads that just completed, for
+        PlanSyncStep to estimate the duration of the next sync
+        """
+        started = getattr(self.parent, 'download_started', None)
+        size = sum(unit.size or 0 for unit in units)
+        if started is None or not size:
+            return
+        elapsed = time.time() - started
+        if elapsed <= 0:
+            return
+        scratchpad = dict(self.get_conduit().get_scratchpad() or {})
+        scratchpad[SCRATCHPAD_THROUGHPUT] = size / elapsed
+        self.get_conduit().set_scratchpad(scratchpad)
 
 
 class SaveMetadataStep(publish_step.PluginStep):
@@ -343,21 +641,20 @@ class SaveMetadataStep(publish_step.PluginStep):
     def process_main(self, item=None):
         for release in self.parent.releases:
             for comp, comp_unit in self.parent.component_units[release].iteritems():
-                # Start with an empty set if we want to delete old entries
-                if self.parent.remove_missing:
-                    comp_unit_packages_set = set()
-                else:
-                    comp_unit_packages_set = set(comp_unit.packages)
+                unit_ids = set()
                 for unit in [unit_key_to_unit(unit_key)
                              for unit_key in self.parent.component_packages[release][comp]]:
-                    comp_unit_packages_set.add(unit.id)
+                    unit_ids.add(unit.id)
                     # Prevent this unit from being cleaned up
                     try:
                         self.parent.debs_to_check.remove(unit)
                     except ValueError:
                         pass
-                comp_unit.packages = list(comp_unit_packages_set)
-                comp_unit.save()
+                # Replace the old entries if we want to delete them
+                if self.parent.remove_missing:
+                    comp_unit.set_packages(unit_ids)
+                else:
+                    comp_unit.add_packages(unit_ids - comp_unit.get_packages())
 
 
 class OrphanRemovedUnits(publish_step.PluginStep):
@@ -370,14 +667,153 @@ class OrphanRemovedUnits(publish_step.PluginStep):
             self.parent.conduit.remove_unit(unit)
         for unit in self.parent.deb_comps_to_check:
             self.parent.conduit.remove_unit(unit)
+        # Components belong to a single repository, nothing uses their
+        # memberships anymore
+        models.DebComponentPackage.remove_components(
+            unit.id for unit in self.parent.deb_comps_to_check)
         for unit in self.parent.debs_to_check:
             self.parent.conduit.remove_unit(unit)
+        if not any([self.parent.deb_releases_to_check, self.parent.deb_comps_to_check,
+                    self.parent.debs_to_check]):
+            return
+        # Purged orphans leave their component memberships behind
+        removed = models.DebComponentPackage.remove_dangling()
+        if removed:
+            _logger.info(_("Removed %(removed)d memberships of purged units"),
+                         dict(removed=removed))
 
 
 def unit_key_to_unit(unit_key):
     return models.DebPackage.objects.filter(**unit_key).first()
 
 
+def compute_checksums(path):
+    with open(path, "rb") as fobj:
+        return models.DebPackage._compute_checksums(fobj)
+
+
+def get_import_methods(import_method, local_tree):
+    """
+    Translate the import_method setting into the list of storage.IMPORT_*
+    methods to try before copying.
+
+    Downloaded files are renamed into the content storage, files of a local
+    tree are hardlinked; reflinks are used first if requested. None means
+    the files are always copied.
+    """
+    if import_method == constants.IMPORT_METHOD_COPY:
+        return None
+    if local_tree:
+        methods = [storage.IMPORT_HARDLINK, storage.IMPORT_REFLINK]
+    else:
+        methods = [storage.IMPORT_MOVE]
+    if import_method == constants.IMPORT_METHOD_REFLINK:
+        methods.insert(0, storage.IMPORT_REFLINK)
+        methods = [x for x in methods if x != storage.IMPORT_HARDLINK]
+    return methods
+
+
+def get_processes(config):
+    """
+    Return the number of worker processes to read or hash package files
+    with, the number of CPUs unless configured
+    """
+    return int(config.get(constants.CONFIG_PROCESSES) or multiprocessing.cpu_count())
+
+
+def local_tree_path(feed_url):
+    """
+    Return the file system path of a feed pointing to a local tree (a plain
+    path or a file:// URL), or None for remote feeds.
+    """
+    if feed_url.startswith('/'):
+        return feed_url
+    parsed = urlparse.urlparse(feed_url)
+    if parsed.scheme == 'file':
+        return parsed.path
+    return None
+
+
+def find_local_releases(tree):
+    """
+    Return the names of the releases (dists/*/Release) in a local tree.
+    """
+    dists = os.path.join(tree, 'dists')
+    if not os.path.isdir(dists):
+        return []
+    return sorted(x for x in os.listdir(dists)
+                  if os.path.isfile(os.path.join(dists, x, 'Release')))
+
+
+def copy_local_files(requests):
+    """
+    Copy the files of a local tree the requests refer to.
+
+    :returns list: the requests whose file could not be copied
+    """
+    failed = []
+    for request in requests:
+        try:
+            shutil.copyfile(local_tree_path(request.url), request.destination)
+        except (IOError, OSError) as e:
+            _logger.debug("Unable to copy %s: %s", request.url, e)
+            failed.append(request)
+    return failed
+
+
+def unit_key_as_tuple(unit_key):
+    return tuple(unit_key[x] for x in ids.UNIT_KEY_DEB)
+
+
+def find_units_to_repair(available_units, units_to_download):
+    """
+    Return the available units that are already stored, but whose files were
+    found corrupt or missing (see pulp_deb.plugins.scrubber).
+    """
+    pending = set(unit_key_as_tuple(unit.unit_key) for unit in units_to_download)
+    stored = [unit for unit in available_units
+              if unit_key_as_tuple(unit.unit_key) not in pending]
+    if not stored:
+        return []
+    broken = models.DebPackage.objects.filter(
+        downloaded=False,
+        checksum__in=[unit.checksum for unit in stored]).only(*ids.UNIT_KEY_DEB)
+    broken = set(unit_key_as_tuple(unit.unit_key) for unit in broken)
+    return [unit for unit in stored if unit_key_as_tuple(unit.unit_key) in broken]
+
+
+def free_space_shortfalls(requirements):
+    """
+    Check that the file systems holding the given paths have room for the
+    given number of bytes. Requirements of paths on the same file system
+    are added up.
+
+    :param requirements: list of (path, bytes) tuples
+    :type requirements: list
+
+    :returns list: (path, required, available) tuples, one per file system
+                   lacking the space
+    """
+    devices = []
+    required_by_device = {}
+    for path, required in requirements:
+        # The content storage may not have been created yet
+        while not os.path.exists(path):
+            path = os.path.dirname(path)
+        device = storage.device_of(path)
+        if device not in required_by_device:
+            devices.append((device, path))
+            required_by_device[device] = 0
+        required_by_device[device] += required
+    shortfalls = []
+    for device, path in devices:
+        stat = os.statvfs(path)
+        available = stat.f_bavail * stat.f_frsize
+        if required_by_device[device] > available:
+            shortfalls.append((path, required_by_device[device], available))
+    return shortfalls
+
+
 def generate_internal_storage_path(filename):
     """
     Generate the internal storage directory for a given deb filename
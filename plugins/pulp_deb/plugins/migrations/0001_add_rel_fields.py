@@ -1,27 +1,23 @@
 import logging
 import os
 
-from pulp.server.db import connection
-from pulp_deb.plugins.db import models
+from pulp_deb.plugins.db import migration, models
 
 
 _logger = logging.getLogger(__name__)
 
 
+def _rel_fields(unit):
+    path = unit.get('_storage_path')
+    if not path or not os.path.exists(path):
+        return None
+    m = models.DebPackage.from_file(path)
+    return dict((fname, getattr(m, fname)) for fname in m.REL_FIELDS)
+
+
 def migrate(*args, **kwargs):
     """
     Add relationship fields (breaks/depends/etc)
     """
-    collection = connection.get_collection('units_deb')
-    for unit in collection.find({}):
-        unit_id = unit['_id']
-        path = unit['_storage_path']
-        if not os.path.exists(path):
-            continue
-
-        m = models.DebPackage.from_file(path)
-        update_dict = dict()
-        for fname in m.REL_FIELDS:
-            update_dict[fname] = getattr(m, fname)
-        collection.update_one(dict(_id=unit_id),
-                              {'$set': update_dict})
+    migration.UnitMigration('0001_add_rel_fields', 'units_deb', _rel_fields,
+                            projection=['_storage_path']).run()
@@ -0,0 +1,32 @@
+import logging
+
+from pulp.server.db import connection
+from pulp_deb.common import ids
+from pulp_deb.plugins.db import models
+
+
+_logger = logging.getLogger(__name__)
+
+# Single-field indexes on the unit key fields, superseded by the platform's
+# compound unit key index and the indexes declared by the models
+STALE_INDEXES = (
+    (models.DebPackage, ids.UNIT_KEY_DEB),
+    (models.DebComponent, ids.UNIT_KEY_DEB_COMP),
+    (models.DebRelease, ids.UNIT_KEY_DEB_RELEASE),
+)
+
+
+def migrate(*args, **kwargs):
+    """
+    Replace the single-field unit key indexes with compound ones, built in
+    the background
+    """
+    for model, fields in STALE_INDEXES:
+        collection = connection.get_collection(model._meta['collection'])
+        existing = collection.index_information()
+        for field in fields:
+            name = '%s_1' % field
+            if name in existing:
+                _logger.info("Dropping index %s on %s", name, collection.name)
+                collection.drop_index(name)
+    models.DebPackage.ensure_indexes()
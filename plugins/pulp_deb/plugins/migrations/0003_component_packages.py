@@ -0,0 +1,21 @@
+import logging
+
+from pulp.server.db import connection
+from pulp_deb.plugins.db import models
+
+
+_logger = logging.getLogger(__name__)
+
+
+def migrate(*args, **kwargs):
+    """
+    Move the packages lists of components to the deb_component_packages
+    collection
+    """
+    models.DebComponentPackage.ensure_indexes()
+    collection = connection.get_collection('units_deb_component')
+    query = {'packages': {'$exists': True}}
+    for unit in collection.find(query, projection=['packages']):
+        models.DebComponentPackage.add(unit['_id'], unit['packages'] or [])
+        collection.update_one(dict(_id=unit['_id']),
+                              {'$unset': {'packages': ''}})
@@ -0,0 +1,27 @@
+import logging
+
+from pulp_deb.plugins.db import migration, models
+
+
+_logger = logging.getLogger(__name__)
+
+# BSON string
+TYPE_STRING = 2
+
+
+def _parse_relations(unit):
+    return dict((field, models.DependencyParser.parse_field(unit[field]))
+                for field in models.DebPackage.REL_FIELDS
+                if isinstance(unit.get(field), models.STRING_TYPES))
+
+
+def migrate(*args, **kwargs):
+    """
+    Parse the relationship fields that syncs stored as strings, and index
+    provided names
+    """
+    fields = models.DebPackage.REL_FIELDS
+    query = {'$or': [{field: {'$type': TYPE_STRING}} for field in fields]}
+    migration.UnitMigration('0004_parse_relations', 'units_deb', _parse_relations,
+                            query=query, projection=fields).run()
+    models.DebPackage.ensure_indexes()
@@ -0,0 +1,16 @@
+from pulp_deb.common import version
+from pulp_deb.plugins.db import migration, models
+
+
+def _version_sort_key(unit):
+    return dict(version_sort_key=version.sort_key(unit['version']))
+
+
+def migrate(*args, **kwargs):
+    """
+    Compute the version sort key of existing deb units and index it
+    """
+    migration.UnitMigration('0005_version_sort_key', 'units_deb', _version_sort_key,
+                            query={'version_sort_key': {'$exists': False}},
+                            projection=['version']).run()
+    models.DebPackage.ensure_indexes()
@@ -0,0 +1,28 @@
+import logging
+import os
+
+from pulp_deb.plugins.db import migration, models
+
+
+_logger = logging.getLogger(__name__)
+
+
+def _control(unit):
+    path = unit.get('_storage_path')
+    if not path or not os.path.isfile(path):
+        return None
+    try:
+        return dict(control=models.DebPackage.read_file(path)['control'])
+    except models.Error as e:
+        _logger.warning("Unable to read the control file of %s: %s", path, e)
+        return None
+
+
+def migrate(*args, **kwargs):
+    """
+    Store the control paragraph of the packages, for publishing them
+    without reading the files
+    """
+    migration.UnitMigration('0006_control', 'units_deb', _control,
+                            query={'control': {'$exists': False}},
+                            projection=['_storage_path']).run()
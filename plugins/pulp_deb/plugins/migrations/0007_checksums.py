@@ -0,0 +1,30 @@
+import logging
+import os
+
+from pulp_deb.plugins.db import migration, models
+
+
+_logger = logging.getLogger(__name__)
+
+
+def _checksums(unit):
+    path = unit.get('_storage_path')
+    if not path or not os.path.isfile(path):
+        return None
+    with open(path, 'rb') as fobj:
+        checksums = models.DebPackage._compute_checksums(fobj)
+    if unit.get('checksumtype') == 'sha256' and checksums['sha256'] != unit.get('checksum'):
+        # Left for the scrubber to report and for a sync to repair
+        _logger.warning("Checksum mismatch for %s, not storing its digests", path)
+        return None
+    return dict(checksums=checksums)
+
+
+def migrate(*args, **kwargs):
+    """
+    Store all the digests Packages indexes list with the packages, for
+    publishing them without hashing the files
+    """
+    migration.UnitMigration('0007_checksums', 'units_deb', _checksums,
+                            query={'checksums.sha512': {'$exists': False}},
+                            projection=['_storage_path', 'checksumtype', 'checksum']).run()
@@ -0,0 +1,277 @@
+"""
+Background scrubber for stored deb packages.
+
+Walks all DebPackage units in _id order, re-hashes their files and marks
+units whose file is corrupt or missing as not downloaded, so that the next
+sync of a repository carrying them downloads them again. Progress is kept in
+the deb_scrub_state collection, so an interrupted scrubber resumes where it
+stopped. Reads are throttled to a configurable bandwidth and IOPS budget, for
+running it continuously on production storage.
+
+The scrubber runs as the pulp-deb-scrub command, or as a Pulp task that
+checks a slice of the packages at a time, dispatched on an ISO 8601 schedule
+created with schedule(). Problems found are listed in the deb_scrub_problems
+collection.
+"""
+import argparse
+import datetime
+import logging
+import os
+import time
+from gettext import gettext as _
+
+from celery import task
+from pulp.common import tags
+from pulp.server.async.tasks import Task  # noqa: W606
+from pulp.server.db import connection
+from pulp.server.db.model.dispatch import ScheduledCall
+from pulp.server.managers.schedule import utils as schedule_utils
+
+from pulp_deb.plugins.db import models
+
+_logger = logging.getLogger(__name__)
+
+PROBLEM_MISSING = 'missing'
+PROBLEM_CORRUPT = 'corrupt'
+
+DEFAULT_STATE = 'default'
+DEFAULT_BATCH_SIZE = 100
+
+# Reserved by the scrub task, so that only one scrubber runs at a time
+RESOURCE_TYPE = 'deb_scrubber'
+
+
+class Throttle(object):
+    """
+    Delay callers so that the bytes and operations they consume stay within
+    bytes_per_sec and ops_per_sec. Either limit may be None for no limit.
+    """
+    def __init__(self, bytes_per_sec=None, ops_per_sec=None,
+                 clock=time.time, sleep=time.sleep):
+        self.bytes_per_sec = bytes_per_sec
+        self.ops_per_sec = ops_per_sec
+        self.clock = clock
+        self.sleep = sleep
+        self._ready = None
+
+    def consume(self, nbytes=0, ops=1):
+        now = self.clock()
+        if self._ready is not None and self._ready > now:
+            self.sleep(self._ready - now)
+            now = self._ready
+        cost = 0
+        if self.bytes_per_sec:
+            cost = max(cost, float(nbytes) / self.bytes_per_sec)
+        if self.ops_per_sec:
+            cost = max(cost, float(ops) / self.ops_per_sec)
+        self._ready = now + cost
+
+
+class ThrottledReader(object):
+    """
+    File object wrapper charging every read to a Throttle
+    """
+    def __init__(self, fobj, throttle):
+        self.fobj = fobj
+        self.throttle = throttle
+
+    def read(self, size=-1):
+        data = self.fobj.read(size)
+        self.throttle.consume(len(data))
+        return data
+
+    def __getattr__(self, name):
+        return getattr(self.fobj, name)
+
+
+class Scrubber(object):
+    def __init__(self, throttle=None, batch_size=DEFAULT_BATCH_SIZE,
+                 state_name=DEFAULT_STATE):
+        self.throttle = throttle or Throttle()
+        self.batch_size = batch_size
+        self.state_name = state_name
+
+    def get_state(self):
+        state = models.DebScrubState.objects.filter(name=self.state_name).first()
+        if state is None:
+            state = models.DebScrubState(name=self.state_name)
+        return state
+
+    def check(self, unit):
+        """
+        Return None if the file of unit is intact, or the problem with it.
+        """
+        path = unit._storage_path
+        self.throttle.consume()
+        if not path or not os.path.isfile(path):
+            return PROBLEM_MISSING
+        with open(path, 'rb') as fobj:
+            checksum = models.DebPackage._compute_checksum(
+                ThrottledReader(fobj, self.throttle))
+        if checksum != unit.checksum:
+            return PROBLEM_CORRUPT
+        return None
+
+    def run(self, max_units=None):
+        """
+        Check up to max_units units (all of them if None), continuing the
+        current pass. Returns when max_units were checked or the pass
+        completed.
+
+        :returns models.DebScrubState: the updated state
+        """
+        state = self.get_state()
+        checked = 0
+        while max_units is None or checked < max_units:
+            if state.pass_started is None:
+                state.pass_started = datetime.datetime.utcnow()
+            limit = self.batch_size
+            if max_units is not None:
+                limit = min(limit, max_units - checked)
+            units = self._next_batch(state.cursor, limit)
+            if not units:
+                self._complete_pass(state)
+                break
+            for unit in units:
+                problem = self.check(unit)
+                if problem is not None:
+                    self._record(state, unit, problem)
+                state.cursor = unit.id
+                state.checked += 1
+                checked += 1
+            state.save()
+        state.save()
+        return state
+
+    def _next_batch(self, cursor, limit):
+        query = models.DebPackage.objects.filter(downloaded=True)
+        if cursor is not None:
+            query = query.filter(id__gt=cursor)
+        query = query.only('id', 'checksum', '_storage_path', *models.DebPackage.unit_key_fields)
+        return list(query.order_by('id').limit(limit))
+
+    def problems(self, state, last_pass=True):
+        """
+        Return the problems found by the last completed pass, or by the
+        current one
+        """
+        pass_number = state.passes - 1 if last_pass else state.passes
+        return models.DebScrubProblem.objects.filter(state=state.name, pass_number=pass_number)
+
+    def _record(self, state, unit, problem):
+        _logger.warning(_("Package %(unit_id)s is %(problem)s at %(path)s"),
+                        dict(unit_id=unit.id, problem=problem, path=unit._storage_path))
+        # Have the next sync download it again
+        models.DebPackage.objects.filter(id=unit.id).update_one(set__downloaded=False)
+        # Upserted, as an interrupted batch gets checked again
+        models.DebScrubProblem.objects.filter(
+            state=state.name, pass_number=state.passes, unit_id=unit.id).update_one(
+                upsert=True, set__unit_key=unit.unit_key, set__path=unit._storage_path,
+                set__problem=problem, set__found=datetime.datetime.utcnow())
+        state.problem_count += 1
+
+    def _complete_pass(self, state):
+        _logger.info(_("Scrub pass completed: %(checked)d packages checked, "
+                       "%(problems)d problems found"),
+                     dict(checked=state.checked, problems=state.problem_count))
+        # Only the problems of the pass just completed are kept
+        models.DebScrubProblem.objects.filter(
+            state=state.name, pass_number__lt=state.passes).delete()
+        state.passes += 1
+        state.last_pass_problem_count = state.problem_count
+        state.problem_count = 0
+        state.checked = 0
+        state.cursor = None
+        state.pass_started = None
+
+
+def get_throttle(mb_per_sec=None, iops=None):
+    bytes_per_sec = None
+    if mb_per_sec:
+        bytes_per_sec = mb_per_sec * 1024 * 1024
+    return Throttle(bytes_per_sec, iops)
+
+
+def scrub(max_units=None, mb_per_sec=None, iops=None, batch_size=DEFAULT_BATCH_SIZE):
+    """
+    Check up to max_units packages (all of them if None), continuing the
+    current pass. Runs as the scrub_task Pulp task.
+
+    :returns dict: progress of the scrubber
+    """
+    state = Scrubber(get_throttle(mb_per_sec, iops), batch_size=batch_size).run(max_units)
+    return dict(passes=state.passes, checked=state.checked, problems=state.problem_count,
+                last_pass_problems=state.last_pass_problem_count)
+
+
+scrub_task = task(scrub, base=Task)
+
+
+def queue_scrub(**kwargs):
+    """
+    Dispatch scrub_task with kwargs, reserving the scrubber so that scrub
+    tasks never run concurrently
+    """
+    return scrub_task.apply_async_with_reservation(
+        RESOURCE_TYPE, DEFAULT_STATE, kwargs=kwargs, tags=[tags.action_tag('deb_scrub')])
+
+
+queue_scrub_task = task(queue_scrub, base=Task)
+
+
+def schedule(iso_schedule, **kwargs):
+    """
+    Dispatch scrub_task with kwargs on iso_schedule, e.g. 'PT1H' with
+    max_units set to check a slice of the packages every hour. Replaces the
+    previous schedule; None only removes it.
+
+    :returns ScheduledCall: the schedule created, or None
+    """
+    resource = tags.resource_tag(RESOURCE_TYPE, DEFAULT_STATE)
+    schedule_utils.delete_by_resource(resource)
+    if iso_schedule is None:
+        return None
+    call = ScheduledCall(iso_schedule, queue_scrub_task.name, kwargs=kwargs, resource=resource)
+    call.save()
+    return call
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        description=_('Verify the checksums of stored deb packages'))
+    parser.add_argument('--mb-per-sec', type=float, default=None,
+                        help=_('maximum read bandwidth, in MB/s'))
+    parser.add_argument('--iops', type=float, default=None,
+                        help=_('maximum number of read operations per second'))
+    parser.add_argument('--batch-size', type=int, default=DEFAULT_BATCH_SIZE,
+                        help=_('number of units to fetch and check between saving progress'))
+    parser.add_argument('--max-units', type=int, default=None,
+                        help=_('stop after checking this many units'))
+    parser.add_argument('--continuous', action='store_true',
+                        help=_('start a new pass whenever one completes'))
+    parser.add_argument('--pass-interval', type=int, default=3600,
+                        help=_('seconds to wait between passes with --continuous'))
+    parser.add_argument('--schedule', default=None, metavar='ISO8601',
+                        help=_('instead of scrubbing now, have Pulp run the scrubber with '
+                               'these options on this schedule, e.g. PT1H'))
+    parser.add_argument('--unschedule', action='store_true',
+                        help=_('remove the schedule of the scrubber'))
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    logging.basicConfig(level=logging.INFO)
+    connection.initialize()
+    if args.schedule or args.unschedule:
+        schedule(args.schedule, max_units=args.max_units, mb_per_sec=args.mb_per_sec,
+                 iops=args.iops, batch_size=args.batch_size)
+        return 0
+    scrubber = Scrubber(get_throttle(args.mb_per_sec, args.iops), batch_size=args.batch_size)
+    while True:
+        state = scrubber.run(max_units=args.max_units)
+        if not args.continuous:
+            break
+        if state.cursor is None:
+            time.sleep(args.pass_interval)
+    return 0
@@ -0,0 +1,161 @@
+import errno
+import fcntl
+import logging
+import os
+import shutil
+import uuid
+
+from pulp.plugins.util import misc
+from pulp.server.config import config as pulp_config
+
+from pulp_deb.common import constants, ids
+
+_logger = logging.getLogger(__name__)
+
+IMPORT_MOVE = 'move'
+IMPORT_HARDLINK = 'hardlink'
+IMPORT_REFLINK = 'reflink'
+IMPORT_COPY = 'copy'
+
+# From linux/fs.h
+FICLONE = 0x40049409
+
+
+def move(src, dst):
+    os.rename(src, dst)
+
+
+def hardlink(src, dst):
+    os.link(src, dst)
+
+
+def reflink(src, dst):
+    """
+    Clone src into dst, sharing the data blocks (btrfs, XFS).
+    """
+    with open(src, 'rb') as fsrc:
+        with open(dst, 'wb') as fdst:
+            try:
+                fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+            except IOError as e:
+                raise OSError(e.errno, e.strerror, dst)
+
+
+def copy(src, dst):
+    shutil.copyfile(src, dst)
+
+
+_IMPORT_FUNCTIONS = {
+    IMPORT_MOVE: move,
+    IMPORT_HARDLINK: hardlink,
+    IMPORT_REFLINK: reflink,
+    IMPORT_COPY: copy,
+}
+
+
+def temp_path(dst):
+    """
+    Return a hidden, unique path in the directory of dst, to write dst
+    under before renaming it into place
+    """
+    return os.path.join(os.path.dirname(dst), '.%s' % uuid.uuid4())
+
+
+def import_file(src, dst, methods):
+    """
+    Place src at dst, using the first of methods that works for the two
+    paths. Copying is always tried last. The file is put in place with a
+    rename, so dst never shows up partially written. Only IMPORT_MOVE
+    removes src.
+
+    :param src: path of the file to import
+    :type src: str
+    :param dst: destination path
+    :type dst: str
+    :param methods: names of the import methods to try, in order
+    :type methods: list
+
+    :returns str: name of the method that succeeded
+    """
+    misc.mkdir(os.path.dirname(dst))
+    tmp_dst = temp_path(dst)
+    methods = list(methods)
+    if IMPORT_COPY not in methods:
+        methods.append(IMPORT_COPY)
+    for method in methods:
+        try:
+            _IMPORT_FUNCTIONS[method](src, tmp_dst)
+        except (IOError, OSError) as e:
+            _remove(tmp_dst)
+            if method == IMPORT_COPY:
+                raise
+            _logger.debug("Unable to %s %s to %s: %s", method, src, dst, e)
+            continue
+        try:
+            os.rename(tmp_dst, dst)
+        except OSError:
+            _remove(tmp_dst)
+            raise
+        return method
+
+
+class ContentAddressedLayout(object):
+    """
+    Store units under their SHA256 checksum, fanned out over depth levels of
+    two hex digits each:
+
+        <storage_dir>/content/units/deb/sha256/ab/cd/abcd....deb
+
+    Storage paths can then be computed from the SHA256 field of a Packages
+    stanza alone, and every file names its own expected checksum.
+    """
+    MAX_DEPTH = 8
+
+    def __init__(self, depth=constants.CONFIG_STORAGE_FANOUT_DEFAULT):
+        if not 0 < depth <= self.MAX_DEPTH:
+            raise ValueError("Invalid fan-out depth: %r" % (depth, ))
+        self.depth = depth
+
+    @classmethod
+    def root(cls):
+        return os.path.join(pulp_config.get('server', 'storage_dir'),
+                            'content', 'units', ids.TYPE_ID_DEB, 'sha256')
+
+    def path(self, checksum):
+        checksum = checksum.lower()
+        fanout = [checksum[2 * i:2 * i + 2] for i in range(self.depth)]
+        return os.path.join(self.root(), *(fanout + [checksum + '.' + ids.TYPE_ID_DEB]))
+
+
+def get_layout(config):
+    """
+    Return the storage layout configured for the importer, or None for
+    Pulp's default layout.
+
+    :param config: importer configuration
+    :type config: pulp.plugins.config.PluginCallConfiguration or dict
+    """
+    layout = config.get(constants.CONFIG_STORAGE_LAYOUT,
+                        constants.CONFIG_STORAGE_LAYOUT_DEFAULT)
+    if layout != constants.STORAGE_LAYOUT_SHA256:
+        return None
+    depth = config.get(constants.CONFIG_STORAGE_FANOUT,
+                       constants.CONFIG_STORAGE_FANOUT_DEFAULT)
+    return ContentAddressedLayout(int(depth))
+
+
+def device_of(path):
+    """
+    Return the device of the file system path is (or would be created) on.
+    """
+    while not os.path.exists(path):
+        path = os.path.dirname(path)
+    return os.stat(path).st_dev
+
+
+def _remove(path):
+    try:
+        os.unlink(path)
+    except OSError as e:
+        if e.errno != errno.ENOENT:
+            raise
@@ -10,6 +10,9 @@ setup(
     author_email='pulp-list@redhat.com',
     description='plugins for deb support in pulp',
     entry_points={
+        'console_scripts': [
+            'pulp-deb-scrub = pulp_deb.plugins.scrubber:main',
+        ],
         'pulp.importers': [
             'importer = pulp_deb.plugins.importers.importer:entry_point',
         ],
@@ -0,0 +1,81 @@
+#!/usr/bin/env python2
+"""
+Microbenchmark for DebPackage.from_metadata.
+
+Reports the cost per Packages stanza of turning stanzas into units, for a
+Packages file given on the command line, or for generated stanzas:
+
+    python plugins/test/benchmarks/bench_from_metadata.py [-n 60000] [Packages]
+"""
+import argparse
+import time
+
+from debian import deb822
+
+from pulp.server import config
+config.check_config_files = lambda *args: None
+
+from pulp_deb.plugins.db import models  # noqa
+
+
+def generate_stanzas(count):
+    for i in range(count):
+        name = 'package%d' % i
+        yield deb822.Packages(dict(
+            Package=name,
+            Version='1.%d-1ubuntu1' % i,
+            Architecture='amd64',
+            Maintainer='Ubuntu Developers <ubuntu-devel-discuss@lists.ubuntu.com>',
+            Source=name,
+            Section='libs',
+            Priority='optional',
+            Depends='libc6 (>= 2.34), zlib1g (>= 1:1.1.4)',
+            Filename='pool/main/p/%s/%s_1.%d-1ubuntu1_amd64.deb' % (name, name, i),
+            Size=str(1000 + i),
+            SHA256='%064x' % i,
+            Description='Package number %d' % i,
+        ))
+
+
+def read_stanzas(path):
+    with open(path) as fobj:
+        return list(deb822.Packages.iter_paragraphs(fobj))
+
+
+def prepare(stanzas):
+    ret = []
+    for stanza in stanzas:
+        # As ReleasePipeline.parse_packages does
+        stanza['checksumtype'] = 'sha256'
+        stanza['checksum'] = stanza['SHA256']
+        ret.append(stanza)
+    return ret
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('-n', '--count', type=int, default=60000,
+                        help='number of stanzas to generate')
+    parser.add_argument('-r', '--repeat', type=int, default=3,
+                        help='number of runs, the fastest is reported')
+    parser.add_argument('packages', nargs='?', help='Packages file to read')
+    args = parser.parse_args()
+
+    if args.packages:
+        stanzas = prepare(read_stanzas(args.packages))
+    else:
+        stanzas = prepare(generate_stanzas(args.count))
+
+    best = None
+    for _ in range(args.repeat):
+        start = time.time()
+        for stanza in stanzas:
+            models.DebPackage.from_metadata(stanza)
+        elapsed = time.time() - start
+        best = elapsed if best is None else min(best, elapsed)
+    print("%d stanzas: %.3f s, %.1f us per stanza" % (
+        len(stanzas), best, best * 1e6 / len(stanzas)))
+
+
+if __name__ == '__main__':
+    main()
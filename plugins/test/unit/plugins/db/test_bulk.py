@@ -0,0 +1,65 @@
+import mock
+from pymongo.errors import BulkWriteError
+
+from .... import testbase
+from pulp_deb.plugins.db import bulk, models
+
+
+class TestBulk(testbase.TestCase):
+    def _units(self, count):
+        return [models.DebPackage(
+            name='pkg%d' % i, version='1', architecture='all', checksumtype='sha256',
+            checksum='%064x' % i, filename='pkg%d_1_all.deb' % i, id='id%d' % i,
+            _storage_path='/var/lib/pulp/pkg%d_1_all.deb' % i)
+            for i in range(count)]
+
+    def test_chunks(self):
+        self.assertEquals([[0, 1], [2, 3], [4]], list(bulk.chunks(range(5), 2)))
+
+    @mock.patch.object(models.DebPackage, 'objects')
+    @mock.patch.object(models.DebPackage, '_get_collection')
+    def test_insert_units_duplicates(self, _get_collection, _objects):
+        units = self._units(3)
+        stored = mock.MagicMock()
+        _objects.filter.return_value.first.return_value = stored
+        _get_collection.return_value.insert_many.side_effect = BulkWriteError(
+            dict(writeErrors=[dict(index=1, code=bulk.E_DUPLICATE)]))
+        self.assertEquals([units[0], stored, units[2]],
+                          bulk.insert_units(models.DebPackage, list(units)))
+        _objects.filter.assert_called_once_with(**units[1].unit_key)
+
+    @mock.patch.object(models.DebPackage, '_get_collection')
+    def test_insert_units_error(self, _get_collection):
+        _get_collection.return_value.insert_many.side_effect = BulkWriteError(
+            dict(writeErrors=[dict(index=0, code=121)]))
+        self.assertRaises(BulkWriteError, bulk.insert_units, models.DebPackage, self._units(1))
+
+    @mock.patch('pulp_deb.plugins.db.bulk.RepositoryContentUnit')
+    def test_associate_units(self, _RCU):
+        repo = mock.MagicMock(repo_id='repo1')
+        with mock.patch.object(bulk, 'chunks', lambda units: iter([units[:2], units[2:]])):
+            self.assertEquals(3, bulk.associate_units(repo, self._units(3)))
+        bulk_write = _RCU._get_collection.return_value.bulk_write
+        self.assertEquals([2, 1], [len(c[0][0]) for c in bulk_write.call_args_list])
+        request = bulk_write.call_args_list[0][0][0][0]
+        self.assertEquals(dict(repo_id='repo1', unit_id='id0', unit_type_id='deb'),
+                          request._filter)
+
+    @mock.patch.object(models.DebRelease, '_from_son')
+    @mock.patch.object(models.DebRelease, '_get_collection')
+    def test_upsert_unit(self, _get_collection, _from_son):
+        query = dict(repoid='repo1', codename='stable')
+        unit = bulk.upsert_unit(models.DebRelease, query, dict(suite='main'))
+        find_one_and_update = _get_collection.return_value.find_one_and_update
+        self.assertEquals(_from_son.return_value, unit)
+        _from_son.assert_called_once_with(find_one_and_update.return_value)
+        args, kwargs = find_one_and_update.call_args
+        self.assertEquals(query, args[0])
+        changes = args[1]
+        self.assertEquals('main', changes['$set']['suite'])
+        # The unit key comes from the query, the rest is only set on insert
+        self.assertEquals('units_deb_release', changes['$setOnInsert']['_ns'])
+        self.assertIn('_id', changes['$setOnInsert'])
+        for field in query:
+            self.assertNotIn(field, changes['$setOnInsert'])
+        self.assertTrue(kwargs['upsert'])
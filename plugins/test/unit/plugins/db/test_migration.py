@@ -0,0 +1,60 @@
+import mock
+
+from .... import testbase
+from pulp_deb.plugins.db import migration, models
+
+
+def _double(doc):
+    if doc['value'] % 2:
+        return None
+    return dict(value=doc['value'] * 2)
+
+
+class TestUnitMigration(testbase.TestCase):
+    def _collection(self, docs):
+        collection = mock.MagicMock()
+
+        def find(query, projection=None):
+            cursor = query.get('$and', [{}, {}])[1].get('_id', {}).get('$gt')
+            found = [d for d in docs if cursor is None or d['_id'] > cursor]
+            ret = mock.MagicMock()
+            ret.sort.return_value.limit.side_effect = lambda limit: found[:limit]
+            return ret
+        collection.find.side_effect = find
+        return collection
+
+    @mock.patch.object(models.DebMigrationState, 'objects')
+    @mock.patch('pulp_deb.plugins.db.migration.connection')
+    def test_run(self, _connection, _objects):
+        docs = [dict(_id='%02d' % i, value=i) for i in range(5)]
+        collection = _connection.get_collection.return_value = self._collection(docs)
+        _objects.filter.return_value.first.return_value = None
+        with mock.patch.object(models.DebMigrationState, 'save') as _save, \
+                mock.patch.object(models.DebMigrationState, 'delete') as _delete:
+            state = migration.UnitMigration('test', 'units_deb', _double, processes=1,
+                                            batch_size=2).run()
+        self.assertEquals(3, _save.call_count)
+        _delete.assert_called_once_with()
+        self.assertEquals(('04', 5, 3), (state.cursor, state.processed, state.updated))
+        requests = [r for c in collection.bulk_write.call_args_list for r in c[0][0]]
+        self.assertEquals([(dict(_id='00'), {'$set': dict(value=0)}),
+                           (dict(_id='02'), {'$set': dict(value=4)}),
+                           (dict(_id='04'), {'$set': dict(value=8)})],
+                          [(r._filter, r._doc) for r in requests])
+
+    @mock.patch.object(models.DebMigrationState, 'objects')
+    @mock.patch('pulp_deb.plugins.db.migration.connection')
+    def test_run_resume(self, _connection, _objects):
+        docs = [dict(_id='%02d' % i, value=i) for i in range(5)]
+        collection = _connection.get_collection.return_value = self._collection(docs)
+        _objects.filter.return_value.first.return_value = models.DebMigrationState(
+            name='test', cursor='02', processed=3, updated=2)
+        with mock.patch.object(models.DebMigrationState, 'save'), \
+                mock.patch.object(models.DebMigrationState, 'delete'):
+            state = migration.UnitMigration('test', 'units_deb', _double, processes=1,
+                                            query=dict(kind='deb')).run()
+        self.assertEquals((5, 3), (state.processed, state.updated))
+        query = collection.find.call_args_list[0][0][0]
+        self.assertEquals({'$and': [dict(kind='deb'), {'_id': {'$gt': '02'}}]}, query)
+        requests = collection.bulk_write.call_args[0][0]
+        self.assertEquals([dict(_id='04')], [r._filter for r in requests])
@@ -5,9 +5,12 @@ Contains tests for pulp_deb.plugins.db.models
 from __future__ import unicode_literals
 
 import os
+import pickle
+import mock
 from debian import deb822
 # Important to import testbase, since it mocks the server's config import snafu
 from .... import testbase
+from pulp_deb.common import version
 from pulp_deb.plugins.db import models
 
 DATA_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__),
@@ -26,6 +29,13 @@ class TestModel(testbase.TestCase):
             'checksum': '177937795c2ef5b381718aefe2981ada4e8cfe458226348d87a6f5b100a4612b',  # noqa
             'checksumtype': 'sha256',
             })
+        control = deb822.Deb822(pkg.control)
+        self.assertEquals('nscd', control['Package'])
+        self.assertEquals('glibc', control['Source'])
+        self.assertEquals(set(models.DebPackage.DIGESTS), set(pkg.checksums))
+        self.assertEquals(pkg.checksum, pkg.checksums['sha256'])
+        with open(pkg_path, 'rb') as fobj:
+            self.assertEquals(pkg.checksums, models.DebPackage._compute_checksums(fobj))
 
     def test_from_file_different_checksumtype(self):
         metadata = dict(checksumtype='sha1',
@@ -41,6 +51,45 @@ class TestModel(testbase.TestCase):
             '177937795c2ef5b381718aefe2981ada4e8cfe458226348d87a6f5b100a4612b',
             pkg.checksum)
 
+    def test_from_metadata(self):
+        stanza = deb822.Packages(dict(
+            Package='nscd', Version='2.24-7ubuntu2', Architecture='amd64',
+            SHA256='abcd', Size='1234', Section='admin'))
+        stanza['checksumtype'] = 'sha256'
+        stanza['checksum'] = stanza['SHA256']
+        pkg = models.DebPackage.from_metadata(stanza, dict(section='net'))
+        self.assertEquals('nscd', pkg.name)
+        self.assertEquals(1234, pkg.size)
+        # user_metadata takes precedence
+        self.assertEquals('net', pkg.section)
+        self.assertEquals('nscd_2.24-7ubuntu2_amd64.deb', pkg.filename)
+
+    def test_from_metadata_control(self):
+        stanza = deb822.Packages(dict(
+            Package='nscd', Version='2.24-7ubuntu2', Architecture='amd64',
+            Filename='pool/main/n/nscd/nscd_2.24-7ubuntu2_amd64.deb',
+            SHA256='abcd', Size='1234', Description='Name Service Cache Daemon'))
+        stanza['checksumtype'] = 'sha256'
+        stanza['checksum'] = stanza['SHA256']
+        pkg = models.DebPackage.from_metadata(stanza)
+        # Only the fields from the control file are kept
+        self.assertEquals(
+            dict(Package='nscd', Version='2.24-7ubuntu2', Architecture='amd64',
+                 Description='Name Service Cache Daemon'),
+            dict(deb822.Deb822(pkg.control)))
+
+    def test_from_metadata_missing_field(self):
+        with self.assertRaises(models.Error) as cm:
+            models.DebPackage.from_metadata(dict(Package='nscd'))
+        self.assertEquals('Required field is missing: architecture', str(cm.exception))
+
+    def test_pre_save_version_sort_key(self):
+        pkg = models.DebPackage(name='nscd', version='2.24-7ubuntu2', architecture='amd64',
+                                _storage_path='/var/lib/pulp/nscd_2.24-7ubuntu2_amd64.deb')
+        self.assertEquals(None, pkg.version_sort_key)
+        models.DebPackage.pre_save_signal(models.DebPackage, pkg)
+        self.assertEquals(version.sort_key('2.24-7ubuntu2'), pkg.version_sort_key)
+
     def test_from_file_no_file(self):
         with self.assertRaises(ValueError) as cm:
             models.DebPackage.from_file('/missing-file')
@@ -101,3 +150,77 @@ class TestModel(testbase.TestCase):
                 "Depends: {}".format(strdep)))[0]
             self.assertEquals(debdep, pkg.relations['depends'])
             self.assertEquals(pulpdep, models.DependencyParser.parse(debdep))
+            # Cached relations are frozen: alternatives and lists are tuples
+            self.assertEquals(models._freeze(pulpdep),
+                              models.DependencyParser.parse_field(strdep))
+
+    def test_dep_parse_cache(self):
+        first = models.DependencyParser.parse_field('libc6 (>= 2.34), zlib1g')
+        second = models.DependencyParser.parse_field('zlib1g,libc6  (>= 2.34)')
+        # Identical relations share one parsed value
+        self.assertIs(first[0], second[1])
+        self.assertIs(first[1], second[0])
+        self.assertEquals({'name': 'libc6', 'version': '2.34', 'flag': 'GE'}, first[0])
+
+    def test_dep_parse_cache_immutable(self):
+        first = models.DependencyParser.parse_field('libc6 (>= 2.34), a | b')
+        self.assertEquals(({'name': 'a'}, {'name': 'b'}), first[1])
+        with self.assertRaises(TypeError):
+            first[0]['name'] = 'changed'
+        with self.assertRaises(TypeError):
+            first[1][0].update(version='1')
+        with self.assertRaises(AttributeError):
+            first[1].append({'name': 'c'})
+        # Copies can be changed, and pickled values stay frozen
+        copy = dict(first[0])
+        copy['name'] = 'changed'
+        self.assertEquals('libc6', first[0]['name'])
+        unpickled = pickle.loads(pickle.dumps(first[0], 2))
+        self.assertEquals(first[0], unpickled)
+        self.assertRaises(TypeError, unpickled.pop, 'name')
+
+    @mock.patch.object(models.DependencyParser, 'CACHE_SIZE', 2)
+    @mock.patch.object(models.DependencyParser, '_cache', models.OrderedDict())
+    def test_dep_parse_cache_bounded(self):
+        for rel in ['a', 'b', 'a', 'c']:
+            models.DependencyParser.parse_relation(rel)
+        # 'b' was the least recently used
+        self.assertEquals(['a', 'c'], list(models.DependencyParser._cache))
+
+
+class TestDebComponent(testbase.TestCase):
+    @mock.patch('pulp_deb.plugins.db.models.DebComponentPackage')
+    def test_set_packages(self, _Membership):
+        _Membership.unit_ids_by_component.return_value = dict(
+            compid=set(['aaaa', 'bbbb']))
+        comp = models.DebComponent(name='main', release='stable', id='compid')
+        comp.set_packages(['bbbb', 'cccc'])
+        # Only the changes get written
+        _Membership.remove.assert_called_once_with('compid', set(['aaaa']))
+        _Membership.add.assert_called_once_with('compid', set(['cccc']))
+
+
+class TestDebComponentPackage(testbase.TestCase):
+    @mock.patch('pulp_deb.plugins.db.models.DebPackage')
+    @mock.patch('pulp_deb.plugins.db.models.DebComponent')
+    @mock.patch('pulp_deb.plugins.db.models.DebComponentPackage.objects')
+    def test_remove_dangling(self, _objects, _DebComponent, _DebPackage):
+        _objects.distinct.return_value = ['comp1', 'comp2']
+        _DebComponent.objects.filter.return_value.scalar.return_value = ['comp1']
+        batches = [['aaaa', 'bbbb'], ['cccc'], []]
+        query = _objects.filter.return_value.order_by.return_value.limit.return_value
+        query.scalar.side_effect = batches[1:]
+        _objects.order_by.return_value.limit.return_value.scalar.return_value = batches[0]
+        _DebPackage.objects.filter.return_value.scalar.side_effect = [['bbbb'], []]
+        _objects.filter.return_value.delete.return_value = 1
+
+        self.assertEquals(3, models.DebComponentPackage.remove_dangling(batch_size=2))
+        _objects.filter.assert_any_call(component_id__in=['comp2'])
+        _objects.filter.assert_any_call(unit_id__in=['aaaa'])
+        _objects.filter.assert_any_call(unit_id__in=['cccc'])
+        # Batches continue after the last unit id
+        _objects.filter.assert_any_call(unit_id__gt='bbbb')
+        _objects.filter.assert_any_call(unit_id__gt='cccc')
+        self.assertEquals(
+            [mock.call(id__in=['aaaa', 'bbbb']), mock.call(id__in=['cccc'])],
+            _DebPackage.objects.filter.call_args_list)
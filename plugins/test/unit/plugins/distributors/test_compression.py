@@ -0,0 +1,122 @@
+import bz2
+import gzip
+import hashlib
+import io
+import os
+import subprocess
+import threading
+
+import mock
+from .... import testbase
+
+from pulp_deb.plugins.distributors import compression
+
+
+class Stanza(object):
+    def __init__(self, data):
+        self.data = data
+
+    def dump(self, fd):
+        fd.write(self.data)
+
+
+def _decompress(path):
+    if path.endswith('.gz'):
+        return gzip.open(path, 'rb').read()
+    if path.endswith('.bz2'):
+        return bz2.BZ2File(path, 'rb').read()
+    return subprocess.check_output(['xz', '-dc', path])
+
+
+class TestIndexCompression(testbase.TestCase):
+    def test_create(self):
+        settings = compression.IndexCompression.create(['xz', 'gz'], dict(xz=9))
+        self.assertEquals((('gz', 'xz'), (9, 9), 1), settings)
+        self.assertEquals('gz:9 xz:9', settings.fingerprint())
+        settings = compression.IndexCompression.create(threads=2)
+        self.assertEquals('gz:9 xz:6 threads:2', settings.fingerprint())
+
+    def test_available(self):
+        self.assertTrue(compression.available('gz'))
+        self.assertFalse(compression.available('lz4'))
+        with mock.patch.object(compression, '_import', return_value=None), \
+                mock.patch.object(compression, 'find_executable', return_value=None):
+            self.assertFalse(compression.available('zst'))
+
+    def test_default_formats(self):
+        with mock.patch.object(compression, 'available', side_effect=lambda fmt: fmt != 'xz'):
+            self.assertEquals(('gz', ), compression.default_formats())
+            self.assertEquals((('gz', ), (9, ), 1), compression.IndexCompression.create())
+
+
+class TestWriteIndex(testbase.TestCase):
+    def test_write_index(self):
+        release_dir = os.path.join(self.work_dir, 'dists', 'stable')
+        stanzas = [Stanza(b'Package: foo\n'), Stanza(b'Package: bar\n' * 50000)]
+        settings = compression.IndexCompression.create(['gz', 'bz2', 'xz'])
+        checksums = compression.write_index(release_dir, 'main/binary-amd64/Packages',
+                                            iter(stanzas), settings)
+        plain = b'Package: foo\n\n' + b'Package: bar\n' * 50000
+        names = ['main/binary-amd64/Packages' + ext for ext in ('', '.gz', '.bz2', '.xz')]
+        self.assertEquals(names, [entry['name'] for entry in checksums['SHA256']])
+        for entry in checksums['SHA256']:
+            path = os.path.join(release_dir, entry['name'])
+            data = open(path, 'rb').read()
+            self.assertEquals(str(len(data)), entry['size'])
+            self.assertEquals(hashlib.sha256(data).hexdigest(), entry['sha256'])
+            self.assertEquals(plain, data if path.endswith('Packages') else _decompress(path))
+        self.assertEquals(hashlib.md5(plain).hexdigest(), checksums['MD5sum'][0]['md5sum'])
+        self.assertEquals(hashlib.sha1(plain).hexdigest(), checksums['SHA1'][0]['sha1'])
+
+    def test_write_index_gzip_reproducible(self):
+        settings = compression.IndexCompression.create(['gz'])
+        checksums = [compression.write_index(os.path.join(self.work_dir, name), 'Packages',
+                                             [Stanza(b'Package: foo\n')], settings)
+                     for name in ('a', 'b')]
+        self.assertEquals(checksums[0], checksums[1])
+
+    def test_write_index_command_failure(self):
+        settings = compression.IndexCompression.create(['xz'])
+        with mock.patch.object(compression, '_import', return_value=None), \
+                mock.patch.object(compression, '_MODULES',
+                                  dict(xz=('lzma', 'false'))):
+            self.assertRaises(compression.Error, compression.write_index,
+                              self.work_dir, 'Packages', [Stanza(b'Package: foo\n')], settings)
+
+    def test_threaded_writer(self):
+        threads = []
+        writer = mock.MagicMock()
+        writer.write.side_effect = lambda data: threads.append(threading.current_thread())
+        threaded = compression._ThreadedWriter(writer)
+        threaded.write(b'a')
+        threaded.write(b'b')
+        threaded.close()
+        self.assertEquals([mock.call(b'a'), mock.call(b'b')], writer.write.call_args_list)
+        writer.close.assert_called_once_with()
+        # The writer runs in a thread of its own
+        self.assertEquals([threaded.thread] * 2, threads)
+
+    def test_threaded_writer_error(self):
+        writer = mock.MagicMock()
+        writer.write.side_effect = IOError('disk full')
+        threaded = compression._ThreadedWriter(writer)
+        for _ in range(2 * compression.QUEUE_SIZE):
+            try:
+                threaded.write(b'a')
+            except IOError:
+                break
+        self.assertRaises(IOError, threaded.close)
+        self.assertEquals(0, writer.close.call_count)
+        threaded.abort()
+        writer.abort.assert_called_once_with()
+
+    def test_tee(self):
+        writers = [io.BytesIO(), io.BytesIO()]
+        tee = compression._Tee(writers)
+        tee.write(b'a')
+        self.assertEquals(b'', writers[0].getvalue())
+        tee.write(b'b' * compression.CHUNK_SIZE)
+        tee.write(b'c')
+        tee.flush()
+        for writer in writers:
+            self.assertEquals(b'a' + b'b' * compression.CHUNK_SIZE + b'c', writer.getvalue())
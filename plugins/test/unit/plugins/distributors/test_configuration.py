@@ -1,3 +1,4 @@
+import multiprocessing
 import os
 
 from mock import Mock
@@ -31,6 +32,16 @@ class TestConfigurationGetters(testbase.TestCase):
         self.assertEquals(directory,
                           '/var/lib/pulp/published/deb/master/deb_distributor/foo')
 
+    def test_get_pool_publish_dir(self):
+        directory = configuration.get_pool_publish_dir(self.repo,
+                                                       'deb_distributor')
+        self.assertEquals(directory,
+                          '/var/lib/pulp/published/deb/pool/deb_distributor/foo')
+        directory = configuration.get_pool_publish_dir(self.repo,
+                                                       'deb_distributor', 'dist-1')
+        self.assertEquals(directory,
+                          '/var/lib/pulp/published/deb/pool/deb_distributor/foo/dist-1')
+
     def test_get_http_publish_dir(self):
         directory = configuration.get_http_publish_dir(self.config)
         self.assertEquals(directory, os.path.join(self.publish_dir, 'http'))
@@ -48,6 +59,28 @@ class TestConfigurationGetters(testbase.TestCase):
         directory = configuration.get_repo_relative_path(self.repo, cfg)
         self.assertEquals(directory, 'a/b')
 
+    def test_get_index_compression(self):
+        self.assertEquals((('gz', 'xz'), (9, 6), 1),
+                          configuration.get_index_compression(self.config))
+        cfg = self.config.__class__(dict(publish_compression=['zst', 'gz'],
+                                         publish_compression_levels=dict(zst=10),
+                                         publish_compression_threads=4), dict())
+        self.assertEquals((('gz', 'zst'), (9, 10), 4),
+                          configuration.get_index_compression(cfg))
+
+    def test_get_publish_processes(self):
+        self.assertEquals(multiprocessing.cpu_count(),
+                          configuration.get_publish_processes(self.config))
+        cfg = self.config.__class__(dict(publish_processes=3), dict())
+        self.assertEquals(3, configuration.get_publish_processes(cfg))
+
+    def test_get_by_hash_generations(self):
+        self.assertEquals(3, configuration.get_by_hash_generations(self.config))
+        cfg = self.config.__class__(dict(publish_by_hash_generations=0), dict())
+        self.assertEquals(0, configuration.get_by_hash_generations(cfg))
+        cfg = self.config.__class__(dict(publish_by_hash=False), dict())
+        self.assertEquals(None, configuration.get_by_hash_generations(cfg))
+
 
 class TestValidateConfig(testbase.TestCase):
     def _config_conduit(self, empty=True):
@@ -107,3 +140,50 @@ class TestValidateConfig(testbase.TestCase):
                            'in repository plugin configuration')
         self.assertEquals((False, expected_reason),
                           configuration.validate_config(repo, config, conduit))
+
+    def test_publish_processes(self):
+        repo = Mock(repo_id='foo', working_dir=self.work_dir)
+        conduit = self._config_conduit()
+        config = PluginCallConfiguration(
+            dict(http=True, https=False, relative_url=None, publish_processes=4), {})
+        self.assertEquals((True, None),
+                          configuration.validate_config(repo, config, conduit))
+        config = PluginCallConfiguration(
+            dict(http=True, https=False, relative_url=None, publish_processes=0), {})
+        self.assertEquals((False, 'Configuration value for [publish_processes] should be '
+                           'a positive integer, but is 0'),
+                          configuration.validate_config(repo, config, conduit))
+
+    def test_publish_compression(self):
+        repo = Mock(repo_id='foo', working_dir=self.work_dir)
+        conduit = self._config_conduit()
+        config = PluginCallConfiguration(
+            dict(http=True, https=False, relative_url=None, publish_compression=['gz', 'bz2'],
+                 publish_compression_levels=dict(gz=6), publish_compression_threads=2), {})
+        self.assertEquals((True, None),
+                          configuration.validate_config(repo, config, conduit))
+        config = PluginCallConfiguration(
+            dict(http=True, https=False, relative_url=None, publish_compression=['lz4']), {})
+        self.assertEquals((False, "Configuration value for [publish_compression] contains "
+                           "the unknown format 'lz4'"),
+                          configuration.validate_config(repo, config, conduit))
+        config = PluginCallConfiguration(
+            dict(http=True, https=False, relative_url=None,
+                 publish_compression_levels=dict(xz=12)), {})
+        self.assertEquals((False, "Configuration value for [publish_compression_levels] "
+                           "should set xz to a level from 0 to 9, but sets it to 12"),
+                          configuration.validate_config(repo, config, conduit))
+
+    def test_publish_by_hash(self):
+        repo = Mock(repo_id='foo', working_dir=self.work_dir)
+        conduit = self._config_conduit()
+        config = PluginCallConfiguration(
+            dict(http=True, https=False, relative_url=None, publish_by_hash=True,
+                 publish_by_hash_generations=0), {})
+        self.assertEquals((True, None),
+                          configuration.validate_config(repo, config, conduit))
+        config = PluginCallConfiguration(
+            dict(http=True, https=False, relative_url=None, publish_by_hash_generations=-1), {})
+        self.assertEquals((False, 'Configuration value for [publish_by_hash_generations] '
+                           'should be a non-negative integer, but is -1'),
+                          configuration.validate_config(repo, config, conduit))
@@ -4,6 +4,7 @@ import sys
 import time
 import uuid
 import hashlib
+import io
 
 from debian import deb822
 import mock
@@ -26,6 +27,7 @@ class BaseTest(testbase.TestCase):
             distributor.configuration.__dict__,
             ROOT_PUBLISH_DIR=root,
             MASTER_PUBLISH_DIR=os.path.join(root, "master"),
+            POOL_PUBLISH_DIR=os.path.join(root, "pool"),
             HTTP_PUBLISH_DIR=os.path.join(root, "http", "repos"),
             HTTPS_PUBLISH_DIR=os.path.join(root, "https", "repos"),
         )
@@ -104,13 +106,15 @@ class TestConfiguration(BaseTest):
 
 
 class PublishRepoMixIn(object):
+    separate_arch_all = False
+
     @classmethod
     def _units(cls, storage_dir):
         units = []
         for Model in cls.Sample_Units:
             units.extend([Model(
                 _storage_path=None,
-                **x)
+                **dict((k, v) for k, v in x.items() if k != 'packages'))
                 for x in cls.Sample_Units[Model]])
         for unit in units:
             try:
@@ -125,13 +129,23 @@ class PublishRepoMixIn(object):
                 pass
         return units
 
+    @classmethod
+    def _component_packages(cls, component_ids):
+        packages = dict((x['id'], set(x['packages']))
+                        for x in cls.Sample_Units.get(models.DebComponent, []))
+        return dict((x, packages.get(x, set())) for x in component_ids)
+
+    @mock.patch("pulp_deb.plugins.distributors.distributor.models.repo_controller")
+    @mock.patch("pulp_deb.plugins.distributors.distributor.models.DebComponentPackage"
+                ".unit_ids_by_component")
     @mock.patch("pulp_deb.plugins.distributors.distributor.aptrepo.AptRepo.sign")
     @mock.patch('pulp.plugins.util.publish_step.selinux.restorecon')
     @mock.patch("pulp_deb.plugins.distributors.distributor.aptrepo.debpkg.debfile.DebFile")
     @mock.patch("pulp.server.managers.repo._common.task.current")
     @mock.patch('pulp.plugins.util.publish_step.repo_controller')
     def test_publish_repo(self, _repo_controller, _task_current, _DebFile,
-                          _restorecon, _sign):
+                          _restorecon, _sign, _unit_ids_by_component, _deb_repo_controller):
+        _unit_ids_by_component.side_effect = self._component_packages
         _task_current.request.id = 'aabb'
         worker_name = "worker01"
         _task_current.request.configure_mock(hostname=worker_name)
@@ -165,21 +179,32 @@ class PublishRepoMixIn(object):
             description="Repo %d description" % repo_time,
             id=repo_id)
 
+        queries = dict()
+
         def mock_get_units(repo_id, model_class, *args, **kwargs):
             units = unit_dict[model_class.TYPE_ID]
-            query = mock.MagicMock()
+            query = queries[model_class] = mock.MagicMock()
             query.count.return_value = len(units)
             query.__iter__.return_value = iter(units)
+            query.only.return_value = query
             return [query]
         _repo_controller.get_unit_model_querysets.side_effect = mock_get_units
+        _deb_repo_controller.get_unit_model_querysets.side_effect = mock_get_units
         conduit = self._config_conduit()
+        conduit.get_scratchpad.return_value = None
+        conduit.distributor_id = 'deb-dist-1'
         repo_config = dict(
             http=True, https=False,
             relative_url='level1/' + repo.id,
             http_publish_dir=publish_dir + '/http/repos',
-            https_publish_dir=publish_dir + '/https/repos')
+            https_publish_dir=publish_dir + '/https/repos',
+            # Package files are read through mocks, which worker processes
+            # would not share
+            publish_processes=1)
         if self.default_release:
             repo_config[constants.PUBLISH_DEFAULT_RELEASE_KEYWORD] = True
+        if self.separate_arch_all:
+            repo_config[constants.PUBLISH_SEPARATE_ARCH_ALL_KEYWORD] = True
 
         signer = self.new_file(name="signer", contents="#!/bin/bash").path
         os.chmod(signer, 0o755)
@@ -193,7 +218,7 @@ class PublishRepoMixIn(object):
         self.assertEquals(
             [x[0][0] for x in conduit.build_success_report.call_args_list],
             [{'publish_directory': 'FINISHED', 'publish_modules': 'FINISHED',
-              'generate_listing_files': 'FINISHED'}])
+              'prune_pool': 'FINISHED', 'generate_listing_files': 'FINISHED'}])
         self.assertEquals(
             [x[0][1][0]['num_processed']
              for x in conduit.build_success_report.call_args_list],
@@ -204,12 +229,13 @@ class PublishRepoMixIn(object):
             [4])
 
         # Make sure all three models (packages, components, releases) are retrieved
-        self.assertEqual(_repo_controller.get_unit_model_querysets.call_count, 3)
+        self.assertEqual(_repo_controller.get_unit_model_querysets.call_count, 2)
+        self.assertEqual(_deb_repo_controller.get_unit_model_querysets.call_count, 1)
 
         # Make sure symlinks got created
         for unit in unit_dict[ids.TYPE_ID_DEB]:
             units_components = [comp.name for comp in unit_dict[ids.TYPE_ID_DEB_COMP]
-                                if unit.id in comp.packages]
+                                if unit.id in self._component_packages([comp.id])[comp.id]]
             for component in units_components:
                 published_path = os.path.join(
                     repo_config['http_publish_dir'],
@@ -250,24 +276,55 @@ class PublishRepoMixIn(object):
             for comp in [comp.name for comp in component_units
                          if comp.release == release.codename]:
                 for arch in self.Architectures:
-                    self.assertTrue(os.path.exists(
-                        os.path.join(comp_dir, comp, 'binary-' + arch, 'Packages')))
+                    packages_path = os.path.join(comp_dir, comp, 'binary-' + arch, 'Packages')
+                    self.assertTrue(os.path.exists(packages_path))
+                    by_hash_path = os.path.join(os.path.dirname(packages_path), 'by-hash',
+                                                'SHA256', self._sha256(packages_path))
+                    self.assertEquals(open(packages_path, 'rb').read(),
+                                      open(by_hash_path, 'rb').read())
             # #3917: make sure Description and Label are properly set
             rel_file_contents = deb822.Deb822(sequence=open(release_file))
             self.assertEqual(repo.id, rel_file_contents['Label'])
             self.assertEqual(repo.description, rel_file_contents['Description'])
+            # The field tells clients that the architecture all packages are
+            # listed in the index of every architecture, so they skip binary-all
+            arch_all_elsewhere = 'No-Support-for-Architecture-all' in rel_file_contents
+            self.assertEqual(not self.separate_arch_all, arch_all_elsewhere)
+            self.assertIn('all', rel_file_contents['Architectures'].split())
+            for comp in [comp.name for comp in component_units
+                         if comp.release == release.codename]:
+                all_packages = self._arch_all_packages(comp_dir, comp, 'all')
+                for arch in self.Architectures:
+                    if arch == 'all':
+                        continue
+                    self.assertEqual(all_packages if arch_all_elsewhere else set(),
+                                     self._arch_all_packages(comp_dir, comp, arch))
+            self.assertEqual('yes', rel_file_contents['Acquire-By-Hash'])
 
         exp = [
             mock.call(repo.id, models.DebRelease, None),
             mock.call(repo.id, models.DebComponent, None),
-            mock.call(repo.id, models.DebPackage, None),
         ]
         self.assertEquals(
             exp,
             _repo_controller.get_unit_model_querysets.call_args_list)
+        self.assertEquals(
+            [mock.call(repo.id, models.DebPackage, None)],
+            _deb_repo_controller.get_unit_model_querysets.call_args_list)
+        # Packages are read with a projection
+        queries[models.DebPackage].only.assert_called_once_with(
+            *self.Module.PublishDebStep.FIELDS)
 
         publish_dir = os.path.join(repo_config['http_publish_dir'],
                                    repo_config['relative_url'])
+        # The pool of the distributor is linked, not copied
+        self.assertEquals(
+            os.path.join(self.Configuration.POOL_PUBLISH_DIR, ids.TYPE_ID_DISTRIBUTOR,
+                         repo_id, 'deb-dist-1', 'pool'),
+            os.readlink(os.path.join(publish_dir, 'pool')))
+        # The scratch files of the packages are not published
+        self.assertEquals([], [name for name in os.listdir(publish_dir)
+                               if name.startswith('.packages-')])
         # Make sure there is a listing file
         lfpath = os.path.join(os.path.dirname(publish_dir), 'listing')
         self.assertEquals(repo_id, open(lfpath).read())
@@ -281,6 +338,39 @@ class PublishRepoMixIn(object):
                                              "aabb", "dists", release.codename, "Release")
             _sign.assert_any_call(work_release_file)
 
+        # Publishing the same packages again reuses the indexes
+        packages_files = self._packages_files(publish_dir)
+        self.assertTrue(packages_files)
+        conduit.get_scratchpad.return_value = conduit.set_scratchpad.call_args[0][0]
+        _DebFile.reset_mock()
+        with mock.patch.object(self.Module.os, 'symlink', wraps=os.symlink) as _symlink:
+            distributor.publish_repo(repo, conduit, config=repo_config)
+        self.assertEquals(0, _DebFile.call_count)
+        # and the pool
+        self.assertEquals([], [c for c in _symlink.call_args_list
+                               if os.sep + 'pool' + os.sep in c[0][1]])
+        self.assertEquals(packages_files, self._packages_files(publish_dir))
+
+    @classmethod
+    def _arch_all_packages(cls, comp_dir, component, architecture):
+        path = os.path.join(comp_dir, component, 'binary-' + architecture, 'Packages')
+        return set(stanza['Package'] for stanza in deb822.Packages.iter_paragraphs(open(path))
+                   if stanza['Architecture'] == 'all')
+
+    @classmethod
+    def _packages_files(cls, publish_dir):
+        ret = dict()
+        for dirpath, _dirnames, filenames in os.walk(os.path.join(publish_dir, 'dists')):
+            for filename in filenames:
+                if filename.startswith('Packages'):
+                    path = os.path.join(dirpath, filename)
+                    ret[os.path.relpath(path, publish_dir)] = open(path, 'rb').read()
+        return ret
+
+    @classmethod
+    def _sha256(cls, path):
+        return hashlib.sha256(open(path, 'rb').read()).hexdigest()
+
     @classmethod
     def _mkdeb(cls, unit):
         return dict(Package=unit['name'],
@@ -379,6 +469,11 @@ class TestPublishRepoMultiCompArchDeb(PublishRepoMixIn, BaseTest):
     default_release = True
 
 
+class TestPublishRepoSeparateArchAllDeb(TestPublishRepoMultiArchDeb):
+    Sample_Units_Order = [3, 2, 0, 1]
+    separate_arch_all = True
+
+
 class TestDistributorRemoved(BaseTest):
     def test_dirstibutor_removed(self):
         repo_id = 'repo-1'
@@ -395,6 +490,11 @@ class TestDistributorRemoved(BaseTest):
         http_dir = os.path.join(self.Configuration.HTTP_PUBLISH_DIR, repo_id)
         https_dir = os.path.join(self.Configuration.HTTPS_PUBLISH_DIR, repo_id)
         os.makedirs(repo_dir)
+        pool_dir = os.path.join(
+            self.Configuration.POOL_PUBLISH_DIR,
+            ids.TYPE_ID_DISTRIBUTOR,
+            repo_id)
+        os.makedirs(os.path.join(pool_dir, 'deb-dist-1', 'pool'))
         for d in [http_dir, https_dir]:
             os.makedirs(os.path.dirname(d))
             os.symlink(repo_dir, d)
@@ -402,5 +502,200 @@ class TestDistributorRemoved(BaseTest):
         distributor.distributor_removed(repo, config)
 
         self.assertFalse(os.path.exists(repo_dir))
+        self.assertFalse(os.path.exists(pool_dir))
         self.assertFalse(os.path.islink(http_dir))
         self.assertFalse(os.path.islink(https_dir))
+
+
+class TestIndexFingerprint(BaseTest):
+    def test_index_fingerprint(self):
+        units = [models.DebPackage(id=unit_id) for unit_id in ('b', 'a', 'c')]
+        fingerprint = self.Module.index_fingerprint(units)
+        self.assertEquals(fingerprint, self.Module.index_fingerprint(reversed(units)))
+        self.assertNotEquals(fingerprint, self.Module.index_fingerprint(units[:2]))
+        self.assertNotEquals(self.Module.index_fingerprint([]),
+                             self.Module.index_fingerprint(units[:1]))
+        self.assertNotEquals(fingerprint, self.Module.index_fingerprint(units, 'gz:9'))
+
+
+class TestPackageStanza(BaseTest):
+    def test_dump(self):
+        path = self.new_file(name="foo_1.0_all.deb", contents="not really a package").path
+        unit = models.DebPackage(
+            name='foo', version='1.0', architecture='all', size=20,
+            checksumtype='sha256', checksum=hashlib.sha256('not really a package').hexdigest(),
+            control='Package: foo\nVersion: 1.0\nArchitecture: all\n'
+                    'Description: Foo\n Does foo.\n',
+            _storage_path=path)
+        fobj = io.BytesIO()
+        self.Module.PackageStanza(unit, 'pool/main/foo_1.0_all.deb').dump(fobj)
+        stanza = deb822.Packages(fobj.getvalue())
+        self.assertEquals(['Package', 'Version', 'Architecture', 'Description', 'Filename',
+                           'Size', 'MD5sum', 'SHA1', 'SHA256', 'SHA512'], list(stanza.keys()))
+        self.assertEquals('Foo\n Does foo.', stanza['Description'])
+        self.assertEquals('pool/main/foo_1.0_all.deb', stanza['Filename'])
+        self.assertEquals('20', stanza['Size'])
+        self.assertEquals(hashlib.md5('not really a package').hexdigest(), stanza['MD5sum'])
+        self.assertEquals(unit.checksum, stanza['SHA256'])
+
+    def test_dump_stored_checksums(self):
+        unit = models.DebPackage(
+            name='foo', version='1.0', architecture='all', size=20,
+            checksumtype='sha256', checksum='03',
+            checksums=dict(md5='01', sha1='02', sha256='03', sha512='04'),
+            control='Package: foo\n', _storage_path='/nonexistent/foo_1.0_all.deb')
+        fobj = io.BytesIO()
+        self.Module.PackageStanza(unit, 'pool/main/foo_1.0_all.deb').dump(fobj)
+        stanza = deb822.Packages(fobj.getvalue())
+        self.assertEquals(['01', '02', '03', '04'],
+                          [stanza[f] for f in ('MD5sum', 'SHA1', 'SHA256', 'SHA512')])
+
+
+class TestPool(BaseTest):
+    def setUp(self):
+        super(TestPool, self).setUp()
+        self.root = os.path.join(self.work_dir, 'pool-root')
+
+    def _publish(self, pool_units):
+        """
+        Update and prune a new Pool, as a publish does
+
+        :returns tuple: paths linked, paths removed
+        """
+        pool = self.Module.Pool(self.root)
+        with mock.patch.object(self.Module.os, 'symlink', wraps=os.symlink) as _symlink:
+            with mock.patch.object(self.Module.os, 'unlink', wraps=os.unlink) as _unlink:
+                pool.update(pool_units)
+                pool.prune()
+        return ([c[0][1] for c in _symlink.call_args_list],
+                [c[0][0] for c in _unlink.call_args_list
+                 if c[0][0] != pool.manifest_path])
+
+    def _storage_path(self, name):
+        return os.path.join(self.work_dir, 'storage', name)
+
+    def _entries(self, *names):
+        return dict((name, self._storage_path(name)) for name in names)
+
+    def _pool_path(self, *names):
+        return os.path.join(self.root, 'pool', *names)
+
+    def test_pool(self):
+        names = ['%d.deb' % i for i in range(100)]
+        links, removed = self._publish(dict(main=self._entries(*names)))
+        self.assertEquals(100, len(links))
+        # Only the added and removed packages are linked and unlinked
+        links, removed = self._publish(dict(main=self._entries('new.deb', *names[1:])))
+        self.assertEquals([self._pool_path('main', 'new.deb')], links)
+        self.assertEquals([self._pool_path('main', '0.deb')], removed)
+        self.assertEquals(sorted(['new.deb'] + names[1:]),
+                          sorted(os.listdir(self._pool_path('main'))))
+        self.assertEquals(self._storage_path('new.deb'),
+                          os.readlink(self._pool_path('main', 'new.deb')))
+        # Unchanged: no links are created nor removed, nor read
+        with mock.patch.object(self.Module.os, 'readlink') as _readlink:
+            with mock.patch.object(self.Module.os, 'listdir') as _listdir:
+                links, removed = self._publish(
+                    dict(main=self._entries('new.deb', *names[1:])))
+        self.assertEquals(([], []), (links, removed))
+        self.assertEquals(0, _readlink.call_count)
+        self.assertEquals(0, _listdir.call_count)
+
+    def test_pool_stale_until_pruned(self):
+        self._publish(dict(main=self._entries('a.deb'), contrib=self._entries('b.deb')))
+        pool = self.Module.Pool(self.root)
+        pool.update(dict(main=self._entries('c.deb')))
+        # Still served to the trees published before
+        self.assertTrue(os.path.islink(self._pool_path('main', 'a.deb')))
+        self.assertEquals(dict(main=['a.deb'], contrib=['b.deb']), pool.stale)
+        self.assertEquals(2, pool.prune())
+        self.assertEquals(['main'], os.listdir(self._pool_path()))
+        self.assertEquals(['c.deb'], os.listdir(self._pool_path('main')))
+
+    def test_pool_moved(self):
+        self._publish(dict(main=self._entries('a.deb', 'b.deb')))
+        entries = dict(main=self._entries('b.deb'))
+        entries['main']['a.deb'] = self._storage_path('moved/a.deb')
+        links, removed = self._publish(entries)
+        self.assertEquals(1, len(links))
+        self.assertEquals([], removed)
+        self.assertEquals(self._storage_path('moved/a.deb'),
+                          os.readlink(self._pool_path('main', 'a.deb')))
+        self.assertEquals(['a.deb', 'b.deb'], sorted(os.listdir(self._pool_path('main'))))
+
+    def test_pool_failed_publish(self):
+        self._publish(dict(main=self._entries('a.deb', 'b.deb')))
+        # A publish failing before prune() leaves no manifest
+        self.Module.Pool(self.root).update(dict(main=self._entries('c.deb')))
+        links, removed = self._publish(dict(main=self._entries('a.deb', 'd.deb')))
+        self.assertEquals([self._pool_path('main', 'd.deb')], links)
+        self.assertEquals(sorted(self._pool_path('main', name) for name in ('b.deb', 'c.deb')),
+                          sorted(removed))
+        self.assertEquals(['a.deb', 'd.deb'], sorted(os.listdir(self._pool_path('main'))))
+
+
+class TestWriteIndex(BaseTest):
+    def setUp(self):
+        super(TestWriteIndex, self).setUp()
+        self.package_files = self.Module.PackageFileStore(self.work_dir)
+
+    def _packages(self, *names):
+        offsets = []
+        for name in names:
+            filename = "%s_1.0_all.deb" % name
+            path = self.new_file(name=filename, contents=name).path
+            package = self.Module.PackageFile(
+                path, 'Package: %s\n' % name, len(name),
+                dict(md5='01', sha1='02', sha256='03', sha512='04'), filename)
+            offsets.append(self.package_files.add(package))
+        return ('pool/main', offsets)
+
+    def _job(self, packages, block_path=None):
+        release_dir = os.path.join(self.work_dir, 'dists', 'stable')
+        return (self.package_files.path, release_dir, 'main/binary-all/Packages',
+                packages, block_path, self.Module.compression.IndexCompression.create())
+
+    def test_map_jobs(self):
+        self.assertEquals([1, 4, 9], self.Module.map_jobs(_square, [1, 2, 3], 1))
+        self.assertEquals([1, 4, 9], self.Module.map_jobs(_square, [1, 2, 3], 2))
+        self.assertEquals([], self.Module.map_jobs(_square, [], 4))
+
+    def test_package_files(self):
+        packages = self._packages('foo', 'bar')
+        self.package_files.close()
+        self.assertEquals(['bar', 'foo'], [
+            stanza.unit.control.split()[1] for stanza in self.Module.package_stanzas(
+                self.package_files.path, (packages[0], list(reversed(packages[1]))))])
+        self.package_files.remove()
+        self.assertFalse(os.path.exists(self.package_files.dir))
+
+    def test_write_index(self):
+        job = self._job(self._packages('foo'))
+        self.package_files.close()
+        checksums = self.Module.write_index(job)
+        path = os.path.join(job[1], job[2])
+        stanza = deb822.Packages(open(path, 'rb').read())
+        self.assertEquals('foo', stanza['Package'])
+        self.assertEquals('pool/main/foo_1.0_all.deb', stanza['Filename'])
+        self.assertEquals('04', stanza['SHA512'])
+        self.assertEquals(hashlib.sha256(open(path, 'rb').read()).hexdigest(),
+                          [x['sha256'] for x in checksums['SHA256']
+                           if x['name'] == job[2]][0])
+
+    def test_write_index_block(self):
+        block_path = self.package_files.new_path('all')
+        all_packages = self._packages('bar', 'baz')
+        job = self._job(self._packages('foo'), block_path)
+        self.package_files.close()
+        self.Module.render_stanzas((self.package_files.path, all_packages, block_path))
+        with open(block_path, 'rb') as fobj:
+            self.assertEquals(['bar', 'baz'],
+                              [p['Package'] for p in deb822.Packages.iter_paragraphs(fobj)])
+        self.Module.write_index(job)
+        with open(os.path.join(job[1], job[2]), 'rb') as fobj:
+            self.assertEquals(['foo', 'bar', 'baz'],
+                              [p['Package'] for p in deb822.Packages.iter_paragraphs(fobj)])
+
+
+def _square(x):
+    return x * x
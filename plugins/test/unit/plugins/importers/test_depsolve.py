@@ -0,0 +1,133 @@
+import mock
+
+from .... import testbase
+from pulp_deb.plugins.db import models
+from pulp_deb.plugins.importers import depsolve
+
+
+def rel(name, flag=None, version=None):
+    ret = dict(name=name)
+    if flag is not None:
+        ret.update(flag=flag, version=version)
+    return ret
+
+
+class TestDependencyResolver(testbase.TestCase):
+    def _package(self, name, version='1', architecture='amd64', **kwargs):
+        return models.DebPackage(name=name, version=version, architecture=architecture,
+                                 id='%s-%s-%s' % (name, version, architecture), **kwargs)
+
+    def _resolver(self, packages):
+        resolver = depsolve.DependencyResolver('repo1')
+        resolver._unit_ids = set(p.id for p in packages)
+        resolver._architectures = sorted(
+            set(p.architecture for p in packages if p.architecture != 'all'))
+
+        def lookup(names):
+            for name in names:
+                candidates = resolver._candidates.setdefault(name, [])
+                if candidates:
+                    continue
+                for p in packages:
+                    if p.name == name:
+                        candidates.append((p, p.version))
+                    for provided in depsolve.relations(p, ['provides']):
+                        if provided[0]['name'] == name:
+                            candidates.append((p, provided[0].get('version')))
+        resolver._lookup = lookup
+        return resolver
+
+    def test_version_matches(self):
+        self.assertTrue(depsolve.version_matches(rel('a'), None))
+        self.assertTrue(depsolve.version_matches(rel('a', 'GE', '1.0'), '1.0-1'))
+        self.assertTrue(depsolve.version_matches(rel('a', 'LT', '1.0'), '1.0~rc1'))
+        self.assertFalse(depsolve.version_matches(rel('a', 'GT', '1:0.5'), '2.0'))
+        self.assertFalse(depsolve.version_matches(rel('a', 'EQ', '1.0'), None))
+
+    def test_resolve(self):
+        app = self._package('app', depends=[rel('lib', 'GE', '2'), [rel('mta'), rel('exim')]],
+                            pre_depends=[rel('base')])
+        lib1 = self._package('lib', '1')
+        lib2 = self._package('lib', '2', depends=[rel('base')])
+        lib3 = self._package('lib', '3', architecture='i386')
+        exim = self._package('exim', provides=[rel('mta')])
+        base = self._package('base', architecture='all')
+        resolver = self._resolver([app, lib1, lib2, lib3, exim, base])
+        self.assertEquals(set([app, lib2, exim, base]), set(resolver.resolve([app])))
+        self.assertEquals([], resolver.unresolved)
+
+    def test_resolve_arch_all(self):
+        app = self._package('app', architecture='all', depends=[rel('lib'), rel('data')])
+        lib1 = self._package('lib', '1')
+        lib2 = self._package('lib', '2')
+        lib1_i386 = self._package('lib', '1', architecture='i386')
+        data = self._package('data', architecture='all')
+        resolver = self._resolver([app, lib1, lib2, lib1_i386, data])
+        # The best candidate of every architecture of the repository
+        self.assertEquals(set([app, lib2, lib1_i386, data]), set(resolver.resolve([app])))
+        self.assertEquals([], resolver.unresolved)
+
+    def test_resolve_arch_all_unresolved(self):
+        app = self._package('app', architecture='all', depends=[rel('lib')])
+        lib = self._package('lib', '1')
+        other = self._package('other', '1', architecture='i386')
+        resolver = self._resolver([app, lib, other])
+        self.assertEquals(set([app, lib]), set(resolver.resolve([app])))
+        # Reported once, although only i386 lacks it
+        self.assertEquals([(app, [rel('lib')])], resolver.unresolved)
+
+    def test_resolve_prefers_selected(self):
+        app = self._package('app', depends=[rel('lib')])
+        lib1 = self._package('lib', '1')
+        lib2 = self._package('lib', '2')
+        resolver = self._resolver([app, lib1, lib2])
+        self.assertEquals(set([app, lib1]), set(resolver.resolve([app, lib1])))
+
+    def test_resolve_unresolved(self):
+        app = self._package('app', depends=[rel('missing'), rel('lib', 'GT', '1')],
+                            pre_depends='base (>= 1)')
+        lib = self._package('lib', '1')
+        base = self._package('base', '2')
+        resolver = self._resolver([app, lib, base])
+        self.assertEquals(set([app, base]), set(resolver.resolve([app])))
+        self.assertEquals([(app, [rel('missing')]), (app, [rel('lib', 'GT', '1')])],
+                          resolver.unresolved)
+
+    @mock.patch.object(models.DebPackage, 'objects')
+    def test_lookup(self, _objects):
+        lib = self._package('lib')
+        exim = self._package('exim', provides=[rel('mta')])
+        _objects.filter.side_effect = lambda **kw: mock.MagicMock(**{
+            'only.return_value': [lib] if 'name__in' in kw else [exim]})
+        resolver = depsolve.DependencyResolver('repo1')
+        resolver._unit_ids = set([lib.id, exim.id])
+        resolver._lookup(['lib', 'mta'])
+        self.assertEquals([(lib, '1')], resolver._candidates['lib'])
+        self.assertEquals([(exim, None)], resolver._candidates['mta'])
+        resolver._lookup(['lib'])
+        self.assertEquals(2, _objects.filter.call_count)
+        # Only the packages of the repository are queried
+        for args, kwargs in _objects.filter.call_args_list:
+            self.assertEquals(resolver._unit_ids, set(kwargs['id__in']))
+
+    @mock.patch.object(depsolve, 'UNIT_ID_CHUNK_SIZE', 2)
+    @mock.patch.object(models.DebPackage, 'objects')
+    def test_lookup_chunks(self, _objects):
+        _objects.filter.return_value.only.return_value = []
+        resolver = depsolve.DependencyResolver('repo1')
+        resolver._unit_ids = set(['a', 'b', 'c'])
+        resolver._lookup(['lib'])
+        self.assertEquals(4, _objects.filter.call_count)
+        queried = [set(kwargs['id__in']) for args, kwargs in _objects.filter.call_args_list]
+        self.assertEquals(resolver._unit_ids, queried[0] | queried[1])
+
+    @mock.patch.object(models.DebPackage, 'objects')
+    def test_architectures(self, _objects):
+        _objects.filter.return_value.distinct.return_value = ['all', 'i386', 'amd64']
+        resolver = depsolve.DependencyResolver('repo1')
+        resolver._unit_ids = set(['a', 'b'])
+        self.assertEquals(['amd64', 'i386'], resolver.architectures)
+        _objects.filter.assert_called_once_with(id__in=mock.ANY)
+        _objects.filter.return_value.distinct.return_value = ['all']
+        resolver._architectures = None
+        self.assertEquals(['all'], resolver.architectures)
@@ -4,14 +4,19 @@ Contains tests for pulp_deb.plugins.importers.importer.
 from gettext import gettext as _
 import json
 import os
+import shutil
+import tarfile
 
 import mock
+from pulp.plugins.config import PluginCallConfiguration
 
-from pulp_deb.common import ids
+from pulp_deb.common import constants, ids
 from .... import testbase
 from pulp_deb.plugins.db import models
 from pulp_deb.plugins.importers import importer
 
+DATA_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), '../../../data'))
+
 
 class TestEntryPoint(testbase.TestCase):
     """
@@ -39,6 +44,12 @@ class ModelMixIn(object):
             checksum,
             self.__class__.Model._compute_checksum(open(file_path)))
 
+    def test__compute_checksums(self):
+        file_path, checksum = self.new_file()
+        checksums = self.__class__.Model._compute_checksums(open(file_path, 'rb'))
+        self.assertEquals(set(self.__class__.Model.DIGESTS), set(checksums))
+        self.assertEquals(checksum, checksums['sha256'])
+
     def test_filename_from_unit_key(self):
         unit_key = dict(name="aaa", version="1", architecture="x86_64",
                         checksumtype="sha256", checksum="decafbad",
@@ -73,9 +84,11 @@ class TestDebImporter(testbase.TestCase):
     """
     This class contains tests for the DebImporter class.
     """
+    @mock.patch("pulp_deb.plugins.importers.importer.bulk.associate_units")
     @mock.patch("pulp_deb.plugins.importers.importer.platform_models")
     @mock.patch("pulp_deb.plugins.db.models.repo_controller")
-    def test_import_units_units_none(self, _repo_controller, _platform_models):
+    def test_import_units_units_none(self, _repo_controller, _platform_models,
+                                     _associate_units):
         """
         Assert correct behavior when units == None.
         """
@@ -85,12 +98,12 @@ class TestDebImporter(testbase.TestCase):
                                                                dst_repo]
         Deb = models.DebPackage
         units = [
-            Deb(name="unit_a", version="1"),
-            Deb(name="unit_b", version="1"),
-            Deb(name="unit_3", version="1"),
+            Deb(name="unit_a", version="1", id="a"),
+            Deb(name="unit_b", version="1", id="b"),
+            Deb(name="unit_3", version="1", id="3"),
         ]
 
-        _repo_controller.find_repo_content_units.return_value = units
+        _repo_controller.find_repo_content_units.return_value = iter(units)
 
         pulpimp = importer.DebImporter()
         import_conduit = mock.MagicMock()
@@ -98,27 +111,25 @@ class TestDebImporter(testbase.TestCase):
         imported_units = pulpimp.import_units(mock.MagicMock(),
                                               mock.MagicMock(),
                                               import_conduit,
-                                              mock.MagicMock(),
+                                              PluginCallConfiguration({}, {}),
                                               units=None)
 
+        # Units are associated as they are read
+        self.assertEqual(0, _associate_units.call_count)
+        imported_units = list(imported_units)
         # Assert that the correct criteria was used
         _repo_controller.find_repo_content_units.assert_called_once_with(
             src_repo, yield_content_unit=True)
-        # Assert that the units were associated correctly
-        _u = sorted(units)
-        self.assertEquals(
-            [
-                mock.call(repository=dst_repo, unit=_u[0]),
-                mock.call(repository=dst_repo, unit=_u[1]),
-                mock.call(repository=dst_repo, unit=_u[2]),
-            ],
-            _repo_controller.associate_single_unit.call_args_list)
-        self.assertEqual(imported_units, sorted(units))
+        # Assert that the units were associated in bulk
+        _associate_units.assert_called_once_with(dst_repo, units)
+        self.assertEqual(imported_units, units)
 
+    @mock.patch.object(models.DebRelease, "copy_to")
+    @mock.patch("pulp_deb.plugins.importers.importer.bulk")
     @mock.patch("pulp_deb.plugins.importers.importer.platform_models")
     @mock.patch("pulp_deb.plugins.db.models.repo_controller")
     def test_import_units_units_not_none(self, _repo_controller,
-                                         _platform_models):
+                                         _platform_models, _bulk, _copy_to):
         """
         Assert correct behavior when units != None.
         """
@@ -126,35 +137,62 @@ class TestDebImporter(testbase.TestCase):
         dst_repo = mock.MagicMock()
         _platform_models.Repository.objects.get.side_effect = [src_repo,
                                                                dst_repo]
+        _bulk.chunks.side_effect = lambda units: iter([units[:2], units[2:]])
         pulpimp = importer.DebImporter()
         import_conduit = mock.MagicMock()
         Deb = models.DebPackage
         units = [
-            Deb(name="unit_a", version="1"),
-            Deb(name="unit_b", version="1"),
-            Deb(name="unit_3", version="1"),
+            Deb(name="unit_a", version="1", id="a"),
+            models.DebRelease(codename='stable', repoid='src', id='r'),
+            Deb(name="unit_3", version="1", id="3"),
+            Deb(name="unit_a", version="1", id="a"),
         ]
 
-        imported_units = pulpimp.import_units(mock.MagicMock(),
-                                              mock.MagicMock(),
-                                              import_conduit,
-                                              mock.MagicMock(),
-                                              units=units)
+        imported_units = list(pulpimp.import_units(mock.MagicMock(),
+                                                   mock.MagicMock(),
+                                                   import_conduit,
+                                                   PluginCallConfiguration({}, {}),
+                                                   units=units))
 
         # Assert that no criteria was used
         self.assertEqual(
             0, _repo_controller.find_repo_content_units.call_count)
-        # Assert that the units were associated correctly
-        _u = sorted(units)
+        # Assert that the units were associated correctly, once each, and
+        # that the release was copied into the destination repository
+        _copy_to.assert_called_once_with(dst_repo)
         self.assertEquals(
             [
-                mock.call(repository=dst_repo, unit=_u[0]),
-                mock.call(repository=dst_repo, unit=_u[1]),
-                mock.call(repository=dst_repo, unit=_u[2]),
+                mock.call(dst_repo, [units[0], _copy_to.return_value]),
+                mock.call(dst_repo, [units[2]]),
             ],
-            _repo_controller.associate_single_unit.call_args_list)
+            _bulk.associate_units.call_args_list)
         # Assert that the units were returned
-        self.assertEqual(imported_units, sorted(units))
+        self.assertEqual(imported_units, units[:3])
+
+    @mock.patch.object(models.DebRelease, "copy_to")
+    @mock.patch("pulp_deb.plugins.importers.importer.bulk.associate_units")
+    @mock.patch("pulp_deb.plugins.importers.importer.depsolve.DependencyResolver")
+    @mock.patch("pulp_deb.plugins.importers.importer.platform_models")
+    def test_import_units_recursive(self, _platform_models, _Resolver, _associate_units,
+                                    _copy_to):
+        src_repo = mock.MagicMock(repo_id='src')
+        dst_repo = mock.MagicMock()
+        _platform_models.Repository.objects.get.side_effect = [src_repo, dst_repo]
+        Deb = models.DebPackage
+        units = [Deb(name="unit_a", version="1", id='a'),
+                 models.DebRelease(codename='stable', repoid='src', id='r')]
+        dependency = Deb(name="unit_b", version="1", id='b')
+        _Resolver.return_value.resolve.return_value = [units[0], dependency]
+        config = PluginCallConfiguration({}, {constants.CONFIG_RECURSIVE: True})
+
+        imported_units = list(importer.DebImporter().import_units(
+            mock.MagicMock(), mock.MagicMock(), mock.MagicMock(), config, units=units))
+
+        _Resolver.assert_called_once_with('src')
+        _Resolver.return_value.resolve.assert_called_once_with([units[0]])
+        _associate_units.assert_called_once_with(
+            dst_repo, [units[0], dependency, _copy_to.return_value])
+        self.assertEqual([units[0], dependency, units[1]], imported_units)
 
     def test_metadata(self):
         """
@@ -236,6 +274,96 @@ class TestDebImporter(testbase.TestCase):
                           ),
                           'summary': ''})
 
+    @mock.patch("pulp_deb.plugins.storage.pulp_config")
+    @mock.patch("pulp_deb.plugins.importers.importer.bulk")
+    @mock.patch("pulp_deb.plugins.importers.importer.units_controller")
+    @mock.patch("pulp_deb.plugins.importers.importer.plugin_api")
+    def test_upload_unit_archive(self, _plugin_api, _units_controller, _bulk,
+                                 _pulp_config):
+        _pulp_config.get.return_value = os.path.join(self.work_dir, 'storage')
+        _plugin_api.get_unit_model_by_id.return_value = models.DebPackage
+        _units_controller.find_units.return_value = []
+        _bulk.insert_units.side_effect = lambda model, units: units
+        deb_path = os.path.join(DATA_DIR, "nscd_2.24-7ubuntu2_amd64.deb")
+        bad_path = self.new_file('bad.deb').path
+        archive_path = os.path.join(self.work_dir, 'build.tar')
+        with tarfile.open(archive_path, 'w') as archive:
+            archive.add(deb_path, 'amd64/nscd.deb')
+            # The same package twice is only uploaded once
+            archive.add(deb_path, 'i386/nscd.deb')
+            archive.add(bad_path, 'bad.deb')
+        repo = mock.MagicMock(repo_id='repo1')
+
+        report = importer.DebImporter().upload_unit(
+            mock.MagicMock(repo_obj=repo), ids.TYPE_ID_DEB, {}, {},
+            archive_path, mock.MagicMock(),
+            {'storage_layout': 'sha256', 'processes': 2})
+
+        self.assertEquals(False, report['success_flag'])
+        self.assertEquals('1 packages uploaded, 1 failed', report['summary'])
+        self.assertEquals(['bad.deb: Not an ar archive'], report['details']['errors'])
+        self.assertEquals(['nscd'], [u['name'] for u in report['details']['units']])
+        [units] = _bulk.insert_units.call_args[0][1:]
+        self.assertEquals(['nscd'], [u.name for u in units])
+        _bulk.associate_units.assert_called_once_with(repo, units)
+        # The file is in place, without staged copies next to it
+        self.assertEquals(units[0].checksum, models.DebPackage._compute_checksum(
+            open(units[0]._storage_path, 'rb')))
+        self.assertEquals([os.path.basename(units[0]._storage_path)],
+                          os.listdir(os.path.dirname(units[0]._storage_path)))
+        # The extracted files are cleaned up
+        self.assertEquals([], [x for x in os.listdir(self.work_dir) if x.startswith('tmp')])
+
+    def _upload_paths(self):
+        path = os.path.join(self.work_dir, 'upload.deb')
+        shutil.copy(os.path.join(DATA_DIR, "nscd_2.24-7ubuntu2_amd64.deb"), path)
+        return [path]
+
+    @mock.patch("pulp_deb.plugins.storage.pulp_config")
+    @mock.patch("pulp_deb.plugins.importers.importer.bulk")
+    @mock.patch("pulp_deb.plugins.importers.importer.units_controller")
+    def test_upload_units_insert_fails(self, _units_controller, _bulk, _pulp_config):
+        _pulp_config.get.return_value = os.path.join(self.work_dir, 'storage')
+        _units_controller.find_units.return_value = []
+        _bulk.insert_units.side_effect = RuntimeError('connection lost')
+        paths = self._upload_paths()
+
+        with self.assertRaises(RuntimeError):
+            importer.DebImporter().upload_units(
+                mock.MagicMock(), paths, {'storage_layout': 'sha256'})
+
+        # Nothing is left in the storage and the upload is where it was
+        [unit] = _bulk.insert_units.call_args[0][1]
+        self.assertEquals([], os.listdir(os.path.dirname(unit._storage_path)))
+        self.assertTrue(os.path.exists(paths[0]))
+        self.assertEquals(0, _bulk.associate_units.call_count)
+
+    @mock.patch("pulp_deb.plugins.storage.pulp_config")
+    @mock.patch("pulp_deb.plugins.importers.importer.bulk")
+    @mock.patch("pulp_deb.plugins.importers.importer.units_controller")
+    def test_upload_units_concurrent(self, _units_controller, _bulk, _pulp_config):
+        _pulp_config.get.return_value = os.path.join(self.work_dir, 'storage')
+        _units_controller.find_units.return_value = []
+        winner = mock.MagicMock()
+
+        def insert_units(model, units):
+            # Another upload stores the same unit first
+            self.new_file(units[0]._storage_path, contents='winner')
+            return [winner]
+        _bulk.insert_units.side_effect = insert_units
+        repo = mock.MagicMock(repo_id='repo1')
+
+        report = importer.DebImporter().upload_units(
+            repo, self._upload_paths(), {'storage_layout': 'sha256'})
+
+        self.assertEquals(True, report['success_flag'])
+        _bulk.associate_units.assert_called_once_with(repo, [winner])
+        # The file of the stored unit is kept
+        [unit] = _bulk.insert_units.call_args[0][1]
+        self.assertEquals('winner', open(unit._storage_path).read())
+        self.assertEquals([os.path.basename(unit._storage_path)],
+                          os.listdir(os.path.dirname(unit._storage_path)))
+
     def test_validate_config(self):
         """
         There is no config, so we'll just assert that validation passes.
@@ -245,6 +373,44 @@ class TestDebImporter(testbase.TestCase):
 
         self.assertEqual(return_value, (True, None))
 
+    def test_validate_config_import_method(self):
+        pulpimp = importer.DebImporter()
+        self.assertEqual(
+            (True, None),
+            pulpimp.validate_config(mock.MagicMock(), {'import_method': 'reflink'}))
+        self.assertEqual(
+            (False, 'Configuration errors:\n'
+                    'The configuration parameter <import_method> must be one of:'
+                    ' link, reflink, copy'),
+            pulpimp.validate_config(mock.MagicMock(), {'import_method': 'teleport'}))
+
+    def test_validate_config_processes(self):
+        pulpimp = importer.DebImporter()
+        self.assertEqual(
+            (True, None), pulpimp.validate_config(mock.MagicMock(), {'processes': '4'}))
+        for processes in (0, 'many'):
+            self.assertEqual(
+                (False, 'Configuration errors:\n'
+                        'The configuration parameter <processes> must be a positive integer'),
+                pulpimp.validate_config(mock.MagicMock(), {'processes': processes}))
+
+    def test_validate_config_storage_layout(self):
+        pulpimp = importer.DebImporter()
+        self.assertEqual(
+            (True, None),
+            pulpimp.validate_config(mock.MagicMock(),
+                                    {'storage_layout': 'sha256', 'storage_fanout': 3}))
+        self.assertEqual(
+            (False, 'Configuration errors:\n'
+                    'The configuration parameter <storage_layout> must be one of:'
+                    ' default, sha256'),
+            pulpimp.validate_config(mock.MagicMock(), {'storage_layout': 'md5'}))
+        self.assertEqual(
+            (False, 'Configuration errors:\n'
+                    'The configuration parameter <storage_fanout> must be an integer'
+                    ' between 1 and 8'),
+            pulpimp.validate_config(mock.MagicMock(), {'storage_fanout': 'deep'}))
+
     @mock.patch("pulp_deb.plugins.importers.importer.sync.RepoSync")
     def test_sync(self, _RepoSync):
         # Basic test to make sure we're passing information correctly into
@@ -12,6 +12,8 @@ from .... import testbase
 
 from pulp_deb.common import constants
 from pulp_deb.common import ids
+from pulp_deb.plugins import storage
+from pulp_deb.plugins.db import models
 from pulp_deb.plugins.importers import sync
 
 
@@ -21,9 +23,10 @@ class _TestSyncBase(testbase.TestCase):
 
         self.repo = RepositoryModel('repo1')
         self.conduit = mock.MagicMock()
+        self.conduit.get_scratchpad.return_value = None
         self.conduit.get_units.return_value = [
             Namespace(type_id=ids.TYPE_ID_DEB_RELEASE),
-            Namespace(type_id=ids.TYPE_ID_DEB_COMP),
+            Namespace(type_id=ids.TYPE_ID_DEB_COMP, id='compid'),
             Namespace(type_id=ids.TYPE_ID_DEB),
         ]
         plugin_config = {
@@ -62,11 +65,9 @@ SHA256:
         # make sure the children are present
         step_ids = [child.step_id for child in self.step.children]
         expected_step_ids = [
-            constants.SYNC_STEP_RELEASE_DOWNLOAD,
-            constants.SYNC_STEP_RELEASE_PARSE,
-            constants.SYNC_STEP_PACKAGES_DOWNLOAD,
-            constants.SYNC_STEP_PACKAGES_PARSE,
+            constants.SYNC_STEP_RELEASES,
             'get_local',
+            constants.SYNC_STEP_PLAN,
             constants.SYNC_STEP_UNITS_DOWNLOAD_REQUESTS,
             constants.SYNC_STEP_UNITS_DOWNLOAD,
             constants.SYNC_STEP_SAVE,
@@ -77,24 +78,34 @@ SHA256:
         self.assertEquals(expected_step_ids, step_ids)
         self.assertEquals(self.remove_missing, self.step.conduit.get_units.called)
 
+    @mock.patch('pulp_deb.plugins.importers.sync.ReleasePipeline.parse_packages')
+    @mock.patch('pulp_deb.plugins.importers.sync.SyncReleasesStep.download')
     @mock.patch('pulp_deb.plugins.importers.sync.models.DebComponent')
     @mock.patch('pulp_deb.plugins.importers.sync.models.DebRelease')
-    def test_ParseReleaseStep(self, _DebRelease, _DebComponent):
-        step = self.step.children[1]
-        self.assertEquals(constants.SYNC_STEP_RELEASE_PARSE, step.step_id)
+    def test_SyncReleasesStep(self, _DebRelease, _DebComponent, _download,
+                              _parse_packages):
+        step = self.step.children[0]
+        self.assertEquals(constants.SYNC_STEP_RELEASES, step.step_id)
         self.step.deb_releases_to_check = mock.MagicMock()
         self.step.deb_comps_to_check = mock.MagicMock()
+        _download.return_value = []
         step.process_lifecycle()
 
+        release_dls, packages_dls = [x[0][0] for x in _download.call_args_list]
+        self.assertEquals(
+            ['http://example.com/deb/dists/stable/Release',
+             'http://example.com/deb/dists/stable/Release.gpg'],
+            [x.url for x in release_dls])
         # Make sure we got a request for the best compression
         self.assertEquals(
             ['http://example.com/deb/dists/stable/main/binary-amd64/Packages.bz2'],
-            [x.url for x in self.step.step_download_Packages.downloads])
+            [x.url for x in packages_dls])
         self.assertEquals(
             [os.path.join(
                 self.pulp_working_dir,
                 'worker01/aabb/dists/foo/main/binary-amd64/Packages.bz2')],
-            [x.destination for x in self.step.step_download_Packages.downloads])
+            [x.destination for x in packages_dls])
+        _parse_packages.assert_called_once()
         # apt_repo_meta is set as a side-effect
         self.assertEquals(
             ['amd64'],
@@ -104,6 +115,55 @@ SHA256:
         self.step.deb_releases_to_check.remove.assert_called_once()
         self.step.deb_comps_to_check.remove.assert_called_once()
 
+    @mock.patch('pulp_deb.plugins.importers.sync.SyncReleasesStep.download')
+    def test_SyncReleasesStep_failed_Packages_download(self, _download):
+        pipeline = sync.ReleasePipeline(self.step.children[0], 'stable')
+        pipeline.repometa = mock.MagicMock()
+        pipeline.repometa.create_Packages_download_requests.return_value = [
+            mock.MagicMock(url='http://example.com/Packages.bz2',
+                           data=dict(component='main', architecture='amd64'))]
+        _download.return_value = [mock.MagicMock(url='http://example.com/Packages.bz2')]
+        with self.assertRaises(Exception) as ctx:
+            pipeline.download_packages()
+        self.assertEquals('Failed to download http://example.com/Packages.bz2',
+                          str(ctx.exception))
+
+    @mock.patch('pulp_deb.plugins.importers.sync.HTTPThreadedDownloader')
+    def test_SyncReleasesStep_download_progress(self, _Downloader):
+        step = self.step.children[0]
+        ok, failed = mock.MagicMock(), mock.MagicMock()
+
+        def download(requests):
+            downloader.event_listener.download_succeeded(ok)
+            downloader.event_listener.download_failed(failed)
+
+        downloader = _Downloader.return_value
+        downloader.download.side_effect = download
+        self.assertEquals([failed], step.download(['Release', 'Release.gpg']))
+        self.assertEquals(2, step.total_units)
+        self.assertEquals(1, step.progress_successes)
+        self.assertEquals(1, step.progress_failures)
+        self.assertEquals([], step._downloaders)
+
+    @mock.patch('pulp_deb.plugins.importers.sync.ReleasePipeline.parse_packages')
+    @mock.patch('pulp_deb.plugins.importers.sync.HTTPThreadedDownloader')
+    @mock.patch('pulp_deb.plugins.importers.sync.models.DebRelease')
+    def test_SyncReleasesStep_cancel(self, _DebRelease, _Downloader, _parse_packages):
+        step = self.step.children[0]
+        downloader = _Downloader.return_value
+        downloader.download.side_effect = lambda requests: step.cancel()
+        step.process_main()
+        self.assertTrue(step.canceled)
+        downloader.cancel.assert_called_once_with()
+        # The pipeline stops after the Release download
+        self.assertEquals(1, downloader.download.call_count)
+        self.assertEquals(0, _DebRelease.get_or_create_and_associate.call_count)
+        self.assertEquals(0, _parse_packages.call_count)
+        self.assertEquals(None, self.step.apt_repo_meta.get('stable'))
+        # No download starts once the step is canceled
+        self.assertEquals([], step.download(['Packages']))
+        self.assertEquals(1, downloader.download.call_count)
+
     def _mock_repometa(self):
         repometa = self.step.apt_repo_meta['stable'] = mock.MagicMock(
             upstream_url="http://example.com/deb/dists/stable/")
@@ -120,22 +180,26 @@ SHA256:
         repometa.iter_component_arch_binaries.return_value = [comp_arch]
         return pkgs
 
-    def test_ParsePackagesStep(self):
+    def test_ReleasePipeline_parse_packages(self):
         pkgs = self._mock_repometa()
         dl1 = mock.MagicMock(destination="dest1")
         dl2 = mock.MagicMock(destination="dest2")
-        self.step.packages_urls['stable'] = set(
-            [u'http://example.com/deb/dists/stable/main/binary-amd64/Packages.bz2'])
-        self.step.step_download_Packages._downloads = [dl1, dl2]
-        self.step.component_packages['stable']['main'] = []
-        step = self.step.children[3]
-        self.assertEquals(constants.SYNC_STEP_PACKAGES_PARSE, step.step_id)
-        step.process_lifecycle()
-
+        step = self.step.children[0]
+        pipeline = sync.ReleasePipeline(step, 'stable')
+        pipeline.repometa = self.step.apt_repo_meta['stable']
+        pipeline.component_packages['main'] = []
+        pipeline.parse_packages([dl1, dl2])
+        pipeline.repometa.validate_component_arch_packages_downloads.assert_called_once_with(
+            [dl1, dl2])
+
+        step.join([pipeline])
         self.assertEquals(
             set([x['SHA256'] for x in pkgs]),
             set([x.checksum for x in self.step.available_units]))
         self.assertEquals(len(self.step.component_packages['stable']['main']), 2)
+        self.assertEquals(
+            dict((x['SHA256'], x['Filename']) for x in pkgs),
+            self.step.unit_relative_urls)
 
     @mock.patch('pulp_deb.plugins.importers.sync.misc.mkdir')
     def test_CreateRequestsUnitsToDownload(self, _mkdir):
@@ -145,7 +209,7 @@ SHA256:
         self.step.step_local_units.units_to_download = units
         self.step.unit_relative_urls = dict((p['SHA256'], p['Filename']) for p in pkgs)
 
-        step = self.step.children[5]
+        step = self.step.children[3]
         self.assertEquals(constants.SYNC_STEP_UNITS_DOWNLOAD_REQUESTS,
                           step.step_id)
         step.process_lifecycle()
@@ -181,17 +245,20 @@ SHA256:
             path = os.path.join(dest_dir, os.path.basename(pkg['Filename']))
             open(path, "wb")
             path_to_unit[path] = unit
-            unit._compute_checksum.return_value = unit.checksum
+            unit._compute_checksums.return_value = dict(sha256=unit.checksum, md5='00')
 
         self.step.step_download_units.path_to_unit = path_to_unit
 
-        step = self.step.children[7]
+        step = self.step.children[5]
         self.assertEquals(constants.SYNC_STEP_SAVE, step.step_id)
         step.process_lifecycle()
 
         repo = self.repo.repo_obj
         for path, unit in path_to_unit.items():
-            unit.save_and_associate.assert_called_once_with(path, repo)
+            self.assertEquals(dict(sha256=unit.checksum, md5='00'), unit.checksums)
+            unit.save_and_associate.assert_called_once_with(
+                path, repo, import_methods=[storage.IMPORT_MOVE],
+                storage_layout=None)
 
     def test_SaveDownloadedUnits_bad_checksum(self):
         self.repo.repo_obj = mock.MagicMock(repo_id=self.repo.id)
@@ -203,12 +270,12 @@ SHA256:
         open(path, "wb")
 
         unit = mock.MagicMock(checksum="00aa")
-        unit._compute_checksum.return_value = "AABB"
+        unit._compute_checksums.return_value = dict(sha256="AABB")
         path_to_unit = {path: unit}
 
         self.step.step_download_units.path_to_unit = path_to_unit
 
-        step = self.step.children[7]
+        step = self.step.children[5]
         self.assertEquals(constants.SYNC_STEP_SAVE, step.step_id)
         with self.assertRaises(exceptions.PulpCodedTaskFailedException) as ctx:
             step.process_lifecycle()
@@ -217,46 +284,331 @@ SHA256:
             ' mismatching checksums for file.deb: expected 00aa, actual AABB',
             str(ctx.exception))
 
+    def _mock_plan_units(self, units_to_repair=()):
+        patcher = mock.patch('pulp_deb.plugins.importers.sync.find_units_to_repair',
+                             return_value=list(units_to_repair))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.step.available_units = [
+            mock.MagicMock(size=1000, unit_key=dict(
+                name=x, version='1-1', architecture='amd64',
+                checksumtype='sha256', checksum='00' + x))
+            for x in ['a', 'b', 'c']]
+        self.step.step_local_units.units_to_download = self.step.available_units[1:]
+        self.step.debs_to_check = [
+            mock.MagicMock(unit_key=self.step.available_units[0].unit_key),
+            mock.MagicMock(unit_key=dict(
+                name='gone', version='1-1', architecture='amd64',
+                checksumtype='sha256', checksum='00gone')),
+        ]
+
+    def test_PlanSync(self):
+        self._mock_plan_units()
+        self.step.get_config().repo_plugin_config[constants.CONFIG_MAX_SPEED] = 100
+        step = self.step.children[2]
+        self.assertEquals(constants.SYNC_STEP_PLAN, step.step_id)
+        step.process_lifecycle()
+        self.assertEquals(
+            dict(units_to_download=2, bytes_to_download=2000, units_to_orphan=2,
+                 estimated_duration=20, free_space_sufficient=True),
+            self.step.sync_plan)
+
+    def test_PlanSync_measured_throughput(self):
+        self._mock_plan_units()
+        self.conduit.get_scratchpad.return_value = {sync.SCRATCHPAD_THROUGHPUT: 400.0}
+        self.step.children[2].process_lifecycle()
+        self.assertEquals(5, self.step.sync_plan['estimated_duration'])
+
+    @mock.patch('pulp_deb.plugins.importers.sync.time.time')
+    def test_SaveDownloadedUnits_throughput(self, _time):
+        self.conduit.get_scratchpad.return_value = dict(other=1)
+        _time.return_value = 110
+        self.step.download_started = 100
+        self.step.children[5]._save_throughput([mock.MagicMock(size=1000),
+                                                mock.MagicMock(size=None)])
+        self.conduit.set_scratchpad.assert_called_once_with(
+            {'other': 1, sync.SCRATCHPAD_THROUGHPUT: 100.0})
+
+    def test_PlanSync_repair(self):
+        broken = mock.MagicMock(size=500)
+        self._mock_plan_units(units_to_repair=[broken])
+        self.step.children[2].process_lifecycle()
+        self.assertEquals(3, self.step.sync_plan['units_to_download'])
+        self.assertEquals(2500, self.step.sync_plan['bytes_to_download'])
+        self.assertIn(broken, self.step.step_local_units.units_to_download)
+
+    @mock.patch('pulp_deb.plugins.importers.sync.models.DebPackage.objects')
+    def test_find_units_to_repair(self, _objects):
+        units = [mock.MagicMock(checksum='00' + x, unit_key=dict(
+            name=x, version='1-1', architecture='amd64',
+            checksumtype='sha256', checksum='00' + x))
+            for x in ['a', 'b', 'c']]
+        _objects.filter.return_value.only.return_value = [
+            mock.MagicMock(unit_key=units[1].unit_key)]
+        self.assertEquals([units[1]], sync.find_units_to_repair(units, units[2:]))
+        _objects.filter.assert_called_once_with(downloaded=False, checksum__in=['00a', '00b'])
+
+    @mock.patch('pulp_deb.plugins.importers.sync.free_space_shortfalls')
+    def test_PlanSync_no_space(self, _shortfalls):
+        self._mock_plan_units()
+        _shortfalls.return_value = [('/var/lib/pulp', 4000, 10)]
+        step = self.step.children[2]
+        with self.assertRaises(exceptions.PulpCodedTaskFailedException) as ctx:
+            step.process_lifecycle()
+        self.assertEquals(
+            'Unable to sync repo1 from http://example.com/deb: insufficient disk'
+            ' space in /var/lib/pulp: 4000 bytes required, 10 bytes available',
+            str(ctx.exception))
+        # Downloads are renamed into the content storage on the same file
+        # system, so they only need space once
+        self.assertEquals(
+            [((self.step.get_working_dir(), 2000),)],
+            [tuple(x[0][0]) for x in _shortfalls.call_args_list])
+        self.assertFalse(self.step.sync_plan['free_space_sufficient'])
+
+    @mock.patch('pulp_deb.plugins.importers.sync.free_space_shortfalls')
+    def test_PlanSync_copy(self, _shortfalls):
+        self._mock_plan_units()
+        _shortfalls.return_value = []
+        self.step.import_methods = sync.get_import_methods('copy', False)
+        self.step.children[2].process_lifecycle()
+        # Downloads get copied into the content storage, and take up space twice
+        self.assertEquals(
+            [((self.step.get_working_dir(), 2000),
+              (os.path.join(self.pulp_dir, 'content'), 2000))],
+            [tuple(x[0][0]) for x in _shortfalls.call_args_list])
+
+    def test_get_import_methods(self):
+        self.assertEquals([storage.IMPORT_MOVE],
+                          sync.get_import_methods('link', False))
+        self.assertEquals([storage.IMPORT_HARDLINK, storage.IMPORT_REFLINK],
+                          sync.get_import_methods('link', True))
+        self.assertEquals([storage.IMPORT_REFLINK, storage.IMPORT_MOVE],
+                          sync.get_import_methods('reflink', False))
+        self.assertEquals([storage.IMPORT_REFLINK],
+                          sync.get_import_methods('reflink', True))
+        self.assertEquals(None, sync.get_import_methods('copy', False))
+
+    def test_free_space_shortfalls(self):
+        # Both paths live on the same file system, their requirements add up
+        missing_dir = os.path.join(self.work_dir, 'not', 'created')
+        stat = os.statvfs(self.work_dir)
+        available = stat.f_bavail * stat.f_frsize
+        self.assertEquals(
+            [], sync.free_space_shortfalls([(self.work_dir, 1), (missing_dir, 1)]))
+        shortfalls = sync.free_space_shortfalls(
+            [(self.work_dir, available), (missing_dir, available)])
+        self.assertEquals(1, len(shortfalls))
+        self.assertEquals((self.work_dir, 2 * available), shortfalls[0][:2])
+
     @mock.patch('pulp_deb.plugins.importers.sync.unit_key_to_unit')
     def test_SaveMetadata(self, _UnitKeyToUnit):
         self.step.component_units['stable']['main'] = mock.MagicMock()
         self.step.component_packages['stable']['main'] = [
             {'name': 'ape', 'version': '1.2a-4~exp', 'architecture': 'DNA'}]
         self.step.debs_to_check = mock.MagicMock()
-        _UnitKeyToUnit.return_value = mock.MagicMock()
-        step = self.step.children[8]
+        _UnitKeyToUnit.return_value = mock.MagicMock(id='apeid')
+        self.step.component_units['stable']['main'].get_packages.return_value = set(
+            ['apeid', 'oldid'])
+        step = self.step.children[6]
         self.assertEquals(constants.SYNC_STEP_SAVE_META, step.step_id)
         step.process_lifecycle()
         self.step.debs_to_check.remove.assert_called_once_with(
             _UnitKeyToUnit.return_value)
         _UnitKeyToUnit.assert_called_once_with(
             {'name': 'ape', 'version': '1.2a-4~exp', 'architecture': 'DNA'})
-
+        # Only the membership changes get written
+        comp_unit = self.step.component_units['stable']['main']
+        unit_ids = set([_UnitKeyToUnit.return_value.id])
+        if self.remove_missing:
+            comp_unit.set_packages.assert_called_once_with(unit_ids)
+            self.assertEquals(0, comp_unit.add_packages.call_count)
+        else:
+            # Existing members are neither written again nor removed
+            comp_unit.add_packages.assert_called_once_with(set())
+            self.assertEquals(0, comp_unit.set_packages.call_count)
+            self.assertEquals(0, comp_unit.remove_packages.call_count)
+        self.assertEquals(0, comp_unit.save.call_count)
+
+    @mock.patch('pulp_deb.plugins.importers.sync.ReleasePipeline.parse_packages')
+    @mock.patch('pulp_deb.plugins.importers.sync.SyncReleasesStep.download')
     @mock.patch('pulp_deb.plugins.importers.sync.models.DebComponent')
     @mock.patch('pulp_deb.plugins.importers.sync.models.DebRelease')
     @mock.patch('pulp_deb.plugins.importers.sync.gnupg.GPG')
-    def test_VerifySignature(self, _GPG, _DebRelease, _DebComponent):
+    def test_VerifySignature(self, _GPG, _DebRelease, _DebComponent, _download,
+                             _parse_packages):
         key_fpr = '0000111122223333444455556666777788889999AAAABBBBCCCCDDDDEEEEFFFF'
-        step = self.step.children[1]
-        self.assertEquals(constants.SYNC_STEP_RELEASE_PARSE, step.step_id)
+        step = self.step.children[0]
+        self.assertEquals(constants.SYNC_STEP_RELEASES, step.step_id)
         step.get_config().repo_plugin_config['require_signature'] = True
         step.get_config().repo_plugin_config['allowed_keys'] = key_fpr
+        _download.return_value = []
         step.process_lifecycle()
         self.assertEqual(_GPG.call_count, 2)
         _GPG.return_value.import_keys.assert_called_once()
         self.assertEqual(_GPG.return_value.export_keys.call_args, mock.call([key_fpr]))
         _GPG.return_value.verify_file.assert_called_once()
 
-    def test_OrphanRemoved(self):
+    @mock.patch('pulp_deb.plugins.importers.sync.models.DebComponentPackage')
+    def test_OrphanRemoved(self, _Membership):
         if self.remove_missing:
-            step = self.step.children[9]
+            step = self.step.children[7]
             self.assertEquals(constants.SYNC_STEP_ORPHAN_REMOVED_UNITS, step.step_id)
             self.step.conduit.remove_unit = mock.MagicMock()
+            _Membership.remove_dangling.return_value = 0
             step.process_lifecycle()
             self.assertEqual([mock.call(item) for item in self.conduit.get_units.return_value],
                              self.step.conduit.remove_unit.call_args_list)
+            # The memberships of removed components are dropped
+            removed = list(_Membership.remove_components.call_args[0][0])
+            self.assertEqual(['compid'], removed)
+            # and so are those of purged units
+            _Membership.remove_dangling.assert_called_once_with()
         else:
-            self.assertEqual(9, len(self.step.children))
+            self.assertEqual(7, len(self.step.children))
+
+
+class TestSyncDryRun(testbase.TestCase):
+    def setUp(self):
+        super(TestSyncDryRun, self).setUp()
+        self.repo = RepositoryModel('repo1')
+        self.conduit = mock.MagicMock()
+        self.conduit.get_scratchpad.return_value = None
+        plugin_config = {
+            importer_constants.KEY_FEED: 'http://example.com/deb',
+            constants.CONFIG_DRY_RUN: True,
+        }
+        self.config = PluginCallConfiguration({}, plugin_config)
+        self._task_current = mock.patch("pulp.server.managers.repo._common.task.current")
+        obj = self._task_current.__enter__()
+        obj.request.id = 'aabb'
+        worker_name = "worker01"
+        obj.request.configure_mock(hostname=worker_name)
+        os.makedirs(os.path.join(self.pulp_working_dir, worker_name))
+        self.step = sync.RepoSync(repo=self.repo,
+                                  conduit=self.conduit,
+                                  config=self.config)
+
+    def tearDown(self):
+        self._task_current.__exit__()
+
+    def test_init(self):
+        self.assertEquals(
+            [
+                constants.SYNC_STEP_RELEASES,
+                constants.SYNC_STEP_PLAN,
+            ],
+            [child.step_id for child in self.step.children])
+
+    @mock.patch('pulp_deb.plugins.importers.sync.free_space_shortfalls')
+    @mock.patch('pulp_deb.plugins.importers.sync.units_controller')
+    def test_PlanSync(self, _units_controller, _shortfalls):
+        units = self.step.available_units = [
+            mock.MagicMock(size=1000, unit_key=dict(
+                name=x, version='1-1', architecture='amd64',
+                checksumtype='sha256', checksum='00' + x))
+            for x in ['a', 'b']]
+        _units_controller.find_units.return_value = units[:1]
+        # Not enough space is reported, but does not fail a dry run
+        _shortfalls.return_value = [('/var/lib/pulp', 4000, 10)]
+        self.step.children[-1].process_lifecycle()
+        self.assertEquals(
+            dict(units_to_download=1, bytes_to_download=1000, units_to_orphan=0,
+                 estimated_duration=0, free_space_sufficient=False),
+            self.step.sync_plan)
+        self.assertEquals(0, self.conduit.get_units.call_count)
+
+
+class TestSyncLocalTree(testbase.TestCase):
+    def setUp(self):
+        super(TestSyncLocalTree, self).setUp()
+        self.tree = os.path.join(self.work_dir, 'mirror')
+        for release in ['stable', 'testing', 'incomplete']:
+            os.makedirs(os.path.join(self.tree, 'dists', release))
+            if release != 'incomplete':
+                open(os.path.join(self.tree, 'dists', release, 'Release'), 'w').close()
+        pool_dir = os.path.join(self.tree, 'pool', 'main')
+        os.makedirs(pool_dir)
+        self.pkgs = []
+        for name in ['a', 'b']:
+            path = os.path.join(pool_dir, '{0}_1-1_amd64.deb'.format(name))
+            with open(path, 'wb') as fobj:
+                fobj.write(name)
+            self.pkgs.append(path)
+
+        self.repo = RepositoryModel('repo1')
+        self.conduit = mock.MagicMock()
+        plugin_config = {
+            importer_constants.KEY_FEED: 'file://' + self.tree,
+        }
+        self.config = PluginCallConfiguration({}, plugin_config)
+        self._task_current = mock.patch("pulp.server.managers.repo._common.task.current")
+        obj = self._task_current.__enter__()
+        obj.request.id = 'aabb'
+        worker_name = "worker01"
+        obj.request.configure_mock(hostname=worker_name)
+        os.makedirs(os.path.join(self.pulp_working_dir, worker_name))
+        self.step = sync.RepoSync(repo=self.repo,
+                                  conduit=self.conduit,
+                                  config=self.config)
+
+    def tearDown(self):
+        self._task_current.__exit__()
+        super(TestSyncLocalTree, self).tearDown()
+
+    def test_init(self):
+        self.assertEquals(self.tree, self.step.local_tree)
+        self.assertEquals(['stable', 'testing'], self.step.releases)
+        self.assertEquals(
+            'file://' + os.path.join(self.tree, 'dists', 'stable', 'Release'),
+            self.step.release_urls['stable'])
+
+    def test_local_tree_path(self):
+        self.assertEquals('/srv/mirror', sync.local_tree_path('/srv/mirror'))
+        self.assertEquals('/srv/mirror', sync.local_tree_path('file:///srv/mirror'))
+        self.assertEquals(None, sync.local_tree_path('http://example.com/srv/mirror'))
+
+    def test_download(self):
+        dest = os.path.join(self.work_dir, 'Release')
+        requests = [
+            mock.MagicMock(url=self.step.release_urls['stable'], destination=dest),
+            mock.MagicMock(url=self.step.release_urls['stable'] + '.gpg',
+                           destination=dest + '.gpg'),
+        ]
+        failed = self.step.children[0].download(requests)
+        self.assertEquals(requests[1:], failed)
+        self.assertTrue(os.path.isfile(dest))
+
+    def test_CreateRequestsUnitsToDownload(self):
+        units = [mock.MagicMock(checksum=x) for x in ['00a', '00b']]
+        self.step.step_local_units.units_to_download = units
+        self.step.unit_relative_urls = {
+            '00a': 'pool/main/a_1-1_amd64.deb',
+            '00b': 'pool/main/b_1-1_amd64.deb',
+        }
+        step = self.step.children[3]
+        self.assertEquals(constants.SYNC_STEP_UNITS_DOWNLOAD_REQUESTS, step.step_id)
+        step.process_lifecycle()
+        self.assertEquals([], self.step.step_download_units.downloads)
+        self.assertEquals(dict(zip(self.pkgs, units)),
+                          self.step.step_download_units.path_to_unit)
+
+    def test_SaveDownloadedUnits(self):
+        self.repo.repo_obj = mock.MagicMock(repo_id=self.repo.id)
+        checksums = [sync.compute_checksums(x) for x in self.pkgs]
+        units = [mock.MagicMock(checksum=x['sha256']) for x in checksums]
+        self.step.step_download_units.path_to_unit = dict(zip(self.pkgs, units))
+        step = self.step.children[5]
+        self.assertEquals(constants.SYNC_STEP_SAVE, step.step_id)
+        step.process_lifecycle()
+        for path, unit, csums in zip(self.pkgs, units, checksums):
+            self.assertEquals(0, unit._compute_checksums.call_count)
+            self.assertEquals(set(models.DebPackage.DIGESTS), set(unit.checksums))
+            self.assertEquals(csums, unit.checksums)
+            unit.save_and_associate.assert_called_once_with(
+                path, self.repo.repo_obj,
+                import_methods=[storage.IMPORT_HARDLINK, storage.IMPORT_REFLINK],
+                storage_layout=None)
 
 
 class TestSyncKeepMissing(_TestSyncBase):
@@ -0,0 +1,61 @@
+import hashlib
+import io
+import os
+import tarfile
+
+from debian import deb822
+
+from ... import testbase
+from pulp_deb.plugins import debstream
+
+DATA_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), '../../data'))
+
+
+def ar_member(name, data):
+    header = '%-16s%-12s%-6s%-6s%-8s%-10d`\n' % (name, 0, 0, 0, 100644, len(data))
+    return header + data + ('\n' if len(data) % 2 else '')
+
+
+def control_tar(control):
+    buf = io.BytesIO()
+    tar = tarfile.open(fileobj=buf, mode='w:gz')
+    info = tarfile.TarInfo('./control')
+    info.size = len(control)
+    tar.addfile(info, io.BytesIO(control))
+    tar.close()
+    return buf.getvalue()
+
+
+class TestReadPackage(testbase.TestCase):
+    control = 'Package: foo\nVersion: 1.0-1\nArchitecture: all\n'
+
+    def test_read_package(self):
+        path = os.path.join(DATA_DIR, "nscd_2.24-7ubuntu2_amd64.deb")
+        with open(path, 'rb') as fobj:
+            control, checksums, size = debstream.read_package(fobj, ['sha256', 'md5'])
+        self.assertEquals('nscd', deb822.Deb822(control)['Package'])
+        self.assertEquals(
+            '177937795c2ef5b381718aefe2981ada4e8cfe458226348d87a6f5b100a4612b',
+            checksums['sha256'])
+        with open(path, 'rb') as fobj:
+            self.assertEquals(hashlib.md5(fobj.read()).hexdigest(), checksums['md5'])
+        self.assertEquals(os.path.getsize(path), size)
+
+    def test_data_not_decompressed(self):
+        deb = ''.join([debstream.AR_MAGIC, ar_member('debian-binary', '2.0\n'),
+                       ar_member('control.tar.gz', control_tar(self.control)),
+                       ar_member('data.tar.xz', 'not really xz')])
+        control, checksums, size = debstream.read_package(io.BytesIO(deb))
+        self.assertEquals(self.control, control)
+        self.assertEquals(hashlib.sha256(deb).hexdigest(), checksums['sha256'])
+        self.assertEquals(len(deb), size)
+
+    def test_invalid(self):
+        no_control = debstream.AR_MAGIC + ar_member('debian-binary', '2.0\n')
+        truncated = no_control + ar_member('control.tar.gz', control_tar(self.control))[:-10]
+        for data, message in [('Not a package', 'Not an ar archive'),
+                              (no_control, 'No control.tar member found'),
+                              (truncated, 'Truncated package')]:
+            with self.assertRaises(debstream.Error) as cm:
+                debstream.read_package(io.BytesIO(data))
+            self.assertEquals(message, str(cm.exception))
@@ -0,0 +1,159 @@
+import os
+
+import mock
+
+from ... import testbase
+from pulp_deb.plugins import scrubber
+from pulp_deb.plugins.db import models
+
+
+class FakeClock(object):
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+
+class TestThrottle(testbase.TestCase):
+    def test_bandwidth(self):
+        clock = FakeClock()
+        throttle = scrubber.Throttle(bytes_per_sec=100, clock=clock, sleep=clock.sleep)
+        for _ in range(5):
+            throttle.consume(50)
+        # The last read is charged to the next caller
+        self.assertEquals(1002.0, clock.now)
+
+    def test_iops(self):
+        clock = FakeClock()
+        throttle = scrubber.Throttle(ops_per_sec=10, clock=clock, sleep=clock.sleep)
+        for _ in range(11):
+            throttle.consume(1024 * 1024)
+        self.assertAlmostEqual(1001.0, clock.now)
+
+    def test_unlimited(self):
+        clock = FakeClock()
+        throttle = scrubber.Throttle(clock=clock, sleep=clock.sleep)
+        for _ in range(10):
+            throttle.consume(1024 * 1024)
+        self.assertEquals(1000.0, clock.now)
+
+
+class TestScrubber(testbase.TestCase):
+    def setUp(self):
+        super(TestScrubber, self).setUp()
+        self.good = self.new_file('good.deb')
+        self.bad = self.new_file('bad.deb')
+        self.units = [
+            mock.MagicMock(id='1', _storage_path=self.good.path, checksum=self.good.checksum),
+            mock.MagicMock(id='2', _storage_path=self.bad.path, checksum='0' * 64),
+            mock.MagicMock(id='3', _storage_path=self.bad.path + '.gone',
+                           checksum=self.bad.checksum),
+        ]
+        self.state = mock.MagicMock(cursor=None, pass_started=None, passes=0, checked=0,
+                                    problem_count=0, last_pass_problem_count=0)
+        self.state.name = 'default'
+
+    def test_check(self):
+        s = scrubber.Scrubber()
+        self.assertEquals([None, scrubber.PROBLEM_CORRUPT, scrubber.PROBLEM_MISSING],
+                          [s.check(unit) for unit in self.units])
+
+    def test_check_throttled(self):
+        throttle = mock.MagicMock()
+        scrubber.Scrubber(throttle).check(self.units[0])
+        read = sum(c[0][0] for c in throttle.consume.call_args_list if c[0])
+        self.assertEquals(os.path.getsize(self.good.path), read)
+
+    @mock.patch('pulp_deb.plugins.scrubber.models')
+    def test_run(self, _models):
+        _models.DebScrubState.objects.filter.return_value.first.return_value = self.state
+        _models.DebPackage._compute_checksum = models.DebPackage._compute_checksum
+        s = scrubber.Scrubber(batch_size=2)
+        s._next_batch = mock.MagicMock(side_effect=[self.units[:2], self.units[2:], []])
+
+        problems = _models.DebScrubProblem.objects.filter
+        state = s.run(max_units=2)
+        self.assertEquals('2', state.cursor)
+        self.assertEquals(2, state.checked)
+        self.assertEquals(1, state.problem_count)
+        problems.assert_called_once_with(state='default', pass_number=0, unit_id='2')
+        self.assertEquals(scrubber.PROBLEM_CORRUPT,
+                          problems.return_value.update_one.call_args[1]['set__problem'])
+
+        # Resumes after the cursor, and completes the pass
+        state = s.run()
+        self.assertEquals(
+            [mock.call(None, 2), mock.call('2', 2), mock.call('3', 2)],
+            s._next_batch.call_args_list)
+        self.assertEquals(None, state.cursor)
+        self.assertEquals(0, state.checked)
+        self.assertEquals(1, state.passes)
+        self.assertEquals(0, state.problem_count)
+        self.assertEquals(2, state.last_pass_problem_count)
+        self.assertEquals(
+            [mock.call(state='default', pass_number=0, unit_id='2'),
+             mock.call(state='default', pass_number=0, unit_id='3'),
+             # The problems of older passes are dropped
+             mock.call(state='default', pass_number__lt=0)],
+            problems.call_args_list)
+        self.assertEquals(scrubber.PROBLEM_MISSING,
+                          problems.return_value.update_one.call_args[1]['set__problem'])
+        # Broken units are downloaded again by the next sync
+        update = _models.DebPackage.objects.filter.return_value.update_one
+        self.assertEquals([mock.call(id='2'), mock.call(id='3')],
+                          _models.DebPackage.objects.filter.call_args_list)
+        self.assertEquals(2, update.call_count)
+        update.assert_called_with(set__downloaded=False)
+
+    @mock.patch('pulp_deb.plugins.scrubber.models')
+    def test_problems(self, _models):
+        self.state.passes = 3
+        s = scrubber.Scrubber()
+        self.assertEquals(_models.DebScrubProblem.objects.filter.return_value,
+                          s.problems(self.state))
+        s.problems(self.state, last_pass=False)
+        self.assertEquals([mock.call(state='default', pass_number=2),
+                           mock.call(state='default', pass_number=3)],
+                          _models.DebScrubProblem.objects.filter.call_args_list)
+
+
+class TestScrubTask(testbase.TestCase):
+    @mock.patch('pulp_deb.plugins.scrubber.Scrubber')
+    def test_scrub(self, _Scrubber):
+        _Scrubber.return_value.run.return_value = mock.MagicMock(
+            passes=2, checked=10, problem_count=1, last_pass_problem_count=3)
+        self.assertEquals(dict(passes=2, checked=10, problems=1, last_pass_problems=3),
+                          scrubber.scrub(max_units=10, mb_per_sec=2, batch_size=5))
+        throttle = _Scrubber.call_args[0][0]
+        self.assertEquals(2 * 1024 * 1024, throttle.bytes_per_sec)
+        self.assertEquals(None, throttle.ops_per_sec)
+        self.assertEquals(5, _Scrubber.call_args[1]['batch_size'])
+        _Scrubber.return_value.run.assert_called_once_with(10)
+
+    @mock.patch('pulp_deb.plugins.scrubber.scrub_task')
+    def test_queue_scrub(self, _scrub_task):
+        scrubber.queue_scrub(max_units=10)
+        _scrub_task.apply_async_with_reservation.assert_called_once_with(
+            scrubber.RESOURCE_TYPE, scrubber.DEFAULT_STATE, kwargs=dict(max_units=10),
+            tags=mock.ANY)
+
+    @mock.patch('pulp_deb.plugins.scrubber.schedule_utils')
+    @mock.patch('pulp_deb.plugins.scrubber.ScheduledCall')
+    def test_schedule(self, _ScheduledCall, _schedule_utils):
+        call = scrubber.schedule('PT1H', max_units=1000)
+        self.assertEquals(_ScheduledCall.return_value, call)
+        resource = _ScheduledCall.call_args[1]['resource']
+        _ScheduledCall.assert_called_once_with(
+            'PT1H', scrubber.queue_scrub_task.name, kwargs=dict(max_units=1000),
+            resource=resource)
+        call.save.assert_called_once_with()
+        # The previous schedule is replaced
+        _schedule_utils.delete_by_resource.assert_called_once_with(resource)
+
+        _ScheduledCall.reset_mock()
+        self.assertEquals(None, scrubber.schedule(None))
+        self.assertEquals(0, _ScheduledCall.call_count)
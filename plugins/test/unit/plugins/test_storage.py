@@ -0,0 +1,80 @@
+import errno
+import os
+
+import mock
+
+from ... import testbase
+from pulp_deb.plugins import storage
+
+
+class TestImportFile(testbase.TestCase):
+    def setUp(self):
+        super(TestImportFile, self).setUp()
+        self.src = self.new_file('src.deb', contents='payload').path
+        self.dst = os.path.join(self.work_dir, 'storage', 'a', 'b', 'dst.deb')
+
+    def test_hardlink(self):
+        method = storage.import_file(self.src, self.dst, [storage.IMPORT_HARDLINK])
+        self.assertEquals(storage.IMPORT_HARDLINK, method)
+        self.assertEquals(os.stat(self.src).st_ino, os.stat(self.dst).st_ino)
+        self.assertEquals(['dst.deb'], os.listdir(os.path.dirname(self.dst)))
+
+    def test_move(self):
+        inode = os.stat(self.src).st_ino
+        method = storage.import_file(self.src, self.dst, [storage.IMPORT_MOVE])
+        self.assertEquals(storage.IMPORT_MOVE, method)
+        self.assertFalse(os.path.exists(self.src))
+        self.assertEquals(inode, os.stat(self.dst).st_ino)
+
+    def test_move_across_devices(self):
+        _move = mock.MagicMock(side_effect=OSError(errno.EXDEV, 'Invalid cross-device link'))
+        with mock.patch.dict(storage._IMPORT_FUNCTIONS, {storage.IMPORT_MOVE: _move}):
+            method = storage.import_file(self.src, self.dst, [storage.IMPORT_MOVE])
+        self.assertEquals(storage.IMPORT_COPY, method)
+        self.assertEquals('payload', open(self.dst).read())
+
+    @mock.patch('pulp_deb.plugins.storage.fcntl.ioctl')
+    @mock.patch('pulp_deb.plugins.storage.os.link')
+    def test_fallback_to_copy(self, _link, _ioctl):
+        _link.side_effect = OSError(errno.EXDEV, 'Invalid cross-device link')
+        _ioctl.side_effect = IOError(errno.EOPNOTSUPP, 'Operation not supported')
+        method = storage.import_file(
+            self.src, self.dst, [storage.IMPORT_HARDLINK, storage.IMPORT_REFLINK])
+        self.assertEquals(storage.IMPORT_COPY, method)
+        self.assertEquals('payload', open(self.dst).read())
+        self.assertNotEquals(os.stat(self.src).st_ino, os.stat(self.dst).st_ino)
+        # No temporary files are left behind
+        self.assertEquals(['dst.deb'], os.listdir(os.path.dirname(self.dst)))
+
+    def test_missing_source(self):
+        with self.assertRaises(IOError):
+            storage.import_file(self.src + '.missing', self.dst, [storage.IMPORT_HARDLINK])
+        self.assertEquals([], os.listdir(os.path.dirname(self.dst)))
+
+
+@mock.patch('pulp_deb.plugins.storage.pulp_config')
+class TestContentAddressedLayout(testbase.TestCase):
+    checksum = 'ABCDEF' + '0' * 58
+
+    def test_path(self, _config):
+        _config.get.return_value = '/var/lib/pulp'
+        layout = storage.ContentAddressedLayout(2)
+        self.assertEquals(
+            '/var/lib/pulp/content/units/deb/sha256/ab/cd/%s.deb' % self.checksum.lower(),
+            layout.path(self.checksum))
+        layout = storage.ContentAddressedLayout(3)
+        self.assertEquals(
+            '/var/lib/pulp/content/units/deb/sha256/ab/cd/ef/%s.deb' % self.checksum.lower(),
+            layout.path(self.checksum))
+
+    def test_invalid_depth(self, _config):
+        self.assertRaises(ValueError, storage.ContentAddressedLayout, 0)
+        self.assertRaises(ValueError, storage.ContentAddressedLayout, 9)
+
+    def test_get_layout(self, _config):
+        self.assertEquals(None, storage.get_layout({}))
+        self.assertEquals(None, storage.get_layout({'storage_layout': 'default'}))
+        layout = storage.get_layout({'storage_layout': 'sha256'})
+        self.assertEquals(2, layout.depth)
+        layout = storage.get_layout({'storage_layout': 'sha256', 'storage_fanout': '1'})
+        self.assertEquals(1, layout.depth)